@@ -1,299 +1,541 @@
-import json
-import requests
-from PyQt5.QtCore import QThread, pyqtSignal
+import threading
+import time
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
 
-class ApiCallThread(QThread):
+from backend_router import DEFAULT_POLICY, async_stream_with_failover, get_router, stream_with_failover
+from http_pool import CancelToken, get_session_pool
+from llm_backend import DEFAULT_MAX_TOKENS, ApiError, GenerationRequest, stream_generate, async_stream_generate
+from model_warmup import get_warmup_tracker, model_key, supports_preload, warm_up
+from repetition_detector import RepetitionDetector, RepetitionLoop, continuation_prompt, retry_sampling
+from rate_limiter import async_run_with_quota, estimate_request_tokens, quota_key, run_with_quota
+from telemetry import RequestMetrics, get_telemetry
+
+# 线程内合并增量文本的最短发送间隔（秒），避免每个分片都投递一次信号
+DELTA_EMIT_INTERVAL = 0.02
+# 缓存命中时按此长度分片回放，与实时流走同样的信号
+CACHE_REPLAY_CHUNK = 64
+
+class ApiRequestMixin:
+    """请求构建、缓存与增量输出的公共逻辑，由ApiCallThread和AsyncApiCall共用"""
+    def _init_request(self, api_type, api_url, api_key, prompt, model_name, api_format, custom_headers,
+                      cache, endpoints=None, routing=DEFAULT_POLICY, sampling=None, context=None,
+                      keep_alive=None, repetition=None):
+        self.request = GenerationRequest(api_type, api_url, api_key, prompt, model_name,
+                                         api_format, custom_headers, sampling, context, keep_alive)
+        self.prompt = prompt
+        self.cache = cache  # 可选的ResponseCache
+        # 估算进度时假设的最大字数：中文约一个字一个token，按本次请求的最大token数计
+        self.expected_chars = max(1, (sampling or {}).get("max_tokens") or DEFAULT_MAX_TOKENS)
+        # 重复循环检测：repetition为截断后调整采样继续生成的次数，None表示不检测
+        self.repetition = RepetitionDetector() if repetition is not None else None
+        self.repetition_retries = repetition or 0
+        self.repetition_cuts = 0  # 因重复循环截断的次数
+        # 配置了多个端点时按路由策略选择端点，首字之前失败自动换端点
+        self.router = get_router(endpoints, routing) if endpoints and len(endpoints) > 1 else None
+        self.metrics = RequestMetrics(api_type, api_url, model_name)  # 本次请求的计时与用量
+        # 按密钥和模型的RPM/TPM配额排队，429时按Retry-After等待重试
+        self.quota_key = quota_key(api_type, api_key, model_name)
+        self.quota_tokens = estimate_request_tokens(prompt)
+        self.final_frame = None  # 结束帧（Ollama返回的context等），正常结束后才有
+        self._chunks = []  # 响应内容分片，结束时一次性拼接
+        self._pending = []  # 尚未通过delta信号发出的分片
+        self._total_chars = 0
+        self._last_progress = -1
+        self._last_emit = 0.0
+
+    @property
+    def response_text(self):
+        """已接收的完整响应内容"""
+        return "".join(self._chunks)
+    
+    def _lookup_cache(self, data):
+        """查询响应缓存，返回(缓存键, 缓存内容)，未启用缓存时都为None"""
+        if self.cache is None:
+            return None, None
+        cache_key = self.request.cache_key(data)
+        return cache_key, self.cache.get(cache_key)
+    
+    def _store_cache(self, cache_key):
+        """完整生成的结果写入缓存（截断过的结果不缓存，再次生成时重新请求）"""
+        if cache_key is not None and self._chunks and not self.repetition_cuts:
+            self.cache.put(cache_key, self.response_text)
+    
+    def _record_metrics(self, status, decoder=None):
+        """结束计时并记入全局统计，在发出finished/error信号之前调用"""
+        if decoder is not None and status == "success":
+            self.final_frame = decoder.final_frame
+        self.metrics.finish(status, decoder, self.response_text)
+        get_telemetry().record(self.metrics)
+    
+    def _append_text(self, text):
+        """追加一段响应文本，合并发送增量信号并在进度变化时更新进度
+        
+        检测到重复循环时截掉重复的部分，抛出RepetitionLoop中断当前请求。
+        """
+        if not text:
+            return
+        self.metrics.on_text(text)
+        self._chunks.append(text)
+        self._pending.append(text)
+        self._total_chars += len(text)
+        
+        if self.repetition is not None:
+            keep = self.repetition.feed(text)
+            if keep is not None:
+                self._trim_to(keep)
+                raise RepetitionLoop()
+        
+        now = time.monotonic()
+        if now - self._last_emit >= DELTA_EMIT_INTERVAL:
+            self._flush_delta()
+        
+        # 计算进度（假设最大expected_chars字），只在百分比变化时发送
+        progress = min(100, int(self._total_chars / self.expected_chars * 100))
+        if progress != self._last_progress:
+            self._last_progress = progress
+            self.progress.emit(progress)
+    
+    def _trim_to(self, keep):
+        """只保留前keep个字：尚未发出的增量直接丢弃，已经发出的部分通过rewind信号撤回"""
+        text = self.response_text
+        removed = text[keep:]
+        self._chunks = [text[:keep]]
+        self._total_chars = keep
+        pending = "".join(self._pending)
+        if len(removed) > len(pending):
+            self._pending = []
+            self.rewind.emit(removed[:len(removed) - len(pending)])
+        else:
+            self._pending = [pending[:len(pending) - len(removed)]] if len(pending) > len(removed) else []
+        self.repetition_cuts += 1
+        print(f"检测到重复循环，已截掉末尾{len(removed)}字")
+    
+    def _continue_after_loop(self):
+        """截断后还可以重试时，改用调整过采样参数的续写请求，返回是否继续"""
+        if self.repetition_cuts > self.repetition_retries or not self.running:
+            return False
+        r = self.request
+        self.request = GenerationRequest(
+            r.api_type, r.api_url, r.api_key, continuation_prompt(self.prompt, self.response_text), r.model_name,
+            r.api_format, r.custom_headers, retry_sampling(r.sampling, r.api_type, r.api_format), r.context,
+            r.keep_alive
+        )
+        self.quota_tokens = estimate_request_tokens(self.request.prompt)
+        self.repetition.reset(self.response_text)
+        return True
+    
+    @property
+    def finish_status(self):
+        """finished信号带回的状态：截断过重复循环时为repetition，被停止时为cancelled"""
+        if self.repetition_cuts:
+            return "repetition"
+        return "success" if self.running else "cancelled"
+    
+    def _replay(self, text):
+        """把缓存的响应按分片回放，界面收到的信号与实时生成相同"""
+        self.repetition = None  # 缓存的都是完整生成过的结果，不再检测
+        for start in range(0, len(text), CACHE_REPLAY_CHUNK):
+            if not self.running:
+                return
+            self._append_text(text[start:start + CACHE_REPLAY_CHUNK])
+    
+    def _flush_delta(self):
+        """发送尚未发出的增量文本"""
+        if self._pending:
+            self.delta.emit("".join(self._pending))
+            self._pending = []
+        self._last_emit = time.monotonic()
+
+class ApiCallThread(QThread, ApiRequestMixin):
     """API调用线程，支持流式响应"""
     progress = pyqtSignal(int)  # 进度信号
+    delta = pyqtSignal(str)  # 增量文本信号
+    rewind = pyqtSignal(str)  # 撤回已发出的末尾文本（重复循环被截掉的部分）
+    waiting = pyqtSignal(float)  # 等待配额的秒数
     finished = pyqtSignal(str, str)
     error = pyqtSignal(str)
 
-    def __init__(self, api_type, api_url, api_key, prompt, model_name, api_format=None, custom_headers=None):
+    def __init__(self, api_type, api_url, api_key, prompt, model_name, api_format=None, custom_headers=None,
+                 cache=None, endpoints=None, routing=DEFAULT_POLICY, sampling=None, context=None,
+                 keep_alive=None, repetition=None):
         super().__init__()
-        self.api_type = api_type
-        self.api_url = api_url
-        self.api_key = api_key
-        self.prompt = prompt
-        self.model_name = model_name
-        self.api_format = api_format
-        self.custom_headers = custom_headers
-        self.response_text = ""  # 存储响应内容
+        self._init_request(api_type, api_url, api_key, prompt, model_name, api_format, custom_headers,
+                           cache, endpoints, routing, sampling, context, keep_alive, repetition)
         self.running = True  # 控制线程运行的标志
+        self.cancel_token = CancelToken()
+
+    def cancel(self):
+        """停止生成：清除运行标志并立即关闭连接，线程随即结束"""
+        self.metrics.mark_cancel_requested()
+        self.running = False
+        self.cancel_token.cancel()
 
     def run(self):
         try:
-            if self.api_type == "Ollama":
-                self._call_ollama_api()
-            elif self.api_type == "SiliconFlow":
-                self._call_siliconflow_api()
-            elif self.api_type == "自定义":
-                self._call_custom_api()
-            else:
-                self.error.emit(f"不支持的API类型: {self.api_type}")
+            headers, data = self.request.build()
+            
+            cache_key, cached = self._lookup_cache(data)
+            if cached is not None:
+                self._replay(cached)
+                self._flush_delta()
+                self.finished.emit(self.response_text, "cached")
                 return
             
+            while True:
+                try:
+                    decoder = self._stream_response(headers, data)
+                    break
+                except RepetitionLoop:
+                    decoder = None
+                    if not self._continue_after_loop():
+                        break
+                    headers, data = self.request.build()
+            
             # 完成所有响应
-            self.finished.emit(self.response_text, "success")
+            self._flush_delta()
+            if self.running:
+                self._store_cache(cache_key)
+            self._record_metrics("success" if self.running else "cancelled", decoder)
+            self.finished.emit(self.response_text, self.finish_status)
             
+        except ApiError as e:
+            self._flush_delta()
+            self._record_metrics("error")
+            self.error.emit(str(e))
         except Exception as e:
+            self._flush_delta()
+            self._record_metrics("error")
             self.error.emit(f"发生错误: {str(e)}")
     
-    def _call_ollama_api(self):
-        """调用Ollama API"""
-        headers = {"Content-Type": "application/json"}
-        data = {
-            "model": self.model_name,
-            "prompt": self.prompt,
-            "stream": True,  # 启用流式传输
-            "max_tokens": 5000,
-            "temperature": 0.7
-        }
-        
-        # 流式请求
-        with requests.post(self.api_url, headers=headers, 
-                          data=json.dumps(data), stream=True) as response:
-            if response.status_code != 200:
-                self.error.emit(f"API调用失败: {response.status_code} - {response.text}")
-                return
-                
-            # 处理流式响应
-            total_chars = 0
-            for line in response.iter_lines():
-                if not self.running:  # 检查是否应该停止
-                    return
-                    
-                if line:
-                    # 修复JSON解析错误：尝试直接提取response字段
-                    try:
-                        # 尝试解析为JSON
-                        chunk = json.loads(line.decode('utf-8'))
-                        if 'response' in chunk and chunk['response'] is not None:
-                            self.response_text += chunk['response']
-                            total_chars += len(chunk['response'])
-                            # 计算进度（假设最大5000字符）
-                            progress = min(100, int(total_chars / 5000 * 100))
-                            self.progress.emit(progress)
-                    except json.JSONDecodeError:
-                        # 如果不是完整JSON，尝试直接提取文本内容
-                        line_str = line.decode('utf-8')
-                        if 'response' in line_str:
-                            # 尝试提取response内容
-                            try:
-                                start_idx = line_str.find('"response":"') + len('"response":"')
-                                end_idx = line_str.find('"', start_idx)
-                                response_chunk = line_str[start_idx:end_idx]
-                                self.response_text += response_chunk
-                                total_chars += len(response_chunk)
-                                progress = min(100, int(total_chars / 5000 * 100))
-                                self.progress.emit(progress)
-                            except:
-                                # 如果提取失败，忽略这一行
-                                pass
-    
-    def _call_siliconflow_api(self):
-        """调用SiliconFlow API"""
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        data = {
-            "model": self.model_name,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": self.prompt
-                }
-            ],
-            "stream": True,  # 启用流式传输
-            "max_tokens": 5000,
-            "temperature": 0.7
-        }
-        
-        # 流式请求
-        with requests.post(self.api_url, headers=headers, 
-                          data=json.dumps(data), stream=True) as response:
-            if response.status_code != 200:
-                self.error.emit(f"API调用失败: {response.status_code} - {response.text}")
-                return
-                
-            # 处理流式响应
-            total_chars = 0
-            for line in response.iter_lines():
-                if not self.running:  # 检查是否应该停止
-                    return
-                    
-                if line:
-                    # 处理SiliconFlow的流式响应格式
-                    line_str = line.decode('utf-8')
-                    if line_str.startswith("data: "):
-                        line_str = line_str[6:]  # 移除"data: "前缀
-                        
-                    if line_str == "[DONE]":
-                        break
-                        
-                    try:
-                        # 尝试解析为JSON
-                        chunk = json.loads(line_str)
-                        if 'choices' in chunk and len(chunk['choices']) > 0:
-                            choice = chunk['choices'][0]
-                            if 'delta' in choice and 'content' in choice['delta']:
-                                content = choice['delta']['content']
-                                if content is not None:  # 检查content是否为None
-                                    self.response_text += content
-                                    total_chars += len(content)
-                                    # 计算进度（假设最大5000字符）
-                                    progress = min(100, int(total_chars / 5000 * 100))
-                                    self.progress.emit(progress)
-                    except json.JSONDecodeError:
-                        # 如果不是完整JSON，尝试直接提取内容
-                        if '"content":"' in line_str:
-                            try:
-                                start_idx = line_str.find('"content":"') + len('"content":"')
-                                end_idx = line_str.find('"', start_idx)
-                                content = line_str[start_idx:end_idx]
-                                if content is not None:  # 检查content是否为None
-                                    self.response_text += content
-                                    total_chars += len(content)
-                                    # 计算进度（假设最大5000字符）
-                                    progress = min(100, int(total_chars / 5000 * 100))
-                                    self.progress.emit(progress)
-                            except:
-                                # 如果提取失败，忽略这一行
-                                pass
-    
-    def _call_custom_api(self):
-        """调用自定义API"""
-        print(f"开始调用自定义API: {self.api_url}")
-        print(f"API格式: {self.api_format}")
-        
+    def _stream_response(self, headers, data):
+        """等到配额允许后发送流式请求，运行标志被清除时提前结束，返回解码器"""
+        def attempt(on_headers):
+            if not self.repetition_cuts:
+                self.metrics.start()  # 等待配额的时间不计入首字延迟；截断后的续写接着计时
+            if self.router is not None:
+                return stream_with_failover(self.router, self.request, headers, data, self._append_text,
+                                            should_stop=lambda: not self.running,
+                                            on_connect=self.metrics.mark_connected,
+                                            cancel_token=self.cancel_token,
+                                            on_endpoint=self.metrics.set_endpoint, on_headers=on_headers)
+            return stream_generate(self.request, headers, data, self._append_text,
+                                   should_stop=lambda: not self.running,
+                                   on_connect=self.metrics.mark_connected,
+                                   cancel_token=self.cancel_token, on_headers=on_headers)
+
+        decoder = run_with_quota(self.quota_key, self.quota_tokens, attempt,
+                                 should_stop=lambda: not self.running, on_wait=self.waiting.emit)
+        return decoder if decoder is not None else self.request.create_decoder()
+
+class AsyncApiCall(QObject, ApiRequestMixin):
+    """基于异步引擎的API调用，接口与ApiCallThread相同
+
+    不占用独立线程，所有请求在AsyncStreamEngine的事件循环线程中多路复用；
+    信号从引擎线程发出，由Qt排队投递到界面线程。
+    """
+    progress = pyqtSignal(int)  # 进度信号
+    delta = pyqtSignal(str)  # 增量文本信号
+    rewind = pyqtSignal(str)  # 撤回已发出的末尾文本（重复循环被截掉的部分）
+    waiting = pyqtSignal(float)  # 等待配额的秒数
+    finished = pyqtSignal(str, str)
+    error = pyqtSignal(str)
+
+    def __init__(self, api_type, api_url, api_key, prompt, model_name, api_format=None, custom_headers=None,
+                 cache=None, endpoints=None, routing=DEFAULT_POLICY, sampling=None, context=None,
+                 keep_alive=None, repetition=None, engine=None):
+        super().__init__()
+        self._init_request(api_type, api_url, api_key, prompt, model_name, api_format, custom_headers,
+                           cache, endpoints, routing, sampling, context, keep_alive, repetition)
+        if engine is None:
+            # 延迟导入，未启用异步引擎时不加载asyncio相关模块；超时与连接池设置保持一致
+            from async_engine import get_async_engine
+            engine = get_async_engine()
+            pool = get_session_pool()
+            engine.connect_timeout = pool.connect_timeout
+            engine.first_byte_timeout = pool.first_byte_timeout
+            engine.read_timeout = pool.read_timeout
+        self.engine = engine
+        self._running = True
+        self._future = None
+        self._done = False
+        # 协程开始运行或在开始前被取消，二者只会发生一个，保证只发出一次结束信号
+        self._state_lock = threading.Lock()
+        self._started = False
+
+    @property
+    def running(self):
+        return self._running
+
+    @running.setter
+    def running(self, value):
+        # 置为False时直接取消协程，连接随之关闭
+        self._running = value
+        if not value and self._future is not None:
+            self._future.cancel()
+
+    def cancel(self):
+        """停止生成：取消协程，连接随之关闭"""
+        self.metrics.mark_cancel_requested()
+        self.running = False
+
+    def start(self):
+        self._future = self.engine.submit(self._run())
+        self._future.add_done_callback(self._on_future_done)
+
+    def isRunning(self):
+        return self._future is not None and not self._done
+
+    def _on_future_done(self, future):
+        """协程开始前就被取消时协程体不会执行，由这里补发结束信号，任务不会一直停在取消中"""
+        if not future.cancelled():
+            return
+        with self._state_lock:
+            if self._started or self._done:
+                return  # 协程已经开始，由它自己发出结束信号
+            self._done = True
+        self._record_metrics("cancelled")
+        self.finished.emit(self.response_text, self.finish_status)
+
+    async def _run(self):
+        import asyncio  # 异步引擎运行时asyncio已加载，这里只是取引用
+        with self._state_lock:
+            if self._done:
+                return  # 开始前已被取消并发出了结束信号
+            self._started = True
         try:
-            # 解析自定义请求头
-            headers = {"Content-Type": "application/json"}
-            if self.custom_headers:
-                try:
-                    custom_headers = json.loads(self.custom_headers)
-                    headers.update(custom_headers)
-                    print(f"自定义请求头: {headers}")
-                except json.JSONDecodeError:
-                    print("警告：自定义请求头格式错误，请确保是有效的JSON格式")
-                    self.error.emit("自定义请求头格式错误，请确保是有效的JSON格式")
-                    return
-            else:
-                print("使用默认请求头")
+            headers, data = self.request.build()
             
-            # 根据API格式构建请求数据
-            if self.api_format == "OpenAI格式":
-                data = {
-                    "model": self.model_name,
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": self.prompt
-                        }
-                    ],
-                    "stream": True,  # 启用流式传输
-                    "max_tokens": 5000,
-                    "temperature": 0.7
-                }
-            else:  # Ollama格式
-                data = {
-                    "model": self.model_name,
-                    "prompt": self.prompt,
-                    "stream": True,  # 启用流式传输
-                    "max_tokens": 5000,
-                    "temperature": 0.7
-                }
+            cache_key, cached = self._lookup_cache(data)
+            if cached is not None:
+                self._replay(cached)
+                self._flush_delta()
+                self.finished.emit(self.response_text, "cached")
+                return
             
-            print(f"请求数据: {json.dumps(data, ensure_ascii=False)}")
+            def attempt(on_headers):
+                if not self.repetition_cuts:
+                    self.metrics.start()  # 等待配额的时间不计入首字延迟；截断后的续写接着计时
+                request = self.request  # 截断后续写时换成新的请求
+                headers, data = request.build()
+                if self.router is not None:
+                    return async_stream_with_failover(
+                        self.router, self.engine, request, headers, data, self._append_text,
+                        on_connect=self.metrics.mark_connected, on_endpoint=self.metrics.set_endpoint,
+                        on_headers=on_headers
+                    )
+                return async_stream_generate(self.engine, request, headers, data, self._append_text,
+                                             on_connect=self.metrics.mark_connected, on_headers=on_headers)
+
+            while True:
+                try:
+                    decoder = await async_run_with_quota(self.quota_key, self.quota_tokens, attempt,
+                                                         on_wait=self.waiting.emit)
+                    break
+                except RepetitionLoop:
+                    decoder = None
+                    if not self._continue_after_loop():
+                        break
+            
+            # 完成所有响应
+            self._flush_delta()
+            self._store_cache(cache_key)
+            self._record_metrics("success", decoder)
+            self.finished.emit(self.response_text, self.finish_status)
             
-            # 流式请求
-            print("发送API请求...")
-            with requests.post(self.api_url, headers=headers, 
-                              data=json.dumps(data), stream=True) as response:
-                print(f"响应状态码: {response.status_code}")
-                if response.status_code != 200:
-                    error_msg = f"API调用失败: {response.status_code} - {response.text}"
-                    print(error_msg)
-                    self.error.emit(error_msg)
-                    return
-                    
-                # 处理流式响应
-                print("开始处理流式响应...")
-                total_chars = 0
-                for line in response.iter_lines():
-                    if not self.running:  # 检查是否应该停止
-                        print("API调用被停止")
-                        return
-                        
-                    if line:
-                        # 根据API格式处理响应
-                        if self.api_format == "OpenAI格式":
-                            # 处理OpenAI格式的流式响应
-                            line_str = line.decode('utf-8')
-                            if line_str.startswith("data: "):
-                                line_str = line_str[6:]  # 移除"data: "前缀
-                                
-                            if line_str == "[DONE]":
-                                print("OpenAI API响应完成")
-                                break
-                                
-                            try:
-                                # 尝试解析为JSON
-                                chunk = json.loads(line_str)
-                                if 'choices' in chunk and len(chunk['choices']) > 0:
-                                    choice = chunk['choices'][0]
-                                    if 'delta' in choice and 'content' in choice['delta']:
-                                        content = choice['delta']['content']
-                                        if content is not None:  # 检查content是否为None
-                                            self.response_text += content
-                                            total_chars += len(content)
-                                            # 计算进度（假设最大5000字符）
-                                            progress = min(100, int(total_chars / 5000 * 100))
-                                            self.progress.emit(progress)
-                            except json.JSONDecodeError:
-                                # 如果不是完整JSON，尝试直接提取内容
-                                if '"content":"' in line_str:
-                                    try:
-                                        start_idx = line_str.find('"content":"') + len('"content":"')
-                                        end_idx = line_str.find('"', start_idx)
-                                        content = line_str[start_idx:end_idx]
-                                        if content is not None:  # 检查content是否为None
-                                            self.response_text += content
-                                            total_chars += len(content)
-                                            # 计算进度（假设最大5000字符）
-                                            progress = min(100, int(total_chars / 5000 * 100))
-                                            self.progress.emit(progress)
-                                    except:
-                                        # 如果提取失败，忽略这一行
-                                        pass
-                        else:  # Ollama格式
-                            # 处理Ollama格式的流式响应
-                            try:
-                                # 尝试解析为JSON
-                                chunk = json.loads(line.decode('utf-8'))
-                                if 'response' in chunk and chunk['response'] is not None:
-                                    self.response_text += chunk['response']
-                                    total_chars += len(chunk['response'])
-                                    # 计算进度（假设最大5000字符）
-                                    progress = min(100, int(total_chars / 5000 * 100))
-                                    self.progress.emit(progress)
-                            except json.JSONDecodeError:
-                                # 如果不是完整JSON，尝试直接提取文本内容
-                                line_str = line.decode('utf-8')
-                                if 'response' in line_str:
-                                    # 尝试提取response内容
-                                    try:
-                                        start_idx = line_str.find('"response":"') + len('"response":"')
-                                        end_idx = line_str.find('"', start_idx)
-                                        response_chunk = line_str[start_idx:end_idx]
-                                        self.response_text += response_chunk
-                                        total_chars += len(response_chunk)
-                                        progress = min(100, int(total_chars / 5000 * 100))
-                                        self.progress.emit(progress)
-                                    except:
-                                        # 如果提取失败，忽略这一行
-                                        pass
+        except asyncio.CancelledError:
+            # 与线程版停止时一致：返回已生成的部分，状态由任务队列按取消处理
+            self._flush_delta()
+            self._record_metrics("cancelled")
+            self.finished.emit(self.response_text, self.finish_status)
+            raise
+        except ApiError as e:
+            self._flush_delta()
+            self._record_metrics("error")
+            self.error.emit(str(e))
+        except Exception as e:
+            self._flush_delta()
+            self._record_metrics("error")
+            self.error.emit(f"发生错误: {str(e)}")
+        finally:
+            self._done = True
+
+class StoryMemoryThread(QThread):
+    """在后台为故事记忆生成章节、篇章和全书概要"""
+    finished = pyqtSignal(str)  # 完成状态：success/stopped
+    error = pyqtSignal(str)
+
+    def __init__(self, memory, params):
+        super().__init__()
+        self.memory = memory
+        self.params = params  # 与生成任务相同的API设置
+        self.running = True
+        self.cancel_token = CancelToken()
+
+    def cancel(self):
+        self.running = False
+        self.cancel_token.cancel()
+
+    def run(self):
+        try:
+            self.memory.update(self._summarize, should_stop=lambda: not self.running)
+        except ApiError as e:
+            if self.running:
+                self.error.emit(str(e))
+                return
+        except Exception as e:
+            self.error.emit(f"生成概要时发生错误: {str(e)}")
+            return
+        self.finished.emit("success" if self.running else "stopped")
+
+    def _summarize(self, prompt):
+        """同步调用模型，返回完整输出"""
+        request = GenerationRequest(
+            self.params["api_type"], self.params["api_url"], self.params["api_key"], prompt,
+            self.params["model_name"], self.params.get("api_format"), self.params.get("custom_headers"),
+            keep_alive=self.params.get("keep_alive")
+        )
+        headers, data = request.build()
+        chunks = []
+        run_with_quota(
+            quota_key(request.api_type, request.api_key, request.model_name), estimate_request_tokens(prompt),
+            lambda on_headers: stream_generate(request, headers, data, chunks.append,
+                                               should_stop=lambda: not self.running,
+                                               cancel_token=self.cancel_token, on_headers=on_headers),
+            should_stop=lambda: not self.running
+        )
+        if not self.running:
+            raise ApiError("概要生成已停止")  # 不保存半截概要
+        return "".join(chunks)
+
+class EndpointProbeThread(QThread):
+    """在后台检查后端池中各端点的健康状态和延迟"""
+    finished = pyqtSignal(list)  # 每个端点的状态字典
+
+    def __init__(self, router):
+        super().__init__()
+        self.router = router
+
+    def run(self):
+        self.finished.emit(self.router.probe())
+
+class ModelWarmupThread(QThread):
+    """在后台预热模型：依次预热后端池中的每个端点，并更新模型的冷热状态"""
+    finished = pyqtSignal(list)  # 每个端点的结果：url、ok、ms、error
+
+    def __init__(self, params):
+        super().__init__()
+        self.params = params  # 与生成任务相同的API设置
+        self.cancel_token = CancelToken()
+
+    def cancel(self):
+        self.cancel_token.cancel()
+
+    def run(self):
+        p = self.params
+        tracker = get_warmup_tracker()
+        # 不能单独加载模型的接口（云端服务）不会被卸载，连接建立后一直视为就绪
+        keep_alive = p.get("keep_alive") if supports_preload(p["api_type"], p.get("api_format")) else -1
+        results = []
+        for url in p.get("endpoints") or [p["api_url"]]:
+            if self.cancel_token.cancelled:
+                break
+            key = model_key(p["api_type"], url, p["model_name"])
+            tracker.mark_warming(key)
+            try:
+                ms = warm_up(p["api_type"], url, p["model_name"], p.get("api_format"), p.get("keep_alive"),
+                             cancel_token=self.cancel_token, num_ctx=p.get("num_ctx"))
+                tracker.mark_warm(key, ms, keep_alive)
+                results.append({"url": url, "ok": True, "ms": ms, "error": None})
+            except ApiError as e:
+                tracker.mark_failed(key, e)
+                results.append({"url": url, "ok": False, "ms": None, "error": str(e)})
+        self.finished.emit(results)
+
+class RetrievalIndexThread(QThread):
+    """在后台读取检索索引，打开项目时按章节补齐新增和改写的内容后保存"""
+    finished = pyqtSignal(object)  # 加载完成的RetrievalIndex
+
+    def __init__(self, path, chapters=None):
+        super().__init__()
+        self.path = path
+        self.chapters = chapters  # 在界面线程中读出的各章(章节号, 正文字节数, 正文)，项目文件不跨线程共享
+        self.running = True
+
+    def cancel(self):
+        self.running = False
+
+    def run(self):
+        from retrieval_index import RetrievalIndex  # 在后台线程中加载，不占用启动的关键路径
+        index = RetrievalIndex.load(self.path)
+        try:
+            if self.chapters is not None:
+                index.sync_chapters([(chapter_id, size, lambda text=text: text)
+                                     for chapter_id, size, text in self.chapters],
+                                    should_stop=lambda: not self.running)
+            if index.dirty and self.running:
+                index.save()
+        except Exception as e:
+            print(f"更新检索索引失败: {e}")
+        if self.running:
+            self.finished.emit(index)
+
+class EmbeddingThread(QThread):
+    """在后台调用向量模型，为检索索引的片段或检索查询计算向量"""
+    finished = pyqtSignal(list)  # 与texts一一对应的向量
+    error = pyqtSignal(str)
+
+    def __init__(self, base_url, model, texts):
+        super().__init__()
+        self.base_url = base_url
+        self.model = model
+        self.texts = texts
+        self.cancel_token = CancelToken()
+
+    def cancel(self):
+        self.cancel_token.cancel()
+
+    def run(self):
+        from retrieval_index import embed_texts
+        try:
+            vectors = embed_texts(self.base_url, self.model, self.texts, cancel_token=self.cancel_token)
+        except ApiError as e:
+            if not self.cancel_token.cancelled:
+                self.error.emit(str(e))
+            return
+        self.finished.emit(vectors)
+
+class PostProcessThread(QThread):
+    """在后台整理文稿并导出：规范化标点、分段和统计在工作进程池中进行，结果逐段写入文件"""
+    progress = pyqtSignal(int)  # 进度百分比
+    chapter_done = pyqtSignal(int, dict)  # 章序号、该章统计
+    finished = pyqtSignal(dict)  # 全书统计
+    error = pyqtSignal(str)
+    cancelled = pyqtSignal()  # 被取消，没有写出文件
+
+    def __init__(self, processor, title, chapters, path, options):
+        super().__init__()
+        self.processor = processor
+        self.title = title
+        self.chapters = chapters  # (标题, 正文)列表
+        self.path = path
+        self.options = options
+        self.running = True
+
+    def cancel(self):
+        self.running = False
+
+    def run(self):
+        from postprocess import export_manuscript  # 只在导出时加载，不拖慢启动
+        try:
+            totals = export_manuscript(
+                self.processor, self.title, self.chapters, self.path, self.options,
+                on_progress=lambda done, total: self.progress.emit(done * 100 // max(1, total)),
+                on_chapter=self.chapter_done.emit, should_stop=lambda: not self.running
+            )
         except Exception as e:
-            error_msg = f"自定义API调用错误: {str(e)}"
-            print(error_msg)
-            self.error.emit(error_msg)
\ No newline at end of file
+            self.error.emit(f"导出时发生错误: {str(e)}")
+            return
+        if totals is None:
+            self.cancelled.emit()
+        else:
+            self.finished.emit(totals)
@@ -0,0 +1,287 @@
+import asyncio
+import ssl
+import threading
+from urllib.parse import urlsplit
+
+# 默认超时（秒），与http_pool保持一致；引擎只依赖标准库，不引入requests
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_FIRST_BYTE_TIMEOUT = 120
+DEFAULT_READ_TIMEOUT = 60
+# 每次从连接读取的最大字节数
+READ_CHUNK_SIZE = 65536
+# 每个端点最多保留的空闲keep-alive连接数
+DEFAULT_MAX_IDLE_PER_ENDPOINT = 16
+
+
+class HttpStatusError(Exception):
+    """服务端返回非200状态码"""
+    def __init__(self, status, body, headers=None):
+        super().__init__(f"{status} - {body}")
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+
+
+class StreamTimeoutError(Exception):
+    """某个阶段超时：connect（建立连接）、first_byte（首块数据）、idle（两块数据之间）"""
+    def __init__(self, stage, seconds):
+        super().__init__(f"{stage} timeout after {seconds}s")
+        self.stage = stage
+        self.seconds = seconds
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class AsyncStreamEngine:
+    """基于asyncio的流式请求引擎
+
+    所有请求在同一个后台事件循环线程中多路复用，只使用标准库的asyncio流，
+    自带按端点的keep-alive连接复用。取消请求会立即关闭对应的socket。
+    """
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 max_idle_per_endpoint=DEFAULT_MAX_IDLE_PER_ENDPOINT,
+                 first_byte_timeout=DEFAULT_FIRST_BYTE_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout  # 空闲超时：两块数据之间的最长等待
+        self.first_byte_timeout = first_byte_timeout
+        self.max_idle_per_endpoint = max_idle_per_endpoint
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._idle = {}  # 端点 -> 空闲连接列表
+        self._ssl_context = None
+        self.active_streams = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                started = threading.Event()
+                self._thread = threading.Thread(
+                    target=self._run_loop, args=(started,), name="AsyncStreamEngine", daemon=True
+                )
+                self._thread.start()
+                started.wait()
+            return self._loop
+
+    def _run_loop(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(started.set)
+        self._loop.run_forever()
+
+    def submit(self, coro):
+        """在引擎线程中运行协程，返回concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def call_soon(self, callback, *args):
+        """在引擎线程中执行回调"""
+        self._ensure_loop().call_soon_threadsafe(callback, *args)
+
+    def stats(self):
+        return {
+            "active_streams": self.active_streams,
+            "connections_opened": self.connections_opened,
+            "connections_reused": self.connections_reused,
+        }
+
+    def shutdown(self):
+        """关闭空闲连接并停止事件循环"""
+        with self._lock:
+            loop = self._loop
+            self._loop = None
+        if loop is None:
+            return
+
+        def stop():
+            for connections in self._idle.values():
+                for conn in connections:
+                    conn.close()
+            self._idle = {}
+            loop.stop()
+        loop.call_soon_threadsafe(stop)
+        self._thread.join(timeout=5)
+
+    async def stream(self, url, headers, body, on_chunk, on_headers=None):
+        """发送POST请求并把响应体按块交给on_chunk
+
+        on_headers(headers)在读完响应头时调用（头部名称为小写）。非200状态码抛出HttpStatusError，
+        各阶段超时抛出StreamTimeoutError。协程被取消时连接直接关闭。
+        """
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        endpoint = (parts.scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        request_headers = {"Host": parts.netloc, "Connection": "keep-alive",
+                           "Accept-Encoding": "identity"}
+        request_headers.update(headers)
+        request_headers["Content-Length"] = str(len(body))
+        head = f"POST {path} HTTP/1.1\r\n" + "".join(
+            f"{k}: {v}\r\n" for k, v in request_headers.items()
+        ) + "\r\n"
+        state = {"stage": "first_byte"}
+        conn, status_line = await self._send_request(
+            endpoint, parts.hostname, port, parts.scheme == "https", head.encode("latin-1") + body, state
+        )
+        reusable = False
+        self.active_streams += 1
+        try:
+            status, response_headers = await self._read_head(conn.reader, state, status_line)
+            if on_headers is not None:
+                on_headers(response_headers)
+            if status != 200:
+                data = []
+                await self._read_body(conn.reader, response_headers, data.append, state)
+                text = b"".join(data).decode("utf-8", errors="replace")
+                raise HttpStatusError(status, text, response_headers)
+
+            def on_data(data):
+                state["stage"] = "idle"  # 收到首块数据后改用空闲超时
+                on_chunk(data)
+
+            reusable = await self._read_body(conn.reader, response_headers, on_data, state)
+            return status
+        finally:
+            self.active_streams -= 1
+            if reusable:
+                self._release(endpoint, conn)
+            else:
+                conn.close()
+
+    async def _send_request(self, endpoint, host, port, use_ssl, request, state):
+        """发送请求并读出状态行，返回(连接, 状态行)
+
+        复用的空闲连接可能已被服务端关闭（keep-alive超时），这时在收到状态行之前就会失败，
+        服务端还没有处理这个请求；与urllib3一样换一个新连接重发一次。
+        """
+        conn, reused = await self._acquire(endpoint, host, port, use_ssl)
+        while True:
+            try:
+                conn.writer.write(request)
+                await conn.writer.drain()
+                return conn, await self._readline(conn.reader, state)
+            except OSError:
+                conn.close()
+                if not reused:
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+            conn, reused = await self._acquire(endpoint, host, port, use_ssl, reuse=False)
+
+    async def _acquire(self, endpoint, host, port, use_ssl, reuse=True):
+        """取一个连接，返回(连接, 是否为复用的空闲连接)；reuse为False时总是新建"""
+        idle = self._idle.get(endpoint) if reuse else None
+        while idle:
+            conn = idle.pop()
+            if not conn.reader.at_eof() and not conn.writer.is_closing():
+                self.connections_reused += 1
+                return conn, True
+            conn.close()
+        ssl_context = None
+        if use_ssl:
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=ssl_context),
+                self.connect_timeout
+            )
+        except asyncio.TimeoutError:
+            raise StreamTimeoutError("connect", self.connect_timeout)
+        self.connections_opened += 1
+        return _Connection(reader, writer), False
+
+    def _release(self, endpoint, conn):
+        idle = self._idle.setdefault(endpoint, [])
+        if len(idle) < self.max_idle_per_endpoint:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    async def _wait(self, awaitable, state):
+        """按当前阶段的超时等待一次读取"""
+        timeout = self.first_byte_timeout if state["stage"] == "first_byte" else self.read_timeout
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            raise StreamTimeoutError(state["stage"], timeout)
+
+    async def _readline(self, reader, state):
+        line = await self._wait(reader.readline(), state)
+        if not line:
+            raise ConnectionError("连接被服务端关闭")
+        return line
+
+    async def _read_head(self, reader, state, status_line):
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            raise ConnectionError(f"无效的HTTP响应: {status_line[:100]!r}")
+        headers = {}
+        while True:
+            line = await self._readline(reader, state)
+            if line in (b"\r\n", b"\n"):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    async def _read_body(self, reader, headers, on_chunk, state):
+        """读取响应体，返回连接是否可以复用"""
+        keep_alive = headers.get("connection", "").lower() != "close"
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            while True:
+                size_line = await self._readline(reader, state)
+                size = int(size_line.split(b";")[0].strip(), 16)
+                if size == 0:
+                    # 跳过trailer
+                    while (await self._readline(reader, state)) not in (b"\r\n", b"\n"):
+                        pass
+                    return keep_alive
+                data = await self._wait(reader.readexactly(size), state)
+                await self._readline(reader, state)
+                on_chunk(data)
+        if "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining > 0:
+                data = await self._wait(reader.read(min(remaining, READ_CHUNK_SIZE)), state)
+                if not data:
+                    raise ConnectionError("响应体不完整")
+                remaining -= len(data)
+                on_chunk(data)
+            return keep_alive
+        # 没有长度信息，读到连接关闭为止
+        while True:
+            data = await self._wait(reader.read(READ_CHUNK_SIZE), state)
+            if not data:
+                return False
+            on_chunk(data)
+
+
+_async_engine = None
+_async_engine_lock = threading.Lock()
+
+
+def get_async_engine():
+    """获取进程级共享的异步引擎"""
+    global _async_engine
+    with _async_engine_lock:
+        if _async_engine is None:
+            _async_engine = AsyncStreamEngine()
+        return _async_engine
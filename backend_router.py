@@ -0,0 +1,301 @@
+import copy
+import threading
+import time
+
+from http_pool import SessionPool, get_session_pool
+from llm_backend import ApiError, async_stream_generate, stream_generate
+
+# 路由策略
+POLICY_LEAST_OUTSTANDING = "least_outstanding"  # 进行中请求最少的端点
+POLICY_EWMA = "ewma"  # 首字延迟的指数加权平均 ×（进行中请求 + 1）最小的端点
+POLICIES = {
+    POLICY_LEAST_OUTSTANDING: "最少进行中请求",
+    POLICY_EWMA: "最低延迟（EWMA）",
+}
+DEFAULT_POLICY = POLICY_LEAST_OUTSTANDING
+
+EWMA_ALPHA = 0.3  # 新样本的权重
+PROBE_INTERVAL = 30  # 健康检查间隔（秒）
+PROBE_TIMEOUT = 5
+MAX_ATTEMPTS = 3  # 首字之前失败时最多尝试的端点数（含第一次）
+RETRY_BACKOFF = 0.5  # 第n次重试前等待 RETRY_BACKOFF * 2^(n-1) 秒
+MAX_COOLDOWN = 60  # 连续失败的端点暂停使用的最长时间（秒）
+
+
+def parse_endpoints(primary, extra):
+    """合并主地址和备用地址（字符串按换行或逗号分隔），去重并保持顺序"""
+    if isinstance(extra, str):
+        extra = extra.replace(",", "\n").split("\n")
+    urls = []
+    for url in [primary] + list(extra or []):
+        url = (url or "").strip()
+        if url and url not in urls:
+            urls.append(url)
+    return urls
+
+
+class Endpoint:
+    """后端池中的一个端点及其运行状态"""
+    def __init__(self, url):
+        self.url = url
+        self.key = SessionPool.endpoint_key(url)
+        self.outstanding = 0  # 进行中的请求数
+        self.ewma_ms = None  # 首字延迟的指数加权平均
+        self.probe_ms = None  # 最近一次健康检查的耗时
+        self.healthy = True
+        self.failures = 0  # 连续失败次数
+        self.down_until = 0.0  # 在此之前不分配新请求（time.monotonic）
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+
+    def available(self, now):
+        return self.healthy and now >= self.down_until
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "ewma_ms": round(self.ewma_ms, 1) if self.ewma_ms is not None else None,
+            "probe_ms": round(self.probe_ms, 1) if self.probe_ms is not None else None,
+            "requests": self.requests,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+class BackendRouter:
+    """一个逻辑后端的多个端点之间的负载均衡
+
+    按策略选择端点，记录每个端点的进行中请求数和首字延迟；
+    连续失败的端点按指数退避暂停使用，后台线程定期做健康检查。
+    """
+    def __init__(self, urls, policy=DEFAULT_POLICY, probe_interval=PROBE_INTERVAL):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.policy = policy
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._next = 0  # 条件相同时轮询
+        self._probe_thread = None
+        self._stop = threading.Event()
+
+    def choose(self, exclude=()):
+        """选择一个端点并计入进行中请求；没有可用端点时在暂停中的端点里选"""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [ep for ep in self.endpoints if ep.url not in exclude]
+            if not candidates:
+                return None
+            available = [ep for ep in candidates if ep.available(now)] or candidates
+            count = len(self.endpoints)
+            order = {ep.url: (i - self._next) % count for i, ep in enumerate(self.endpoints)}
+            if self.policy == POLICY_EWMA:
+                # 没有延迟数据的端点优先试一次
+                key = lambda ep: ((ep.ewma_ms or 0) * (ep.outstanding + 1), order[ep.url])
+            else:
+                key = lambda ep: (ep.outstanding, ep.ewma_ms or 0, order[ep.url])
+            endpoint = min(available, key=key)
+            self._next = (self.endpoints.index(endpoint) + 1) % count
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        self._ensure_probing()
+        return endpoint
+
+    def release(self, endpoint):
+        with self._lock:
+            endpoint.outstanding = max(0, endpoint.outstanding - 1)
+
+    def report_success(self, endpoint, ttft_ms):
+        """首字到达：更新延迟并清除失败计数"""
+        with self._lock:
+            endpoint.failures = 0
+            endpoint.down_until = 0.0
+            endpoint.healthy = True
+            if endpoint.ewma_ms is None:
+                endpoint.ewma_ms = ttft_ms
+            else:
+                endpoint.ewma_ms = EWMA_ALPHA * ttft_ms + (1 - EWMA_ALPHA) * endpoint.ewma_ms
+
+    def report_failure(self, endpoint, error):
+        """首字之前失败：连续失败越多，暂停越久"""
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.errors += 1
+            endpoint.last_error = str(error)
+            endpoint.down_until = time.monotonic() + min(MAX_COOLDOWN, 2 ** (endpoint.failures - 1))
+
+    def probe(self):
+        """立即检查所有端点：能收到任何HTTP响应即视为健康"""
+        pool = get_session_pool()
+        for endpoint in self.endpoints:
+            start = time.perf_counter()
+            try:
+                pool.get(endpoint.key + "/", timeout=(pool.connect_timeout, PROBE_TIMEOUT)).close()
+                elapsed = (time.perf_counter() - start) * 1000
+                with self._lock:
+                    endpoint.healthy = True
+                    endpoint.probe_ms = elapsed
+                    if endpoint.ewma_ms is None:
+                        endpoint.ewma_ms = elapsed
+            except Exception as e:
+                with self._lock:
+                    endpoint.healthy = False
+                    endpoint.last_error = f"健康检查失败: {type(e).__name__}"
+        return self.stats()
+
+    def stats(self):
+        with self._lock:
+            return [ep.to_dict() for ep in self.endpoints]
+
+    def stop(self):
+        self._stop.set()
+
+    def _ensure_probing(self):
+        if self._probe_thread is not None or self.probe_interval <= 0 or len(self.endpoints) < 2:
+            return
+        with self._lock:
+            if self._probe_thread is not None:
+                return
+            self._probe_thread = threading.Thread(target=self._probe_loop, name="BackendProbe", daemon=True)
+        self._probe_thread.start()
+
+    def _probe_loop(self):
+        while not self._stop.wait(self.probe_interval):
+            self.probe()
+
+
+_routers = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(urls, policy=DEFAULT_POLICY):
+    """获取端点列表对应的共享路由器，相同端点列表的任务共用端点状态"""
+    key = tuple(urls)
+    with _routers_lock:
+        router = _routers.get(key)
+        if router is None:
+            router = _routers[key] = BackendRouter(urls, policy)
+        router.policy = policy
+        return router
+
+
+def prune_routers(urls):
+    """停止并移除端点列表不是urls的路由器（设置中的端点改动后调用），进行中的请求仍可使用原路由器"""
+    key = tuple(urls)
+    with _routers_lock:
+        stale = [_routers.pop(other) for other in list(_routers) if other != key]
+    for router in stale:
+        router.stop()
+
+
+def _attempt_request(request, endpoint):
+    """为一次尝试复制请求并换成该端点的地址"""
+    attempt = copy.copy(request)
+    attempt.api_url = endpoint.url
+    return attempt
+
+
+def _should_retry(error, got_text, cancelled):
+    """首字之前的连接错误、5xx和连接/首字超时换端点重试；已输出内容或被取消时不重试"""
+    if got_text or cancelled:
+        return False
+    if isinstance(error, ApiError):
+        return error.retriable
+    return True  # 连接被拒绝、连接重置等
+
+
+def stream_with_failover(router, request, headers, data, on_text, should_stop=None, on_connect=None,
+                         cancel_token=None, on_endpoint=None, max_attempts=MAX_ATTEMPTS, on_headers=None):
+    """同步流式请求，首字之前失败时按退避换一个端点重试
+
+    参数与stream_generate相同；on_endpoint(url)在每次尝试前调用。返回解码器。
+    """
+    tried = []
+    last_error = None
+    for attempt in range(max_attempts):
+        if attempt:
+            if len(tried) >= len(router.endpoints):
+                break
+            # 退避等待，期间可被取消
+            deadline = time.monotonic() + RETRY_BACKOFF * (2 ** (attempt - 1))
+            while time.monotonic() < deadline:
+                if (should_stop is not None and should_stop()) or \
+                        (cancel_token is not None and cancel_token.cancelled):
+                    return request.create_decoder()
+                time.sleep(0.05)
+        endpoint = router.choose(exclude=tried)
+        if endpoint is None:
+            break
+        tried.append(endpoint.url)
+        if on_endpoint is not None:
+            on_endpoint(endpoint.url)
+        start = time.perf_counter()
+        state = {"got_text": False}
+
+        def on_attempt_text(text, endpoint=endpoint, start=start, state=state):
+            if not state["got_text"]:
+                state["got_text"] = True
+                router.report_success(endpoint, (time.perf_counter() - start) * 1000)
+            on_text(text)
+
+        try:
+            return stream_generate(_attempt_request(request, endpoint), headers, data, on_attempt_text,
+                                   should_stop=should_stop, on_connect=on_connect, cancel_token=cancel_token,
+                                   on_headers=on_headers)
+        except Exception as e:
+            cancelled = cancel_token is not None and cancel_token.cancelled
+            if not _should_retry(e, state["got_text"], cancelled):
+                raise
+            router.report_failure(endpoint, e)
+            last_error = e
+            print(f"端点 {endpoint.url} 失败，尝试其他端点: {e}")
+        finally:
+            router.release(endpoint)
+    if last_error is not None:
+        raise last_error
+    raise ApiError("没有可用的端点")
+
+
+async def async_stream_with_failover(router, engine, request, headers, data, on_text, on_connect=None,
+                                     on_endpoint=None, max_attempts=MAX_ATTEMPTS, on_headers=None):
+    """异步版本的stream_with_failover，取消由协程取消完成"""
+    import asyncio
+    tried = []
+    last_error = None
+    for attempt in range(max_attempts):
+        if attempt:
+            if len(tried) >= len(router.endpoints):
+                break
+            await asyncio.sleep(RETRY_BACKOFF * (2 ** (attempt - 1)))
+        endpoint = router.choose(exclude=tried)
+        if endpoint is None:
+            break
+        tried.append(endpoint.url)
+        if on_endpoint is not None:
+            on_endpoint(endpoint.url)
+        start = time.perf_counter()
+        state = {"got_text": False}
+
+        def on_attempt_text(text, endpoint=endpoint, start=start, state=state):
+            if not state["got_text"]:
+                state["got_text"] = True
+                router.report_success(endpoint, (time.perf_counter() - start) * 1000)
+            on_text(text)
+
+        try:
+            return await async_stream_generate(engine, _attempt_request(request, endpoint), headers, data,
+                                               on_attempt_text, on_connect=on_connect, on_headers=on_headers)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not _should_retry(e, state["got_text"], False):
+                raise
+            router.report_failure(endpoint, e)
+            last_error = e
+            print(f"端点 {endpoint.url} 失败，尝试其他端点: {e}")
+        finally:
+            router.release(endpoint)
+    if last_error is not None:
+        raise last_error
+    raise ApiError("没有可用的端点")
@@ -0,0 +1,283 @@
+"""无界面批量生成
+
+读取JSONL提示文件，按并发上限流式生成，把结果和耗时逐行写入JSONL。
+输出文件同时作为断点：重新运行时跳过已成功的提示，适合在服务器上整夜批量生成章节。
+不导入PyQt5，可在没有显示器的环境中运行。
+
+用法:
+    python batch_cli.py prompts.jsonl -o results.jsonl --parallel 4
+    python batch_cli.py prompts.jsonl -o results.jsonl --api-type SiliconFlow --model Qwen/Qwen2.5-7B-Instruct
+
+输入每行一个JSON对象，至少包含提示词（prompt或body字段），可选id（或request_id）
+以及覆盖默认设置的api_type、api_url、api_key、model_name、api_format、custom_headers、
+extra_endpoints、routing和采样参数temperature、max_tokens。配置了多个端点时按路由策略分配请求，首字之前失败自动换端点重试。
+请求按每分钟请求数/token数限额（--rpm/--tpm、设置或响应头中的限额）排队，
+收到429时按Retry-After等待后重试，而不是直接记为失败。
+输出陷入重复循环时截掉重复部分并结束该请求，结果中repetition为true（--no-repetition-check关闭）。
+默认设置取自settings.json，命令行参数优先。
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from backend_router import DEFAULT_POLICY, POLICIES, get_router, parse_endpoints, stream_with_failover
+from http_pool import CancelToken, get_session_pool
+from llm_backend import ApiError, GenerationRequest, stream_generate
+from repetition_detector import RepetitionDetector, RepetitionLoop
+from rate_limiter import estimate_request_tokens, get_rate_limiter, quota_key, run_with_quota
+from telemetry import RequestMetrics, get_telemetry
+
+ID_FIELDS = ("id", "request_id")
+PROMPT_FIELDS = ("prompt", "body")
+API_FIELDS = ("api_type", "api_url", "api_key", "model_name", "api_format", "custom_headers",
+              "extra_endpoints", "routing", "keep_alive")
+# 可按条或在命令行指定的采样参数，未指定时使用请求的默认值
+SAMPLING_FIELDS = ("temperature", "max_tokens")
+
+
+def load_settings(path):
+    """读取界面保存的settings.json，不存在时返回空设置"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_prompts(path, id_field=None, prompt_field=None):
+    """逐行读取提示文件，返回(编号, 提示词, 覆盖设置)列表"""
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            id_fields = (id_field,) if id_field else ID_FIELDS
+            prompt_fields = (prompt_field,) if prompt_field else PROMPT_FIELDS
+            item_id = next((record[k] for k in id_fields if k in record), None)
+            prompt = next((record[k] for k in prompt_fields if k in record), None)
+            if prompt is None:
+                print(f"第{line_no}行缺少提示词，已跳过", file=sys.stderr)
+                continue
+            overrides = {k: record[k] for k in API_FIELDS + SAMPLING_FIELDS if k in record}
+            items.append((str(item_id if item_id is not None else line_no), prompt, overrides))
+    return items
+
+
+def load_checkpoint(path):
+    """读取已有输出，返回已成功完成的编号集合"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 上次中断时可能写了半行
+            if record.get("status") == "ok":
+                done.add(str(record.get("id")))
+    return done
+
+
+class BatchRunner:
+    """并发执行一批生成任务，每完成一个立即落盘"""
+    def __init__(self, defaults, output_path, parallel=4, repetition_check=True):
+        self.defaults = defaults
+        self.output_path = output_path
+        self.parallel = parallel
+        self.repetition_check = repetition_check
+        self.stop_event = threading.Event()
+        self._tokens = set()  # 进行中请求的取消令牌，中断时立即关闭它们的连接
+        self._lock = threading.Lock()
+        self._output = None
+
+    def run(self, items):
+        """运行所有任务，返回(成功数, 失败数)"""
+        ok = failed = 0
+        get_session_pool().configure(pool_size=max(self.parallel, 10))
+        with open(self.output_path, "a", encoding="utf-8") as self._output:
+            with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                futures = [executor.submit(self.run_one, *item) for item in items]
+                try:
+                    for future in as_completed(futures):
+                        record = future.result()
+                        if record is None:
+                            continue
+                        if record["status"] == "ok":
+                            ok += 1
+                        else:
+                            failed += 1
+                        print(f"[{ok + failed}/{len(items)}] {record['id']} {record['status']} "
+                              f"{record['chars']}字 {record['elapsed']:.1f}s", file=sys.stderr)
+                except KeyboardInterrupt:
+                    print("正在停止，已完成的结果已保存，可用相同命令继续", file=sys.stderr)
+                    self.stop_event.set()
+                    for future in futures:
+                        future.cancel()
+                    with self._lock:
+                        tokens = list(self._tokens)
+                    for token in tokens:
+                        token.cancel()
+        return ok, failed
+
+    def run_one(self, item_id, prompt, overrides):
+        """执行单个任务，被中断时返回None（不写断点，下次重跑）"""
+        if self.stop_event.is_set():
+            return None
+        params = dict(self.defaults)
+        params.update(overrides)
+        sampling = {k: params[k] for k in SAMPLING_FIELDS if params.get(k) is not None}
+        request = GenerationRequest(
+            params.get("api_type", "Ollama"), params.get("api_url", ""), params.get("api_key", ""),
+            prompt, params.get("model_name", ""), params.get("api_format"),
+            params.get("custom_headers") or None, sampling=sampling or None, keep_alive=params.get("keep_alive")
+        )
+        chunks = []
+        metrics = RequestMetrics(request.api_type, request.api_url, request.model_name)
+        started_at = datetime.now().isoformat(timespec="seconds")
+        start = time.perf_counter()
+        detector = RepetitionDetector() if self.repetition_check else None
+
+        def on_text(text):
+            metrics.on_text(text)
+            chunks.append(text)
+            if detector is not None:
+                keep = detector.feed(text)
+                if keep is not None:
+                    chunks[:] = ["".join(chunks)[:keep]]
+                    raise RepetitionLoop()
+
+        record = {"id": item_id, "api_type": request.api_type, "model": request.model_name,
+                  "started_at": started_at}
+        decoder = None
+        token = CancelToken()
+        with self._lock:
+            self._tokens.add(token)
+        endpoints = parse_endpoints(request.api_url, params.get("extra_endpoints"))
+        def attempt(on_headers):
+            metrics.start()
+            if len(endpoints) > 1:
+                router = get_router(endpoints, params.get("routing") or DEFAULT_POLICY)
+                return stream_with_failover(router, request, headers, data, on_text,
+                                            should_stop=self.stop_event.is_set, on_connect=metrics.mark_connected,
+                                            cancel_token=token, on_endpoint=metrics.set_endpoint,
+                                            on_headers=on_headers)
+            return stream_generate(request, headers, data, on_text, should_stop=self.stop_event.is_set,
+                                   on_connect=metrics.mark_connected, cancel_token=token, on_headers=on_headers)
+
+        try:
+            headers, data = request.build()
+            # 超出RPM/TPM配额时排队等待，429时按Retry-After重试
+            decoder = run_with_quota(quota_key(request.api_type, request.api_key, request.model_name),
+                                     estimate_request_tokens(prompt), attempt, should_stop=self.stop_event.is_set)
+            if self.stop_event.is_set():
+                return None
+            record["status"] = "ok"
+        except RepetitionLoop:
+            record["status"] = "ok"
+            record["repetition"] = True
+        except ApiError as e:
+            record["status"] = "error"
+            record["error"] = str(e)
+        except Exception as e:
+            if self.stop_event.is_set():
+                return None
+            record["status"] = "error"
+            record["error"] = f"发生错误: {str(e)}"
+        finally:
+            with self._lock:
+                self._tokens.discard(token)
+        elapsed = time.perf_counter() - start
+        text = "".join(chunks)
+        metrics.finish("success" if record["status"] == "ok" else "error", decoder, text)
+        get_telemetry().record(metrics)
+        record.update({
+            "text": text,
+            "chars": len(text),
+            "ttft": round(metrics.ttft_ms / 1000, 3) if metrics.ttft_ms is not None else None,
+            "elapsed": round(elapsed, 3),
+            "chars_per_sec": round(len(text) / elapsed, 1) if elapsed > 0 else None,
+            "tokens": metrics.tokens,
+            "tokens_per_sec": round(metrics.tokens_per_sec, 1) if metrics.tokens_per_sec else None,
+        })
+        self._write(record)
+        return record
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._output.write(line)
+            self._output.flush()
+            os.fsync(self._output.fileno())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="无界面批量生成（JSONL输入/输出）")
+    parser.add_argument("input", help="提示词JSONL文件")
+    parser.add_argument("-o", "--output", required=True, help="结果JSONL文件，同时作为断点")
+    parser.add_argument("--parallel", type=int, default=4, help="并发数")
+    parser.add_argument("--settings", default="settings.json", help="默认设置文件")
+    parser.add_argument("--api-type", choices=["Ollama", "SiliconFlow", "自定义"])
+    parser.add_argument("--api-url")
+    parser.add_argument("--api-key")
+    parser.add_argument("--model", dest="model_name")
+    parser.add_argument("--api-format", choices=["OpenAI格式", "Ollama格式"])
+    parser.add_argument("--custom-headers", help="自定义请求头（JSON）")
+    parser.add_argument("--endpoints", dest="extra_endpoints", help="备用端点，逗号分隔，与API地址组成后端池")
+    parser.add_argument("--routing", choices=list(POLICIES), help="多端点路由策略")
+    parser.add_argument("--keep-alive", dest="keep_alive", help="Ollama保持模型加载的时长，例如30m，-1表示一直保持")
+    parser.add_argument("--temperature", type=float, help="采样温度（默认0.7）")
+    parser.add_argument("--max-tokens", dest="max_tokens", type=int, help="每条最大输出token数（默认5000）")
+    parser.add_argument("--rpm", type=int, help="每分钟请求数上限（0为不限，默认取设置或从响应头学习）")
+    parser.add_argument("--tpm", type=int, help="每分钟token数上限（0为不限）")
+    parser.add_argument("--no-repetition-check", action="store_true", help="不检测重复循环")
+    parser.add_argument("--id-field", help="编号字段名，默认id或request_id")
+    parser.add_argument("--prompt-field", help="提示词字段名，默认prompt或body")
+    parser.add_argument("--no-resume", action="store_true", help="忽略已有输出，重新生成全部")
+    parser.add_argument("--telemetry", help="把本次运行的请求统计导出到该文件（.json或.csv）")
+    args = parser.parse_args(argv)
+
+    settings = load_settings(args.settings)
+    defaults = {k: settings[k] for k in API_FIELDS if settings.get(k)}
+    for field in API_FIELDS + SAMPLING_FIELDS:
+        value = getattr(args, field)
+        if value is not None:
+            defaults[field] = value
+    rate_limits = dict(settings.get("rate_limits") or {})
+    if args.rpm is not None or args.tpm is not None:
+        api_type = defaults.get("api_type", "Ollama")
+        limit = dict(rate_limits.get(api_type) or {})
+        if args.rpm is not None:
+            limit["rpm"] = args.rpm
+        if args.tpm is not None:
+            limit["tpm"] = args.tpm
+        rate_limits[api_type] = limit
+    for api_type, limit in rate_limits.items():
+        get_rate_limiter().configure(api_type, limit.get("rpm", 0), limit.get("tpm", 0))
+
+    items = read_prompts(args.input, args.id_field, args.prompt_field)
+    if args.no_resume and os.path.exists(args.output):
+        os.remove(args.output)
+    done = load_checkpoint(args.output)
+    pending = [item for item in items if item[0] not in done]
+    if done:
+        print(f"从断点继续：已完成{len(items) - len(pending)}条，剩余{len(pending)}条", file=sys.stderr)
+
+    runner = BatchRunner(defaults, args.output, parallel=max(1, args.parallel),
+                         repetition_check=not args.no_repetition_check)
+    ok, failed = runner.run(pending)
+    print(f"完成：成功{ok}条，失败{failed}条", file=sys.stderr)
+    if args.telemetry:
+        get_telemetry().export(args.telemetry)
+        print(f"请求统计已导出到 {args.telemetry}", file=sys.stderr)
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
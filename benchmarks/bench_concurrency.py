@@ -0,0 +1,122 @@
+"""并发基准：线程-每请求模型（requests + 连接池）对比异步引擎
+
+在本地启动模拟服务（mock_server.py）的Ollama流式接口，分别以1、10、50路并发运行，
+统计总耗时、首字延迟（TTFT）、增量吞吐和占用的线程数。
+
+用法:
+    python benchmarks/bench_concurrency.py [--tokens 200] [--interval-ms 5] [--levels 1,10,50]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from async_engine import AsyncStreamEngine
+from mock_server import MockConfig, start_mock_server
+from stream_decoder import OllamaStreamDecoder
+
+
+# 与ApiCallThread的读取块大小一致（llm_backend.STREAM_CHUNK_SIZE）
+STREAM_CHUNK_SIZE = 1024
+BODY = json.dumps({"model": "mock", "prompt": "写一段开头", "stream": True}).encode("utf-8")
+HEADERS = {"Content-Type": "application/json"}
+
+
+def run_threads(url, concurrency):
+    """线程-每请求：与ApiCallThread相同的requests流式读取方式"""
+    from http_pool import get_session_pool
+
+    pool = get_session_pool()
+    pool.configure(pool_size=max(concurrency, 10))
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        start = time.perf_counter()
+        ttft = None
+        deltas = 0
+        decoder = OllamaStreamDecoder()
+        with pool.post(url, headers=HEADERS, data=BODY, stream=True) as response:
+            for raw in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                got = decoder.feed(raw)
+                if got and ttft is None:
+                    ttft = time.perf_counter() - start
+                deltas += len(got)
+        with lock:
+            results.append((ttft, deltas))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    peak_threads = threading.active_count()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, results, peak_threads
+
+
+def run_async(url, concurrency, engine):
+    """异步引擎：所有请求在一个事件循环线程中"""
+    results = []
+
+    async def one():
+        start = time.perf_counter()
+        state = {"ttft": None, "deltas": 0}
+        decoder = OllamaStreamDecoder()
+
+        def on_chunk(raw):
+            got = decoder.feed(raw)
+            if got and state["ttft"] is None:
+                state["ttft"] = time.perf_counter() - start
+            state["deltas"] += len(got)
+
+        await engine.stream(url, HEADERS, BODY, on_chunk)
+        results.append((state["ttft"], state["deltas"]))
+
+    start = time.perf_counter()
+    futures = [engine.submit(one()) for _ in range(concurrency)]
+    peak_threads = threading.active_count()
+    for future in futures:
+        future.result()
+    return time.perf_counter() - start, results, peak_threads
+
+
+def report(name, concurrency, elapsed, results, peak_threads):
+    ttfts = sorted(r[0] for r in results if r[0] is not None)
+    deltas = sum(r[1] for r in results)
+    p95 = ttfts[min(len(ttfts) - 1, int(len(ttfts) * 0.95))] if ttfts else 0
+    print(f"  {name:<6} 并发{concurrency:>3}: 总耗时 {elapsed:6.2f}s, "
+          f"TTFT 平均 {statistics.mean(ttfts) * 1000 if ttfts else 0:7.1f}ms / P95 {p95 * 1000:7.1f}ms, "
+          f"吞吐 {deltas / elapsed:9,.0f} 增量/秒, 线程数 {peak_threads}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="线程模型与异步引擎并发基准")
+    parser.add_argument("--tokens", type=int, default=200, help="每个流的增量数")
+    parser.add_argument("--interval-ms", type=float, default=5, help="模拟服务每个增量的间隔")
+    parser.add_argument("--levels", default="1,10,50", help="并发级别，逗号分隔")
+    parser.add_argument("--mode", choices=["both", "threads", "async"], default="both")
+    args = parser.parse_args()
+
+    server_process, base_url = start_mock_server(MockConfig(tokens=args.tokens, rate=1000 / args.interval_ms))
+    url = base_url + "/api/generate"
+    engine = AsyncStreamEngine()
+    try:
+        for level in [int(x) for x in args.levels.split(",")]:
+            print(f"[并发 {level}]")
+            if args.mode in ("both", "threads"):
+                report("线程", level, *run_threads(url, level))
+            if args.mode in ("both", "async"):
+                report("异步", level, *run_async(url, level, engine))
+    finally:
+        engine.shutdown()
+        server_process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""结果区基准：旧的富文本QTextEdit与ManuscriptView的追加延迟和内存占用
+
+每个组合在单独的子进程中运行（内存互不影响）：按界面的刷新方式每次追加一批
+文本并处理事件（排版、绘制），直到总字数达到目标，记录每次追加的耗时和进程的
+常驻内存（RSS），最后测量clear()的耗时。
+
+用法:
+    python benchmarks/bench_manuscript_view.py [--sizes 100000,1000000,5000000] [--legacy-max 1000000]
+
+没有显示器时自动使用Qt的offscreen平台。RSS从/proc读取，仅支持Linux。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子进程中运行的测量脚本
+CHILD = r"""
+import json, os, sys, time
+sys.path.insert(0, %(root)r)
+from PyQt5.QtWidgets import QApplication, QTextEdit
+from PyQt5.QtGui import QTextCursor
+
+SAMPLE = "夜色如墨，山风穿过竹林，少年握紧了手中的长剑。他知道，今夜之后一切都将不同。"
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * PAGE_SIZE / 1024 / 1024
+
+def legacy_append(widget, text):
+    # 改动前main.py中_flush_delta_buffer的做法
+    scrollbar = widget.verticalScrollBar()
+    at_bottom = scrollbar.value() >= scrollbar.maximum() - 4
+    cursor = QTextCursor(widget.document())
+    cursor.movePosition(QTextCursor.End)
+    cursor.insertText(text)
+    if at_bottom:
+        scrollbar.setValue(scrollbar.maximum())
+
+app = QApplication(sys.argv)
+if %(view)r == "legacy":
+    widget = QTextEdit()
+    widget.setReadOnly(True)
+    append = lambda text: legacy_append(widget, text)
+else:
+    from manuscript_view import ManuscriptView
+    widget = ManuscriptView()
+    append = widget.append_text
+widget.resize(800, 600)
+widget.show()
+app.processEvents()
+
+rss_start = rss_mb()
+batch = %(batch)d
+text = (SAMPLE * 4 + "\n") * (batch // (len(SAMPLE) * 4 + 1) + 1)
+latencies = []
+written = 0
+rss_peak = rss_start
+while written < %(size)d:
+    start = time.perf_counter()
+    append(text[:batch])
+    app.processEvents()
+    latencies.append((time.perf_counter() - start) * 1000)
+    written += batch
+    if len(latencies) %% 200 == 0:
+        rss_peak = max(rss_peak, rss_mb())
+rss_peak = max(rss_peak, rss_mb())
+start = time.perf_counter()
+widget.clear()
+app.processEvents()
+clear_ms = (time.perf_counter() - start) * 1000
+latencies.sort()
+tail = latencies[len(latencies) * 9 // 10:]
+print(json.dumps({
+    "p50": latencies[len(latencies) // 2],
+    "p99": latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)],
+    "max": latencies[-1],
+    "tail_mean": sum(tail) / len(tail),
+    "rss_delta": rss_peak - rss_start,
+    "clear_ms": clear_ms,
+}))
+"""
+
+
+def run_once(view, size, batch):
+    env = dict(os.environ)
+    if not env.get("DISPLAY") and sys.platform.startswith("linux"):
+        env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD % {"root": ROOT, "view": view, "size": size, "batch": batch}],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="结果区追加延迟与内存基准")
+    parser.add_argument("--sizes", default="100000,1000000,5000000", help="总字数，逗号分隔")
+    parser.add_argument("--batch", type=int, default=200, help="每次追加的字数（约等于一次刷新的量）")
+    parser.add_argument("--legacy-max", type=int, default=1000000,
+                        help="旧实现只测不超过这个字数的规模（大规模下耗时很长）")
+    args = parser.parse_args()
+
+    print(f"{'实现':<16}{'字数':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'最大(ms)':>10}"
+          f"{'末10%均值':>11}{'RSS增量(MB)':>13}{'clear(ms)':>11}")
+    for size in [int(x) for x in args.sizes.split(",")]:
+        for view, label in (("legacy", "QTextEdit(旧)"), ("manuscript", "ManuscriptView")):
+            if view == "legacy" and size > args.legacy_max:
+                print(f"{label:<16}{size:>10}  跳过（--legacy-max {args.legacy_max}）")
+                continue
+            r = run_once(view, size, args.batch)
+            print(f"{label:<16}{size:>10}{r['p50']:>10.2f}{r['p99']:>10.2f}{r['max']:>10.1f}"
+                  f"{r['tail_mean']:>11.2f}{r['rss_delta']:>13.1f}{r['clear_ms']:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""项目文件基准：整体重写JSON与只追加的ProjectStore的保存、打开耗时
+
+对不同章节数的书分别测量：
+  - 保存：续写一段（默认200字）后保存的耗时（取多次的中位数）
+  - 打开：打开项目并读出一个章节正文的耗时
+对照组是把整本书写成一个JSON文件、每次保存都整体重写的做法。
+
+用法:
+    python benchmarks/bench_project_store.py [--chapters 100,1000,5000] [--chapter-chars 3000]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from project_store import ProjectStore
+
+SAMPLE_TEXT = "夜色如墨，山风穿过竹林，少年握紧了手中的长剑。他知道，今夜之后一切都将不同。"
+
+
+def _text(chars):
+    return (SAMPLE_TEXT * (chars // len(SAMPLE_TEXT) + 1))[:chars]
+
+
+def bench_json(directory, chapters, chapter_chars, delta_chars, saves):
+    path = os.path.join(directory, "book.json")
+    book = {"chapters": [{"title": f"第{i + 1}章", "text": _text(chapter_chars)} for i in range(chapters)]}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(book, f, ensure_ascii=False)
+    delta = _text(delta_chars)
+    times = []
+    for _ in range(saves):
+        book["chapters"][-1]["text"] += delta
+        start = time.perf_counter()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(book, f, ensure_ascii=False)
+        times.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    with open(path, "r", encoding="utf-8") as f:
+        loaded = json.load(f)
+    loaded["chapters"][-1]["text"]
+    open_time = time.perf_counter() - start
+    return statistics.median(times), open_time, os.path.getsize(path)
+
+
+def bench_store(directory, chapters, chapter_chars, delta_chars, saves):
+    path = os.path.join(directory, "book.novel")
+    store = ProjectStore(path)
+    text = _text(chapter_chars)
+    for i in range(chapters):
+        chapter_id = store.add_chapter(f"第{i + 1}章", text)
+    delta = _text(delta_chars)
+    times = []
+    for _ in range(saves):
+        start = time.perf_counter()
+        store.append_text(chapter_id, delta)
+        times.append(time.perf_counter() - start)
+    store.close()
+    start = time.perf_counter()
+    store = ProjectStore(path)
+    store.chapter_text(chapter_id)
+    open_time = time.perf_counter() - start
+    size = store.stats()["log_bytes"]
+    store.close()
+    return statistics.median(times), open_time, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="项目文件保存与打开基准")
+    parser.add_argument("--chapters", default="100,1000,5000", help="章节数，逗号分隔")
+    parser.add_argument("--chapter-chars", type=int, default=3000, help="每章字数")
+    parser.add_argument("--delta-chars", type=int, default=200, help="每次保存新增的字数")
+    parser.add_argument("--saves", type=int, default=20, help="保存次数")
+    args = parser.parse_args()
+
+    print(f"{'格式':<14}{'章节数':>8}{'总字数':>12}{'保存(ms)':>12}{'打开(ms)':>12}{'文件(MB)':>10}")
+    for chapters in [int(x) for x in args.chapters.split(",")]:
+        for label, bench in (("JSON整体重写", bench_json), ("ProjectStore", bench_store)):
+            directory = tempfile.mkdtemp(prefix="bench_project_")
+            try:
+                save, open_time, size = bench(directory, chapters, args.chapter_chars,
+                                              args.delta_chars, args.saves)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+            print(f"{label:<14}{chapters:>8}{chapters * args.chapter_chars:>12}"
+                  f"{save * 1000:>12.3f}{open_time * 1000:>12.2f}{size / 1024 / 1024:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
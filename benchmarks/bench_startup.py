@@ -0,0 +1,117 @@
+"""启动时间基准：模块导入耗时与首次绘制时间
+
+每轮启动一个全新的Python进程（冷启动），测量：
+  - import main 的耗时
+  - 从进程开始执行到主窗口第一次收到绘制事件的时间
+  - 父进程看到的总耗时（包括解释器启动）
+取多轮的中位数，并列出导入耗时最多的模块。
+
+用法:
+    python benchmarks/bench_startup.py [--runs 10]
+
+没有显示器时自动使用Qt的offscreen平台。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子进程中运行的测量脚本
+CHILD = r"""
+import time
+t0 = time.perf_counter()
+import sys, json
+sys.path.insert(0, %(root)r)
+import main
+t_import = time.perf_counter()
+from PyQt5.QtCore import QObject, QEvent, QTimer
+from PyQt5.QtWidgets import QApplication
+
+class PaintProbe(QObject):
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint and not hasattr(self, "t_paint"):
+            self.t_paint = time.perf_counter()
+            QTimer.singleShot(0, QApplication.instance().quit)
+        return False
+
+app = QApplication(sys.argv)
+window = main.NovelWriterWindow()
+probe = PaintProbe()
+window.installEventFilter(probe)
+window.show()
+t_show = time.perf_counter()
+QTimer.singleShot(10000, app.quit)
+app.exec_()
+print(json.dumps({
+    "import": t_import - t0,
+    "window": t_show - t_import,
+    "first_paint": getattr(probe, "t_paint", time.perf_counter()) - t0,
+}))
+"""
+
+
+def run_once():
+    env = dict(os.environ)
+    if not env.get("DISPLAY") and sys.platform.startswith("linux"):
+        env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD % {"root": ROOT}],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    total = time.perf_counter() - start
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_total"] = total
+    return result
+
+
+def slowest_imports(limit=10):
+    """用 -X importtime 找出导入耗时最多的模块（累计耗时）"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT, capture_output=True, text=True
+    ).stderr
+    # 子模块先于父模块输出，模块名前每两个空格表示一层嵌套；
+    # 取main之前、上一个顶层模块之后的那一段，即main的导入树
+    block = []
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|", 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == "main":
+                rows = block
+            block = []
+        elif depth == 1:
+            # 只看main直接导入的模块，避免子模块重复计数
+            block.append((int(cumulative_us), name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动时间基准")
+    parser.add_argument("--runs", type=int, default=10, help="冷启动次数")
+    args = parser.parse_args()
+
+    results = [run_once() for _ in range(args.runs)]
+    print(f"冷启动 {args.runs} 次（中位数）:")
+    for key, label in (("import", "import main"), ("window", "创建并显示窗口"),
+                       ("first_paint", "首次绘制"), ("process_total", "进程总耗时")):
+        values = [r[key] * 1000 for r in results]
+        print(f"  {label:<12} {statistics.median(values):8.1f} ms  "
+              f"(最小 {min(values):.1f} / 最大 {max(values):.1f})")
+
+    print("main直接导入的模块中耗时最多的（累计）:")
+    for cumulative_us, name in slowest_imports():
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""流解码器微基准：对比旧的逐行json.loads解析与StreamDecoder的增量/秒
+
+用法:
+    python benchmarks/bench_stream_decoder.py [--size-mb 4] [--ollama-file F] [--openai-file F]
+
+未指定录制文件时，生成指定大小的模拟流（中文文本，含少量转义字符），
+并按随机大小切块，模拟iter_content读取时帧被截断的情况。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stream_decoder import OllamaStreamDecoder, OpenAIStreamDecoder
+
+SAMPLE_TEXT = "夜色如墨，山风穿过竹林，少年握紧了手中的长剑。他知道，今夜之后一切都将不同。"
+
+
+def _pieces(rng):
+    while True:
+        start = rng.randrange(len(SAMPLE_TEXT))
+        piece = SAMPLE_TEXT[start:start + rng.randint(1, 6)]
+        # 约2%的分片带换行或引号，需要转义
+        roll = rng.random()
+        if roll < 0.01:
+            piece += "\n"
+        elif roll < 0.02:
+            piece = "“" + piece + "\""
+        yield piece
+
+
+def make_ollama_stream(size, seed=1):
+    """生成Ollama NDJSON格式的模拟流"""
+    rng = random.Random(seed)
+    frames = []
+    total = 0
+    for piece in _pieces(rng):
+        frame = json.dumps({
+            "model": "qwen2.5:7b", "created_at": "2024-01-01T00:00:00.000000Z",
+            "response": piece, "done": False
+        }, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        frames.append(frame)
+        total += len(frame)
+        if total >= size:
+            break
+    frames.append(json.dumps({
+        "model": "qwen2.5:7b", "response": "", "done": True, "context": list(range(64))
+    }, separators=(",", ":")).encode("utf-8") + b"\n")
+    return b"".join(frames)
+
+
+def make_openai_stream(size, seed=1):
+    """生成OpenAI SSE格式的模拟流"""
+    rng = random.Random(seed)
+    frames = []
+    total = 0
+    for piece in _pieces(rng):
+        frame = b"data: " + json.dumps({
+            "id": "chatcmpl-1", "object": "chat.completion.chunk", "created": 1700000000,
+            "model": "Qwen/Qwen2.5-7B-Instruct",
+            "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]
+        }, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n\n"
+        frames.append(frame)
+        total += len(frame)
+        if total >= size:
+            break
+    frames.append(b"data: [DONE]\n\n")
+    return b"".join(frames)
+
+
+def split_chunks(data, seed=2, min_size=64, max_size=2048):
+    """按随机大小切块，模拟网络读取"""
+    rng = random.Random(seed)
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(min_size, max_size)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def legacy_iter_lines(chunks):
+    """与requests.Response.iter_lines相同的分行逻辑"""
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        for line in lines:
+            yield line
+    if pending is not None:
+        yield pending
+
+
+def legacy_ollama(chunks):
+    """旧版Ollama解析循环"""
+    deltas = []
+    for line in legacy_iter_lines(chunks):
+        if line:
+            try:
+                chunk = json.loads(line.decode('utf-8'))
+                if 'response' in chunk and chunk['response'] is not None:
+                    deltas.append(chunk['response'])
+            except json.JSONDecodeError:
+                line_str = line.decode('utf-8')
+                if 'response' in line_str:
+                    start_idx = line_str.find('"response":"') + len('"response":"')
+                    end_idx = line_str.find('"', start_idx)
+                    deltas.append(line_str[start_idx:end_idx])
+    return deltas
+
+
+def legacy_openai(chunks):
+    """旧版OpenAI/SiliconFlow解析循环"""
+    deltas = []
+    for line in legacy_iter_lines(chunks):
+        if line:
+            line_str = line.decode('utf-8')
+            if line_str.startswith("data: "):
+                line_str = line_str[6:]
+            if line_str == "[DONE]":
+                break
+            try:
+                chunk = json.loads(line_str)
+                if 'choices' in chunk and len(chunk['choices']) > 0:
+                    choice = chunk['choices'][0]
+                    if 'delta' in choice and 'content' in choice['delta']:
+                        content = choice['delta']['content']
+                        if content is not None:
+                            deltas.append(content)
+            except json.JSONDecodeError:
+                if '"content":"' in line_str:
+                    start_idx = line_str.find('"content":"') + len('"content":"')
+                    end_idx = line_str.find('"', start_idx)
+                    deltas.append(line_str[start_idx:end_idx])
+    return deltas
+
+
+def run_decoder(decoder_cls, chunks):
+    decoder = decoder_cls()
+    deltas = []
+    for chunk in chunks:
+        deltas.extend(decoder.feed(chunk))
+    deltas.extend(decoder.finish())
+    return deltas, decoder
+
+
+def timed(func, *args, repeat=3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench(name, data, legacy_func, decoder_cls, repeat):
+    chunks = split_chunks(data)
+    legacy_time, legacy_deltas = timed(legacy_func, chunks, repeat=repeat)
+    new_time, (deltas, decoder) = timed(run_decoder, decoder_cls, chunks, repeat=repeat)
+    mb = len(data) / 1024 / 1024
+    print(f"[{name}] {mb:.1f} MB, {len(chunks)} 块, {decoder.frames} 帧")
+    print(f"  旧解析:   {len(legacy_deltas) / legacy_time:12,.0f} 增量/秒 ({legacy_time * 1000:.1f} ms)")
+    print(f"  新解码器: {len(deltas) / new_time:12,.0f} 增量/秒 ({new_time * 1000:.1f} ms), "
+          f"快速路径 {decoder.fast_frames / max(1, decoder.frames):.0%}")
+    print(f"  加速比: {legacy_time / new_time:.2f}x, 文本一致: {''.join(deltas) == ''.join(legacy_deltas)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流解码器微基准")
+    parser.add_argument("--size-mb", type=float, default=4.0, help="模拟流大小（MB）")
+    parser.add_argument("--ollama-file", help="录制的Ollama NDJSON原始流")
+    parser.add_argument("--openai-file", help="录制的OpenAI SSE原始流")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快一次")
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    if args.ollama_file:
+        with open(args.ollama_file, "rb") as f:
+            ollama_data = f.read()
+    else:
+        ollama_data = make_ollama_stream(size)
+    if args.openai_file:
+        with open(args.openai_file, "rb") as f:
+            openai_data = f.read()
+    else:
+        openai_data = make_openai_stream(size)
+
+    bench("Ollama NDJSON", ollama_data, legacy_ollama, OllamaStreamDecoder, args.repeat)
+    bench("OpenAI SSE", openai_data, legacy_openai, OpenAIStreamDecoder, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""基准测试套件：解码吞吐、首字延迟、并发扩展、结果区追加开销、检索耗时和文稿整理吞吐
+
+所有网络相关的测量都使用本地模拟服务（mock_server.py），不需要真实的Ollama或云端服务；
+指定--replay时改为回放录制的真实流（mock_server.py --record录制），解码吞吐也使用录制的流。
+
+每次运行的结果追加到benchmarks/results/history.jsonl，并与基准结果
+（benchmarks/results/baseline.json，没有时与上一次运行）逐项比较，
+变差超过容差（默认20%）的指标标记为回归，此时以状态码1退出，便于在CI中使用。
+
+用法:
+    python benchmarks/run_benchmarks.py [--suites decode,ttft,concurrency,ui,retrieval,postprocess] [--quick]
+    python benchmarks/run_benchmarks.py --save-baseline
+    python benchmarks/run_benchmarks.py --replay streams.jsonl --speed 0
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+
+from mock_server import MockConfig, load_recordings, start_mock_server
+
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+HISTORY_FILE = os.path.join(RESULTS_DIR, "history.jsonl")
+BASELINE_FILE = os.path.join(RESULTS_DIR, "baseline.json")
+
+SUITES = ("decode", "ttft", "concurrency", "ui", "retrieval", "postprocess")
+# 模拟服务的首字前等待（秒），首字延迟指标扣除这部分，只反映客户端自身的开销
+MOCK_LATENCY = 0.02
+# 耗时类指标变化小于这个值（毫秒）时不算回归，避免亚毫秒级的抖动被放大成百分比
+MIN_DELTA_MS = 1.0
+# 检索基准的合成正文由这些句子随机拼接
+SAMPLE_SENTENCES = ("夜色如墨，", "山风穿过竹林，", "少年握紧了手中的长剑。", "他知道，", "今夜之后一切都将不同。",
+                    "远处传来钟声，", "石阶上积满落叶，", "她轻声说道：", "“你终于来了。”", "众人面面相觑。")
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def bench_decode(args, recordings):
+    """解码吞吐（增量/秒，越高越好）"""
+    from bench_stream_decoder import make_ollama_stream, make_openai_stream, run_decoder, split_chunks, timed
+    from stream_decoder import OllamaStreamDecoder, OpenAIStreamDecoder
+
+    size = int(args.decode_mb * 1024 * 1024)
+    streams = {"ollama": make_ollama_stream(size), "openai": make_openai_stream(size)}
+    if recordings is not None:
+        # 按录制的格式拼接原始流
+        recorded = {"ollama": [], "openai": []}
+        for records in recordings.values():
+            for record in records:
+                fmt = "openai" if "event-stream" in record["content_type"] else "ollama"
+                recorded[fmt].extend(data for _, data in record["chunks"])
+        streams = {fmt: b"".join(chunks) for fmt, chunks in recorded.items() if chunks}
+
+    metrics = {}
+    decoders = {"ollama": OllamaStreamDecoder, "openai": OpenAIStreamDecoder}
+    for fmt, data in streams.items():
+        chunks = split_chunks(data)
+        elapsed, (deltas, _) = timed(run_decoder, decoders[fmt], chunks, repeat=3)
+        metrics[f"decode.{fmt}.deltas_per_s"] = len(deltas) / elapsed
+        print(f"  {fmt:<7} {len(data) / 1024 / 1024:6.1f} MB  {len(deltas) / elapsed:12,.0f} 增量/秒")
+    return metrics
+
+
+def bench_ttft(args, base_url):
+    """首字延迟：顺序发送请求，记录从发送到收到第一段文本的时间（越低越好）"""
+    from llm_backend import GenerationRequest, stream_generate
+
+    request = GenerationRequest("Ollama", base_url + "/api/generate", "", "写一段开头", "mock")
+    headers, data = request.build()
+    latency = 0 if args.replay else MOCK_LATENCY
+    # 先发一次不计时的请求，建立连接并完成首次导入
+    stream_generate(request, headers, data, lambda text: None)
+    ttfts = []
+    for _ in range(args.ttft_requests):
+        state = {"ttft": None}
+        start = time.perf_counter()
+
+        def on_text(text):
+            if state["ttft"] is None:
+                state["ttft"] = time.perf_counter() - start
+
+        stream_generate(request, headers, data, on_text)
+        if state["ttft"] is not None:
+            ttfts.append((state["ttft"] - latency) * 1000)
+    if not ttfts:
+        print("  没有收到任何文本，跳过")
+        return {}
+    p50, p95 = statistics.median(ttfts), _percentile(ttfts, 0.95)
+    print(f"  {len(ttfts)} 次请求  首字开销 p50 {p50:.2f} ms / p95 {p95:.2f} ms")
+    return {"ttft.p50_ms": p50, "ttft.p95_ms": p95}
+
+
+def bench_concurrency(args, base_url):
+    """并发扩展：各并发级别下线程模型与异步引擎的吞吐和首字延迟"""
+    from async_engine import AsyncStreamEngine
+    from bench_concurrency import run_async, run_threads
+
+    url = base_url + "/api/generate"
+    metrics = {}
+    engine = AsyncStreamEngine()
+    try:
+        for level in args.levels:
+            for name, run in (("threads", lambda: run_threads(url, level)),
+                              ("async", lambda: run_async(url, level, engine))):
+                elapsed, results, _ = run()
+                ttfts = [r[0] * 1000 for r in results if r[0] is not None]
+                throughput = sum(r[1] for r in results) / elapsed
+                p95 = _percentile(ttfts, 0.95) if ttfts else 0
+                metrics[f"concurrency.{name}.{level}.deltas_per_s"] = throughput
+                metrics[f"concurrency.{name}.{level}.ttft_p95_ms"] = p95
+                print(f"  {name:<8}并发{level:>3}  {throughput:10,.0f} 增量/秒  首字 p95 {p95:7.1f} ms")
+    finally:
+        engine.shutdown()
+    return metrics
+
+
+def bench_ui(args):
+    """结果区追加开销：每次追加并处理事件的耗时和内存增量"""
+    from bench_manuscript_view import run_once
+
+    try:
+        r = run_once("manuscript", args.ui_chars, 200)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        print(f"  无法运行（需要PyQt5）: {e}")
+        return {}
+    print(f"  {args.ui_chars} 字  追加 p50 {r['p50']:.2f} ms / p99 {r['p99']:.2f} ms  "
+          f"RSS增量 {r['rss_delta']:.1f} MB")
+    return {"ui.append_p50_ms": r["p50"], "ui.append_p99_ms": r["p99"], "ui.rss_delta_mb": r["rss_delta"]}
+
+
+def bench_retrieval(args):
+    """检索索引：建索引吞吐（字/秒，越高越好）和单次检索耗时（越低越好）"""
+    import random
+    from retrieval_index import QUERY_TAIL_CHARS, RetrievalIndex
+
+    rng = random.Random(1)
+    names = ["林枫", "苏晴", "玄天宗", "白老", "青云剑", "血魔"]
+    paragraphs = []
+    total = 0
+    while total < args.retrieval_chars:
+        words = [rng.choice(SAMPLE_SENTENCES) for _ in range(rng.randint(2, 6))]
+        words.insert(rng.randint(0, len(words)), rng.choice(names))
+        paragraphs.append("".join(words))
+        total += len(paragraphs[-1])
+    text = "\n".join(paragraphs)
+    index = RetrievalIndex()
+    start = time.perf_counter()
+    for i in range(0, len(paragraphs), 100):
+        index.add_text("bench", "\n".join(paragraphs[i:i + 100]))
+    build = time.perf_counter() - start
+    times = []
+    for i in range(50):
+        query = rng.choice(names) + "来到" + rng.choice(names) + "\n" + text[-QUERY_TAIL_CHARS - i * 1000:][:QUERY_TAIL_CHARS]
+        start = time.perf_counter()
+        index.search(query)
+        times.append((time.perf_counter() - start) * 1000)
+    p50, p95 = statistics.median(times), _percentile(times, 0.95)
+    print(f"  {len(text)} 字 {len(index)} 个片段  建索引 {len(text) / build:,.0f} 字/秒  "
+          f"检索 p50 {p50:.2f} ms / p95 {p95:.2f} ms")
+    return {"retrieval.index_chars_per_s": len(text) / build, "retrieval.search_p50_ms": p50,
+            "retrieval.search_p95_ms": p95}
+
+
+def bench_postprocess(args):
+    """文稿整理：单进程与进程池的吞吐（字/秒，越高越好），以及进程池取回第一段结果的耗时"""
+    import random
+    from postprocess import PostProcessor, default_workers
+
+    rng = random.Random(2)
+    chapters = []
+    for _ in range(10):
+        paragraphs = ["".join(rng.choice(SAMPLE_SENTENCES) for _ in range(rng.randint(2, 8)))
+                      for _ in range(args.postprocess_chars // 10 // 60)]
+        chapters.append(" \n".join(paragraphs))
+    total = sum(len(text) for text in chapters)
+    options = {"format": "txt"}
+    inline = PostProcessor(0)
+    start = time.perf_counter()
+    for _ in inline.run(chapters, options):
+        pass
+    inline_s = time.perf_counter() - start
+    pool = PostProcessor(default_workers())
+    try:
+        for _ in pool.run(["预热"], options):  # 启动工作进程不计入
+            pass
+        start = time.perf_counter()
+        first = None
+        for _ in pool.run(chapters, options):
+            if first is None:
+                first = time.perf_counter() - start
+        pool_s = time.perf_counter() - start
+    finally:
+        pool.shutdown()
+    print(f"  {total} 字  单进程 {total / inline_s:,.0f} 字/秒  {pool.max_workers}个进程 {total / pool_s:,.0f} 字/秒  "
+          f"首段 {first * 1000:.1f} ms")
+    return {"postprocess.inline_chars_per_s": total / inline_s, "postprocess.pool_chars_per_s": total / pool_s,
+            "postprocess.first_segment_ms": first * 1000}
+
+
+def higher_is_better(name):
+    return name.endswith("per_s")
+
+
+def compare(current, reference, tolerance):
+    """逐项比较，返回回归的指标列表"""
+    regressions = []
+    print(f"\n{'指标':<40}{'基准':>12}{'本次':>12}{'变化':>9}")
+    for name in sorted(current):
+        value = current[name]
+        base = reference.get(name)
+        if base is None or base == 0:
+            print(f"{name:<40}{'-':>12}{value:>12.2f}")
+            continue
+        change = (value - base) / base
+        worse = -change if higher_is_better(name) else change
+        flag = ""
+        if worse > tolerance and not (name.endswith("_ms") and value - base < MIN_DELTA_MS):
+            flag = "  回归"
+            regressions.append(name)
+        print(f"{name:<40}{base:>12.2f}{value:>12.2f}{change:>+9.1%}{flag}")
+    return regressions
+
+
+def load_reference():
+    """基准结果；没有时取上一次运行"""
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f), "baseline.json"
+    if os.path.exists(HISTORY_FILE):
+        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+        if lines:
+            return json.loads(lines[-1]), "上一次运行"
+    return None, None
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="基准测试套件（结果保存并与基准比较）")
+    parser.add_argument("--suites", default=",".join(SUITES), help="要运行的项目，逗号分隔")
+    parser.add_argument("--quick", action="store_true", help="缩小规模，快速检查")
+    parser.add_argument("--replay", help="回放录制的真实流代替模拟生成")
+    parser.add_argument("--speed", type=float, default=0, help="回放加速倍数，0表示不等待")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="判定为回归的变差比例")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基准")
+    parser.add_argument("--no-save", action="store_true", help="不写入历史记录")
+    args = parser.parse_args()
+
+    suites = [s for s in args.suites.split(",") if s]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"未知的项目: {', '.join(sorted(unknown))}")
+    args.decode_mb = 1 if args.quick else 4
+    args.ttft_requests = 10 if args.quick else 50
+    args.levels = (1, 10) if args.quick else (1, 10, 50)
+    args.ui_chars = 200000 if args.quick else 1000000
+    args.retrieval_chars = 200000 if args.quick else 1000000
+    args.postprocess_chars = 500000 if args.quick else 2000000
+
+    recordings = load_recordings(args.replay) if args.replay else None
+    if args.replay:
+        config = MockConfig(replay=args.replay, speed=args.speed)
+    else:
+        config = MockConfig(tokens=200, rate=200, latency=MOCK_LATENCY, seed=1)
+    server_process, base_url = start_mock_server(config)
+    metrics = {}
+    try:
+        for suite in suites:
+            print(f"[{suite}]")
+            if suite == "decode":
+                metrics.update(bench_decode(args, recordings))
+            elif suite == "ttft":
+                metrics.update(bench_ttft(args, base_url))
+            elif suite == "concurrency":
+                metrics.update(bench_concurrency(args, base_url))
+            elif suite == "ui":
+                metrics.update(bench_ui(args))
+            elif suite == "retrieval":
+                metrics.update(bench_retrieval(args))
+            else:
+                metrics.update(bench_postprocess(args))
+    finally:
+        server_process.terminate()
+
+    result = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "replay": os.path.basename(args.replay) if args.replay else None,
+        "metrics": metrics,
+    }
+    reference, source = load_reference()
+    regressions = []
+    if reference is not None:
+        comparable = reference.get("quick") == args.quick and reference.get("replay") == result["replay"]
+        if comparable:
+            print(f"\n与{source}（{reference.get('time')}，{reference.get('commit')}）比较:")
+        else:
+            print(f"\n{source}的规模或数据来源与本次不同，仅供参考")
+        regressions = compare(metrics, reference["metrics"], args.tolerance)
+        if not comparable:
+            regressions = []
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    if not args.no_save:
+        with open(HISTORY_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"已保存为基准: {BASELINE_FILE}")
+    if regressions:
+        print(f"\n{len(regressions)} 项指标回归超过 {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
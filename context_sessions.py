@@ -0,0 +1,92 @@
+import threading
+import time
+
+# 上下文超过这么多token时不再复用（超出模型上下文窗口后服务端会截断开头）
+DEFAULT_MAX_CONTEXT_TOKENS = 4096
+# 默认让Ollama在最后一次请求后保持模型加载的时长
+DEFAULT_KEEP_ALIVE = "30m"
+
+
+def supports_context(api_type, api_format=None):
+    """只有Ollama原生接口（/api/generate）返回并接受context"""
+    return api_type == "Ollama" or (api_type == "自定义" and api_format == "Ollama格式")
+
+
+class ContextSession:
+    """一个文档（章节）的续写会话：Ollama最近一次返回的context"""
+    def __init__(self, model_name, context):
+        self.model_name = model_name
+        self.context = context
+        self.turns = 1
+        self.updated_at = time.time()
+
+
+class ContextSessionStore:
+    """按文档保存Ollama返回的context，下次续写时原样发回
+
+    context是模型相关的token序列，发回后服务端只需处理新增的提示，
+    模型仍在显存中时可以直接复用KV缓存。以下情况视为失效，返回None，
+    调用方改用完整提示（故事记忆或原始提示）重新开始会话：
+    换了模型、context超过max_tokens、上次生成被中断或请求出错。
+    """
+    def __init__(self, max_tokens=DEFAULT_MAX_CONTEXT_TOKENS):
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._sessions = {}  # 文档键 -> ContextSession
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, model_name):
+        """返回可复用的context，没有或已失效时返回None"""
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and (session.model_name != model_name
+                                        or len(session.context) > self.max_tokens):
+                del self._sessions[key]
+                session = None
+            if session is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return session.context
+
+    def peek(self, key, model_name):
+        """与get的判断相同，但不删除失效的会话，也不计入命中统计（用于估算提示长度）"""
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None or session.model_name != model_name or len(session.context) > self.max_tokens:
+                return None
+            return session.context
+
+    def update(self, key, model_name, context):
+        """保存生成完成后返回的context"""
+        if not context:
+            self.invalidate(key)
+            return
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None and session.model_name == model_name:
+                session.context = context
+                session.turns += 1
+                session.updated_at = time.time()
+            else:
+                self._sessions[key] = ContextSession(model_name, context)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions = {}
+
+    def stats(self, key=None):
+        with self._lock:
+            session = self._sessions.get(key)
+            return {
+                "sessions": len(self._sessions),
+                "tokens": len(session.context) if session is not None else 0,
+                "turns": session.turns if session is not None else 0,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,198 @@
+import itertools
+import json
+import os
+import threading
+import time
+
+JOURNAL_DIR = "journal"
+JOURNAL_SUFFIX = ".jrnl"
+# 缓冲的增量写出到文件的间隔（秒）
+FLUSH_INTERVAL = 0.5
+# 已写出的内容fsync到磁盘的间隔（秒），崩溃时最多丢失这么久的输出
+FSYNC_INTERVAL = 2.0
+# 单个生成缓冲超过这么多字节时立即唤醒写线程，缓冲占用的内存不随输出长度增长
+MAX_BUFFER_BYTES = 64 * 1024
+
+
+class JournalEntry:
+    """磁盘上一份未完成的生成：元数据和已写入的正文"""
+    def __init__(self, path, meta, text):
+        self.path = path
+        self.meta = meta
+        self.text = text
+        self.modified = os.path.getmtime(path)
+
+
+class _OpenEntry:
+    def __init__(self, path, fd):
+        self.path = path
+        self.fd = fd
+        self.buffer = bytearray()  # 尚未写出的增量
+        self.dirty = False  # 已写出但尚未fsync
+        self.closing = None  # None / "keep" / "delete"
+
+
+class GenerationJournal:
+    """进行中生成的预写日志，崩溃或中途退出后可以找回已生成的内容
+
+    每个生成一个文件：第一行是元数据（JSON），之后是UTF-8正文，只追加。
+    增量先放入内存缓冲，由后台写线程每FLUSH_INTERVAL秒写出、每FSYNC_INTERVAL秒fsync，
+    界面线程只做内存操作，不会被磁盘阻塞。生成正常结束后（结果已保存到项目）删除文件；
+    程序退出时仍在进行的生成保留文件，下次启动时由recover()找回。
+    """
+    def __init__(self, directory=JOURNAL_DIR, flush_interval=FLUSH_INTERVAL, fsync_interval=FSYNC_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()  # 保护_entries和各缓冲；文件只由写线程操作
+        self._wakeup = threading.Event()
+        self._entries = {}
+        self._kept = {}  # 已结束但保留的日志：编号 -> 路径（如尚未选定的候选）
+        self._ids = itertools.count(1)
+        self._thread = None
+        self._closed = False
+        self.bytes_written = 0
+        self.fsyncs = 0
+
+    def begin(self, meta):
+        """开始记录一个生成，返回日志编号"""
+        os.makedirs(self.directory, exist_ok=True)
+        entry_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._ids)}"
+        path = os.path.join(self.directory, entry_id + JOURNAL_SUFFIX)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o600)
+        _write_all(fd, json.dumps(meta, ensure_ascii=False).encode("utf-8") + b"\n")
+        with self._lock:
+            self._entries[entry_id] = _OpenEntry(path, fd)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer_loop, name="GenerationJournal", daemon=True)
+                self._thread.start()
+        return entry_id
+
+    def append(self, entry_id, text):
+        """追加一段增量（只写入内存缓冲）"""
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is None or entry.closing is not None:
+                return
+            entry.buffer += text.encode("utf-8")
+            if len(entry.buffer) >= MAX_BUFFER_BYTES:
+                self._wakeup.set()
+
+    def finish(self, entry_id, keep=False):
+        """生成结束：默认删除日志（结果已另行保存）；keep为True时写完并保留，之后可再次调用删除"""
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                path = self._kept.pop(entry_id, None)
+                if path is not None and not keep:
+                    self._remove(path)
+                return
+            entry.closing = "keep" if keep else "delete"
+            if keep:
+                self._kept[entry_id] = entry.path
+            else:
+                self._kept.pop(entry_id, None)
+        self._wakeup.set()
+
+    def close(self):
+        """程序退出：写出并fsync所有缓冲，仍在进行的生成保留日志"""
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        if thread is not None:
+            self._wakeup.set()
+            thread.join()
+
+    def recover(self):
+        """返回上次未正常结束的生成（按开始时间排序），不包括本次正在记录的"""
+        if not os.path.isdir(self.directory):
+            return []
+        with self._lock:
+            open_paths = {entry.path for entry in self._entries.values()} | set(self._kept.values())
+        entries = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(JOURNAL_SUFFIX) or path in open_paths:
+                continue
+            with open(path, "rb") as f:
+                data = f.read()
+            header, newline, body = data.partition(b"\n")
+            try:
+                meta = json.loads(header.decode("utf-8")) if newline else None
+            except ValueError:
+                meta = None
+            if meta is None:
+                # 写元数据时就中断了，没有可恢复的内容
+                os.remove(path)
+                continue
+            # 崩溃时最后一个字符可能只写了一半
+            entries.append(JournalEntry(path, meta, body.decode("utf-8", errors="ignore")))
+        return entries
+
+    def discard(self, entry):
+        """恢复或放弃后删除日志"""
+        self._remove(entry.path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _writer_loop(self):
+        last_fsync = time.monotonic()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            with self._lock:
+                closed = self._closed
+            now = time.monotonic()
+            fsync = closed or now - last_fsync >= self.fsync_interval
+            self._flush(fsync, closed)
+            if fsync:
+                last_fsync = now
+            if closed:
+                return
+
+    def _flush(self, fsync, closing_all):
+        """在写线程中：取出各缓冲写到文件，按需fsync，关闭已结束的日志
+
+        是否关闭在持锁取缓冲时一并确定，之后只按取出的值处理：
+        取出后才调用的finish()留到下一轮，同一个fd不会被关闭两次。
+        """
+        with self._lock:
+            pending = []
+            for entry_id, entry in list(self._entries.items()):
+                closing = entry.closing or ("keep" if closing_all else None)
+                pending.append((entry, bytes(entry.buffer), closing))
+                entry.buffer = bytearray()
+                if closing is not None:
+                    del self._entries[entry_id]
+        for entry, data, closing in pending:
+            # 每个日志单独处理，一个出错不影响其余日志写出和关闭
+            if closing != "delete":
+                try:
+                    if data:
+                        _write_all(entry.fd, data)
+                        self.bytes_written += len(data)
+                        entry.dirty = True
+                    if entry.dirty and (fsync or closing is not None):
+                        os.fsync(entry.fd)
+                        self.fsyncs += 1
+                        entry.dirty = False
+                except OSError as e:
+                    print(f"写入生成日志失败: {e}")
+            if closing is not None:
+                try:
+                    os.close(entry.fd)
+                    if closing == "delete":
+                        self._remove(entry.path)
+                except OSError as e:
+                    print(f"关闭生成日志失败: {e}")
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
@@ -0,0 +1,242 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+# 默认连接池参数
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10  # 建立连接超时（秒）
+DEFAULT_FIRST_BYTE_TIMEOUT = 120  # 发出请求到收到第一块响应数据的超时（秒），包括模型加载
+DEFAULT_READ_TIMEOUT = 60  # 空闲超时（秒），流式响应中两块数据之间的最长等待
+
+# 当前线程正在发送的请求对应的取消令牌，由_TrackedConnection登记socket
+_active = threading.local()
+
+
+class CancelToken:
+    """可从任意线程立即取消的请求令牌
+
+    连接建立后（复用的连接在发送前）登记底层socket，cancel()直接shutdown该socket，
+    阻塞在发送请求、等待响应头或读取响应体中的线程会立刻返回，不必等到超时。
+    建立连接期间（DNS解析、TCP连接和TLS握手）还没有可登记的socket，取消后最多等到连接超时，
+    连接建立时发现已取消会立即关闭。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sock = None
+        self.cancelled = False
+        self.cancelled_at = None  # time.perf_counter()
+
+    def attach(self, sock):
+        """登记请求使用的socket；已被取消时立即关闭"""
+        with self._lock:
+            self._sock = sock
+            cancelled = self.cancelled
+        if cancelled:
+            self._shutdown(sock)
+
+    def detach(self):
+        with self._lock:
+            self._sock = None
+
+    def set_timeout(self, timeout):
+        """调整之后每次读取的超时（首块数据之后改为空闲超时）"""
+        with self._lock:
+            sock = self._sock
+        if sock is not None:
+            try:
+                sock.settimeout(timeout)
+            except OSError:
+                pass
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            self.cancelled_at = time.perf_counter()
+            sock = self._sock
+        if sock is not None:
+            self._shutdown(sock)
+
+    @staticmethod
+    def _shutdown(sock):
+        import socket  # 取消时才需要；连接建立后socket模块已由urllib3加载
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # 连接已关闭
+
+    def __enter__(self):
+        """在当前线程中激活，期间发出的请求都登记到该令牌"""
+        _active.token = self
+        return self
+
+    def __exit__(self, *exc):
+        _active.token = None
+        self.detach()
+
+
+def _tracked_adapter_class():
+    """构造登记socket的HTTPAdapter（延迟导入requests和urllib3）"""
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def register(sock):
+        token = getattr(_active, "token", None)
+        if token is not None and sock is not None:
+            token.attach(sock)
+
+    class _TrackedConnection(HTTPConnection):
+        def connect(self):
+            # 新连接建立（HTTPS为握手完成）后立即登记，发送请求期间也可以取消
+            super().connect()
+            register(self.sock)
+
+        def request(self, *args, **kwargs):
+            register(self.sock)  # 复用的连接不经过connect；新连接此时还没有socket
+            super().request(*args, **kwargs)
+
+    class _TrackedHTTPSConnection(HTTPSConnection):
+        def connect(self):
+            super().connect()
+            register(self.sock)
+
+        def request(self, *args, **kwargs):
+            register(self.sock)
+            super().request(*args, **kwargs)
+
+    class _TrackedPool(HTTPConnectionPool):
+        ConnectionCls = _TrackedConnection
+
+    class _TrackedHTTPSPool(HTTPSConnectionPool):
+        ConnectionCls = _TrackedHTTPSConnection
+
+    class TrackedAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {"http": _TrackedPool, "https": _TrackedHTTPSPool}
+
+    return TrackedAdapter
+
+
+class SessionPool:
+    """进程级HTTP连接池管理器
+
+    按端点（协议+主机+端口）共享keep-alive的requests.Session，
+    连续多次生成可以复用已建立的TCP/TLS连接。
+    """
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 first_byte_timeout=DEFAULT_FIRST_BYTE_TIMEOUT):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self._sessions = {}  # 端点 -> Session
+        self._adapter_class = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint_key(url):
+        """提取连接池键：协议://主机:端口"""
+        parts = urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme == "https" else 80)
+        return f"{scheme}://{parts.hostname}:{port}"
+
+    def configure(self, pool_size=None, connect_timeout=None, read_timeout=None, first_byte_timeout=None):
+        """更新连接池参数，连接池大小变化时会重建会话"""
+        with self._lock:
+            if connect_timeout is not None:
+                self.connect_timeout = connect_timeout
+            if read_timeout is not None:
+                self.read_timeout = read_timeout
+            if first_byte_timeout is not None:
+                self.first_byte_timeout = first_byte_timeout
+            if pool_size is not None and pool_size != self.pool_size:
+                self.pool_size = pool_size
+                self._close_sessions()
+
+    def get_session(self, url):
+        """获取端点对应的共享会话，不存在时创建"""
+        key = self.endpoint_key(url)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                # 延迟导入requests，启动时不加载
+                import requests
+                if self._adapter_class is None:
+                    self._adapter_class = _tracked_adapter_class()
+                session = requests.Session()
+                adapter = self._adapter_class(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[key] = session
+            return session
+
+    def post(self, url, **kwargs):
+        """通过共享会话发送POST请求，未指定timeout时使用连接池默认超时"""
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        return self.get_session(url).post(url, **kwargs)
+
+    def get(self, url, **kwargs):
+        """通过共享会话发送GET请求"""
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        return self.get_session(url).get(url, **kwargs)
+
+    def stats(self):
+        """返回各端点的连接池统计
+
+        requests为发出的请求数，connections为新建的连接数，
+        reused为复用已有连接的请求数。
+        """
+        result = {}
+        with self._lock:
+            sessions = list(self._sessions.items())
+        for key, session in sessions:
+            adapter = session.get_adapter(key)
+            requests_count = 0
+            connections = 0
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue  # 其他线程的请求刚把它移出
+                requests_count += pool.num_requests
+                connections += pool.num_connections
+            result[key] = {
+                "requests": requests_count,
+                "connections": connections,
+                "reused": max(0, requests_count - connections),
+            }
+        return result
+
+    def endpoint_stats(self, url):
+        """返回单个端点的连接池统计"""
+        return self.stats().get(self.endpoint_key(url),
+                                {"requests": 0, "connections": 0, "reused": 0})
+
+    def close_all(self):
+        """关闭所有会话及其连接"""
+        with self._lock:
+            self._close_sessions()
+
+    def _close_sessions(self):
+        for session in self._sessions.values():
+            session.close()
+        self._sessions = {}
+
+
+_session_pool = None
+_session_pool_lock = threading.Lock()
+
+
+def get_session_pool():
+    """获取进程级共享的连接池管理器"""
+    global _session_pool
+    with _session_pool_lock:
+        if _session_pool is None:
+            _session_pool = SessionPool()
+        return _session_pool
@@ -0,0 +1,291 @@
+import itertools
+import time
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from api_client import ApiCallThread, AsyncApiCall
+from backend_router import DEFAULT_POLICY
+from http_pool import SessionPool
+from llm_backend import DEFAULT_TEMPERATURE, variant_sampling
+
+# 任务状态
+JOB_QUEUED = "排队中"
+JOB_RUNNING = "生成中"
+JOB_CANCELLING = "取消中"
+JOB_DONE = "已完成"
+JOB_CANCELLED = "已取消"
+JOB_FAILED = "失败"
+
+FINAL_STATES = (JOB_DONE, JOB_CANCELLED, JOB_FAILED)
+
+# 各API类型的默认并发上限：本地Ollama通常只有一块GPU，云端服务可以并发更多
+DEFAULT_CONCURRENCY = {
+    "Ollama": 2,
+    "SiliconFlow": 8,
+    "自定义": 4,
+}
+
+
+class Job:
+    """一个生成任务"""
+    def __init__(self, job_id, prompt, params, priority=0, cache=None, group=None):
+        self.job_id = job_id
+        self.prompt = prompt
+        # api_type、api_url、api_key、model_name、api_format、custom_headers，
+        # 可选endpoints（含api_url在内的所有端点）、routing（路由策略）、sampling（采样参数）、
+        # context（Ollama上次返回的上下文）、keep_alive和repetition（重复循环检测，见ApiCallThread）
+        self.params = params
+        self.priority = priority
+        self.cache = cache
+        self.group = group  # 同一提示的多个候选共用一个组号（第一个候选的任务号）
+        self.picked = False  # 在候选组中被选中
+        self.state = JOB_QUEUED
+        self.progress = 0
+        self.chunks = []  # 按信号顺序收到的增量文本
+        self.result = None
+        self.status = None  # finished信号带回的状态（success/cached/repetition/cancelled）
+        self.error = None
+        self.thread = None
+        self.waiting_until = None  # 等待RPM/TPM配额时预计可以发送的时刻
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def api_type(self):
+        return self.params["api_type"]
+
+    @property
+    def backend(self):
+        """并发限制按后端计算：API类型 + 端点"""
+        return (self.api_type, SessionPool.endpoint_key(self.params["api_url"]))
+
+    @property
+    def text(self):
+        """当前已收到的文本"""
+        if self.result is not None:
+            return self.result
+        return "".join(self.chunks)
+
+    @property
+    def metrics(self):
+        """请求的计时与用量（RequestMetrics），尚未开始时为None"""
+        return self.thread.metrics if self.thread is not None else None
+
+    @property
+    def final_frame(self):
+        """正常结束时的结束帧（Ollama返回的context、用量等），没有时为None"""
+        return self.thread.final_frame if self.thread is not None else None
+
+    @property
+    def display_state(self):
+        """界面显示的状态：等待配额时显示预计剩余秒数"""
+        if self.state == JOB_RUNNING and self.waiting_until is not None:
+            remaining = self.waiting_until - time.time()
+            if remaining > 0:
+                return f"等待配额 {remaining:.0f}秒"
+        return self.state
+
+    @property
+    def is_active(self):
+        return self.state not in FINAL_STATES
+
+
+class JobQueue(QObject):
+    """多提示词生成任务队列
+
+    按优先级（高者先）和提交顺序调度，每个后端有独立的并发上限，
+    每个任务可以单独取消。
+    """
+    job_changed = pyqtSignal(int)  # 任务状态或进度变化
+    job_started = pyqtSignal(int)
+    job_delta = pyqtSignal(int, str)
+    job_rewind = pyqtSignal(int, str)  # 撤回已发出的末尾文本
+    job_finished = pyqtSignal(int)  # 任务进入最终状态（完成、取消或失败）
+
+    def __init__(self, limits=None, use_async=False, parent=None):
+        super().__init__(parent)
+        self.use_async = use_async  # 使用AsyncApiCall在单个事件循环线程中运行所有任务
+        self.limits = dict(DEFAULT_CONCURRENCY)
+        if limits:
+            self.limits.update(limits)
+        self._jobs = {}  # job_id -> Job，保持提交顺序
+        self._ids = itertools.count(1)
+
+    def set_limit(self, api_type, limit):
+        """设置某类后端的并发上限"""
+        self.limits[api_type] = max(1, int(limit))
+        self._dispatch()
+
+    def submit(self, prompt, params, priority=0, cache=None, group=None):
+        """提交任务，返回任务编号"""
+        job = Job(next(self._ids), prompt, params, priority, cache, group)
+        self._jobs[job.job_id] = job
+        self.job_changed.emit(job.job_id)
+        self._dispatch()
+        return job.job_id
+
+    def submit_variants(self, prompt, params, count, priority=0, cache=None):
+        """为同一提示提交count个候选（随机种子和温度各不相同），返回任务编号列表
+
+        温度以params中采样参数的温度为中心分布，其余采样参数（如max_tokens）各候选相同。
+        同组候选同时开始，合起来只占一个并发名额。
+        """
+        group = None
+        job_ids = []
+        base = params.get("sampling") or {}
+        for sampling in variant_sampling(count, temperature=base.get("temperature", DEFAULT_TEMPERATURE)):
+            job = Job(next(self._ids), prompt, dict(params, sampling=dict(base, **sampling)), priority, cache)
+            group = job.group = group or job.job_id
+            self._jobs[job.job_id] = job
+            job_ids.append(job.job_id)
+            self.job_changed.emit(job.job_id)
+        self._dispatch()
+        return job_ids
+
+    def pick(self, job_id):
+        """选中候选组中的一个，立即取消同组其余还在生成的候选"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        job.picked = True
+        for other in self.group_jobs(job.group):
+            if other is not job:
+                self.cancel(other.job_id)
+        for other in self.group_jobs(job.group):
+            self.job_changed.emit(other.job_id)
+
+    def group_jobs(self, group):
+        if group is None:
+            return []
+        return [job for job in self._jobs.values() if job.group == group]
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        return list(self._jobs.values())
+
+    def active_count(self):
+        return sum(1 for job in self._jobs.values() if job.is_active)
+
+    def cancel(self, job_id):
+        """取消任务：排队中的直接移出，运行中的通知线程停止"""
+        job = self._jobs.get(job_id)
+        if job is None or not job.is_active:
+            return
+        if job.state == JOB_QUEUED:
+            self._finish(job, JOB_CANCELLED)
+            return
+        job.state = JOB_CANCELLING
+        job.thread.cancel()
+        self.job_changed.emit(job.job_id)
+
+    def stop_early(self, job_id):
+        """提前结束运行中的任务：已生成的内容按正常完成处理（用于写到目标长度时停止）"""
+        job = self._jobs.get(job_id)
+        if job is not None and job.state == JOB_RUNNING:
+            job.thread.cancel()
+
+    def cancel_all(self):
+        for job in list(self._jobs.values()):
+            self.cancel(job.job_id)
+
+    def clear_finished(self, keep=()):
+        """移除已结束且线程已退出的任务；keep中的任务（界面仍在使用）保留"""
+        for job_id, job in list(self._jobs.items()):
+            if job_id in keep:
+                continue
+            if not job.is_active and (job.thread is None or not job.thread.isRunning()):
+                del self._jobs[job_id]
+
+    def _running_slots(self, backend):
+        """占用并发名额的任务：候选组按组计算"""
+        return {job.group or job.job_id for job in self._jobs.values()
+                if job.backend == backend and job.state in (JOB_RUNNING, JOB_CANCELLING)}
+
+    def _dispatch(self):
+        """按优先级启动可以运行的排队任务"""
+        queued = [job for job in self._jobs.values() if job.state == JOB_QUEUED]
+        queued.sort(key=lambda job: (-job.priority, job.job_id))
+        for job in queued:
+            # 并发上限按端点计算，后端池有几个端点就能同时运行几倍的任务
+            limit = self.limits.get(job.api_type, 1) * max(1, len(job.params.get("endpoints") or ()))
+            slots = self._running_slots(job.backend)
+            if job.group in slots or len(slots) < limit:
+                self._start(job)
+
+    def _start(self, job):
+        p = job.params
+        call_class = AsyncApiCall if self.use_async else ApiCallThread
+        thread = call_class(
+            p["api_type"], p["api_url"], p["api_key"], job.prompt,
+            p["model_name"], p.get("api_format"), p.get("custom_headers"),
+            cache=job.cache, endpoints=p.get("endpoints"), routing=p.get("routing", DEFAULT_POLICY),
+            sampling=p.get("sampling"), context=p.get("context"), keep_alive=p.get("keep_alive"),
+            repetition=p.get("repetition")
+        )
+        job_id = job.job_id
+        thread.progress.connect(lambda value: self._on_progress(job_id, value))
+        thread.delta.connect(lambda text: self._on_delta(job_id, text))
+        thread.rewind.connect(lambda text: self._on_rewind(job_id, text))
+        thread.waiting.connect(lambda seconds: self._on_waiting(job_id, seconds))
+        thread.finished.connect(lambda result, status: self._on_finished(job_id, result, status))
+        thread.error.connect(lambda msg: self._on_error(job_id, msg))
+        job.thread = thread
+        job.state = JOB_RUNNING
+        job.started_at = time.time()
+        thread.start()
+        self.job_started.emit(job_id)
+        self.job_changed.emit(job_id)
+
+    def _on_progress(self, job_id, value):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.progress = value
+            self.job_changed.emit(job_id)
+
+    def _on_waiting(self, job_id, seconds):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.waiting_until = time.time() + seconds
+            self.job_changed.emit(job_id)
+
+    def _on_delta(self, job_id, text):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.waiting_until = None
+            job.chunks.append(text)
+            self.job_delta.emit(job_id, text)
+
+    def _on_rewind(self, job_id, text):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            current = "".join(job.chunks)
+            job.chunks = [current[:len(current) - len(text)]]
+            self.job_rewind.emit(job_id, text)
+
+    def _on_finished(self, job_id, result, status):
+        job = self._jobs.get(job_id)
+        if job is None or not job.is_active:
+            return
+        job.result = result
+        job.status = status
+        self._finish(job, JOB_CANCELLED if job.state == JOB_CANCELLING else JOB_DONE)
+
+    def _on_error(self, job_id, msg):
+        job = self._jobs.get(job_id)
+        if job is None or not job.is_active:
+            return
+        job.error = msg
+        self._finish(job, JOB_FAILED)
+
+    def _finish(self, job, state):
+        job.state = state
+        job.finished_at = time.time()
+        if job.result is None:
+            job.result = "".join(job.chunks)
+        job.chunks = []
+        self.job_changed.emit(job.job_id)
+        self.job_finished.emit(job.job_id)
+        self._dispatch()
@@ -0,0 +1,103 @@
+import math
+
+from repetition_detector import continuation_prompt
+
+# 续写请求只附带已写正文的末尾这么多字，提示长度不随章节长度增长
+CONTEXT_TAIL_CHARS = 1500
+# 每段的最大token数在剩余字数的估计上多留出的比例，留给收尾到自然断点
+CHUNK_MARGIN = 0.15
+# 每段至少请求这么多token，避免最后一段太短写不完一句
+MIN_CHUNK_TOKENS = 200
+# 达到目标后最多再写这么多字寻找段落结尾，仍没有时在句末结束
+MAX_OVERRUN_CHARS = 300
+# 一次分段生成最多的请求数，模型每段都只写很短时不会无限续写
+MAX_CHUNKS = 20
+# 复用Ollama上下文续写时只发送这句要求，已写内容都在上下文中
+CONTINUE_INSTRUCTION = "紧接上文继续写下去"
+
+SENTENCE_ENDS = "。！？!?…"
+CLOSING_QUOTES = "」』”’）)"
+
+
+def natural_break(text, start, overrun=MAX_OVERRUN_CHARS):
+    """text中start之后的第一个自然断点，返回断点处的位置，没有时返回None
+
+    优先在段落结尾断开；start之后已超过overrun字仍没有换行时，在第一个句末（连同后引号）断开。
+    """
+    start = max(0, start)
+    newline = text.find("\n", start)
+    if newline != -1:
+        return newline
+    if len(text) - start < overrun:
+        return None
+    ends = [pos for pos in (text.find(ch, start) for ch in SENTENCE_ENDS) if pos != -1]
+    if not ends:
+        return None
+    end = min(ends) + 1
+    while end < len(text) and text[end] in SENTENCE_ENDS + CLOSING_QUOTES:
+        end += 1
+    return end
+
+
+class LengthRun:
+    """按目标字数分段生成一章：每段请求的长度按剩余字数计算，写到目标后在自然断点处停止
+
+    prompt为第一段的完整提示；之后每段的提示由它和已写正文的末尾组成
+    （或复用Ollama上下文，只发送CONTINUE_INSTRUCTION）。job_ids按顺序记录各段的任务。
+    """
+    def __init__(self, prompt, target_chars, max_tokens):
+        self.prompt = prompt
+        self.target_chars = target_chars
+        self.max_tokens = max_tokens
+        self.chunks = []
+        self.job_ids = []
+        self.last_done = None  # 最近一段正常写完的任务，之后的段失败时以它保存已写的各段
+        self.tokens_per_char = 1.0  # 中文约一个字一个token，每段结束后按实际用量修正
+        self.stopping = False  # 当前段已写到目标，正在断点处停止
+        self.submitting = False  # 正在提交下一段，任务号尚未登记
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    @property
+    def written(self):
+        return sum(len(chunk) for chunk in self.chunks)
+
+    @property
+    def remaining(self):
+        return max(0, self.target_chars - self.written)
+
+    def progress(self, current_chars=0):
+        """整章的进度百分比，current_chars为当前段已写的字数"""
+        return min(100, (self.written + current_chars) * 100 // max(1, self.target_chars))
+
+    def next_max_tokens(self):
+        """下一段请求的最大token数：剩余字数加上余量，不超过单次请求的上限"""
+        tokens = math.ceil(self.remaining * self.tokens_per_char * (1 + CHUNK_MARGIN))
+        return max(MIN_CHUNK_TOKENS, min(self.max_tokens, tokens))
+
+    def break_point(self, chunk_text):
+        """当前段写到chunk_text时应在哪里结束：达到目标后的第一个自然断点，还不能结束时返回None"""
+        start = self.target_chars - self.written
+        if len(chunk_text) < start:
+            return None
+        return natural_break(chunk_text, start)
+
+    def add_chunk(self, chunk_text, tokens=None):
+        """一段结束，返回保留的部分（写过目标时截到自然断点）；tokens为该段实际输出的token数"""
+        if tokens and chunk_text:
+            self.tokens_per_char = tokens / len(chunk_text)
+        cut = self.break_point(chunk_text)
+        if cut is not None:
+            chunk_text = chunk_text[:cut]
+        self.chunks.append(chunk_text)
+        return chunk_text
+
+    def should_continue(self):
+        """还没写到目标、上一段有输出且没有超过段数上限时继续"""
+        return self.remaining > 0 and bool(self.chunks[-1].strip()) and len(self.chunks) < MAX_CHUNKS
+
+    def next_prompt(self):
+        """不复用上下文时下一段的提示：原提示加已写正文的末尾"""
+        return continuation_prompt(self.prompt, self.text[-CONTEXT_TAIL_CHARS:])
@@ -0,0 +1,297 @@
+import json
+import random
+import time
+
+from http_pool import CancelToken, get_session_pool
+from stream_decoder import create_decoder
+
+# 每次从连接读取的最大字节数（分块传输时按服务端分块返回，不会等满）
+STREAM_CHUNK_SIZE = 1024
+# 请求默认的最大输出token数和温度，可由每次请求的采样参数覆盖
+DEFAULT_MAX_TOKENS = 5000
+DEFAULT_TEMPERATURE = 0.7
+# Ollama原生接口options中与OpenAI格式名称不同的参数
+OLLAMA_OPTION_NAMES = {"max_tokens": "num_predict"}
+
+class ApiError(Exception):
+    """API调用失败（状态码错误、配置错误等），消息直接展示给用户
+
+    retriable为True表示换一个端点重试可能成功（5xx、连接或首字超时）。
+    retry_after为服务端在Retry-After头中要求的等待秒数（429/503时）。
+    """
+    def __init__(self, message, status=None, retriable=False, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retriable = retriable
+        self.retry_after = retry_after
+
+def timeout_message(stage, seconds):
+    """各阶段超时的提示信息"""
+    if stage == "connect":
+        return f"连接超时：{seconds}秒内未能连接到服务器"
+    if stage == "first_byte":
+        return f"等待响应超时：{seconds}秒内未收到任何数据"
+    return f"响应中断：超过{seconds}秒未收到新数据"
+
+def parse_retry_after(value):
+    """Retry-After头：秒数或HTTP日期，返回秒数，无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+def status_error(status, body, headers):
+    """非200响应对应的ApiError"""
+    return ApiError(f"API调用失败: {status} - {body}", status=status, retriable=status >= 500,
+                    retry_after=parse_retry_after(headers.get("retry-after")))
+
+def variant_sampling(count, temperature=DEFAULT_TEMPERATURE, spread=0.2, seed=None):
+    """为同一提示的count个候选生成不同的采样参数
+
+    每个候选使用不同的随机种子，温度在temperature±spread之间均匀分布。
+    seed为None时随机选取起始种子，重复生成时不会得到与上次相同的候选。
+    """
+    if seed is None:
+        seed = random.randrange(1 << 30)
+    middle = (count - 1) / 2
+    result = []
+    for i in range(count):
+        offset = (i - middle) / middle * spread if middle else 0
+        result.append({"seed": seed + i, "temperature": round(max(0.05, temperature + offset), 2)})
+    return result
+
+def parse_keep_alive(value):
+    """把设置中的keep_alive转成Ollama接受的值：纯数字按秒，其余（如"30m"）原样传递，空值不传"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+class GenerationRequest:
+    """一次生成请求的参数与请求构建逻辑，不依赖界面，可供命令行等无界面环境复用
+
+    sampling为可选的采样参数（如seed、temperature、max_tokens），覆盖默认值；
+    Ollama原生接口放在options中，max_tokens改名为num_predict。
+    context和keep_alive只用于Ollama原生接口：context为上一次生成返回的上下文，
+    keep_alive为请求结束后模型保持加载的时长（如"30m"，-1表示一直保持）。
+    """
+    def __init__(self, api_type, api_url, api_key, prompt, model_name, api_format=None, custom_headers=None,
+                 sampling=None, context=None, keep_alive=None):
+        self.api_type = api_type
+        self.api_url = api_url
+        self.api_key = api_key
+        self.prompt = prompt
+        self.model_name = model_name
+        self.api_format = api_format
+        self.custom_headers = custom_headers
+        self.sampling = sampling
+        self.context = context
+        self.keep_alive = keep_alive
+
+    def build(self):
+        """按API类型构建请求头和请求数据"""
+        if self.api_type == "Ollama":
+            return self._build_ollama_request()
+        elif self.api_type == "SiliconFlow":
+            return self._build_siliconflow_request()
+        elif self.api_type == "自定义":
+            return self._build_custom_request()
+        raise ApiError(f"不支持的API类型: {self.api_type}")
+
+    def create_decoder(self):
+        """创建与API格式对应的流解码器"""
+        return create_decoder(self.api_type, self.api_format)
+
+    def cache_key(self, data):
+        """响应缓存键"""
+        from response_cache import make_cache_key, sampling_params
+        return make_cache_key(self.api_type, self.api_url, self.model_name,
+                              self.prompt, sampling_params(data))
+
+    def _apply_sampling(self, data, ollama):
+        """覆盖默认采样参数；Ollama原生接口只认options中的采样参数，另外带上context和keep_alive"""
+        if self.sampling:
+            if ollama:
+                data.setdefault("options", {}).update(
+                    (OLLAMA_OPTION_NAMES.get(name, name), value) for name, value in self.sampling.items()
+                )
+            else:
+                data.update(self.sampling)
+        if ollama:
+            keep_alive = parse_keep_alive(self.keep_alive)
+            if keep_alive is not None:
+                data["keep_alive"] = keep_alive
+            if self.context:
+                data["context"] = self.context
+        return data
+
+    def _build_ollama_request(self):
+        """构建Ollama API请求"""
+        headers = {"Content-Type": "application/json"}
+        data = {
+            "model": self.model_name,
+            "prompt": self.prompt,
+            "stream": True,  # 启用流式传输
+            "options": {"num_predict": DEFAULT_MAX_TOKENS, "temperature": DEFAULT_TEMPERATURE}
+        }
+        return headers, self._apply_sampling(data, ollama=True)
+
+    def _build_siliconflow_request(self):
+        """构建SiliconFlow API请求"""
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        data = {
+            "model": self.model_name,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": self.prompt
+                }
+            ],
+            "stream": True,  # 启用流式传输
+            "max_tokens": DEFAULT_MAX_TOKENS,
+            "temperature": DEFAULT_TEMPERATURE
+        }
+        return headers, self._apply_sampling(data, ollama=False)
+
+    def _build_custom_request(self):
+        """构建自定义API请求"""
+        print(f"开始调用自定义API: {self.api_url}")
+        print(f"API格式: {self.api_format}")
+
+        # 解析自定义请求头
+        headers = {"Content-Type": "application/json"}
+        if self.custom_headers:
+            try:
+                custom_headers = json.loads(self.custom_headers)
+                headers.update(custom_headers)
+                print(f"自定义请求头: {headers}")
+            except json.JSONDecodeError:
+                print("警告：自定义请求头格式错误，请确保是有效的JSON格式")
+                raise ApiError("自定义请求头格式错误，请确保是有效的JSON格式")
+        else:
+            print("使用默认请求头")
+
+        # 根据API格式构建请求数据
+        if self.api_format == "OpenAI格式":
+            data = {
+                "model": self.model_name,
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": self.prompt
+                    }
+                ],
+                "stream": True,  # 启用流式传输
+                "max_tokens": DEFAULT_MAX_TOKENS,
+                "temperature": DEFAULT_TEMPERATURE
+            }
+            self._apply_sampling(data, ollama=False)
+        else:  # Ollama格式
+            data = {
+                "model": self.model_name,
+                "prompt": self.prompt,
+                "stream": True,  # 启用流式传输
+                "options": {"num_predict": DEFAULT_MAX_TOKENS, "temperature": DEFAULT_TEMPERATURE}
+            }
+            self._apply_sampling(data, ollama=True)
+
+        print(f"请求数据: {json.dumps(data, ensure_ascii=False)}")
+        return headers, data
+
+def stream_generate(request, headers, data, on_text, should_stop=None, on_connect=None, cancel_token=None,
+                    on_headers=None):
+    """同步发送流式请求，每解码出一段文本调用一次on_text
+
+    should_stop返回True时提前结束，on_connect在收到响应头时调用，
+    on_headers(headers)收到响应头（包括错误响应）时调用，头部名称为小写。
+    cancel_token.cancel()会立即关闭连接，本函数随即正常返回。
+    连接、首块数据和两块数据之间分别受连接池的三个超时限制，超时抛出ApiError。
+    返回解码器，可从中读取结束帧等信息。
+    """
+    from requests.exceptions import ConnectTimeout, RequestException
+    pool = get_session_pool()
+    token = cancel_token if cancel_token is not None else CancelToken()
+    decoder = request.create_decoder()
+    stage = "connect"
+    try:
+        with token:
+            with pool.post(request.api_url, headers=headers, data=json.dumps(data), stream=True,
+                           timeout=(pool.connect_timeout, pool.first_byte_timeout)) as response:
+                stage = "first_byte"
+                if on_connect is not None:
+                    on_connect()
+                response_headers = {k.lower(): v for k, v in response.headers.items()}
+                if on_headers is not None:
+                    on_headers(response_headers)
+                if response.status_code != 200:
+                    raise status_error(response.status_code, response.text, response_headers)
+
+                # 处理流式响应，半帧由解码器缓存到下一块再拼接
+                for raw in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    if stage == "first_byte":
+                        stage = "idle"
+                        token.set_timeout(pool.read_timeout)
+                    if should_stop is not None and should_stop():  # 检查是否应该停止
+                        return decoder
+                    # 结束帧之后继续读完剩余数据，连接才能回到连接池复用
+                    for text in decoder.feed(raw):
+                        on_text(text)
+    except (RequestException, OSError) as e:
+        if token.cancelled:
+            return decoder  # 连接是被取消关闭的
+        if isinstance(e, ConnectTimeout):
+            stage = "connect"
+        elif "timed out" not in str(e).lower():
+            raise
+        elif stage == "connect":
+            stage = "first_byte"  # 连接已建立，等待响应头时超时
+        seconds = {"connect": pool.connect_timeout, "first_byte": pool.first_byte_timeout,
+                   "idle": pool.read_timeout}[stage]
+        raise ApiError(timeout_message(stage, seconds), retriable=stage != "idle")
+    if token.cancelled:
+        return decoder
+    for text in decoder.finish():
+        on_text(text)
+    return decoder
+
+async def async_stream_generate(engine, request, headers, data, on_text, on_connect=None, on_headers=None):
+    """通过AsyncStreamEngine发送流式请求，返回解码器"""
+    from async_engine import HttpStatusError, StreamTimeoutError
+    decoder = request.create_decoder()
+
+    def on_response_headers(response_headers):
+        if on_connect is not None:
+            on_connect()
+        if on_headers is not None:
+            on_headers(response_headers)
+
+    def on_chunk(raw):
+        for text in decoder.feed(raw):
+            on_text(text)
+
+    try:
+        await engine.stream(request.api_url, headers, json.dumps(data).encode("utf-8"), on_chunk,
+                            on_headers=on_response_headers)
+    except HttpStatusError as e:
+        raise status_error(e.status, e.body, e.headers)
+    except StreamTimeoutError as e:
+        raise ApiError(timeout_message(e.stage, e.seconds), retriable=e.stage != "idle")
+    for text in decoder.finish():
+        on_text(text)
+    return decoder
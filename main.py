@@ -1,26 +1,218 @@
 import sys
 import os
 import json
-from datetime import datetime, timedelta, timezone 
-from PyQt5.QtCore import Qt, QTimer, QUrl, QObject
+from datetime import datetime
+from PyQt5.QtCore import Qt, QTimer, QThread, pyqtSignal
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel,
-    QPushButton, QMessageBox, QFrame, QTabWidget, QTextEdit, QComboBox,
-    QFormLayout, QProgressBar, QStatusBar
+    QMessageBox, QFrame, QTabWidget, QTextEdit, QComboBox,
+    QFormLayout, QProgressBar, QStatusBar, QSpinBox, QDoubleSpinBox, QCheckBox, QFileDialog, QInputDialog
 )
 from PyQt5.QtGui import QFont, QIcon
 
-from api_client import ApiCallThread
-from ui_components import GradientFrame, CustomButton, CustomInput
+from api_client import (
+    StoryMemoryThread, EndpointProbeThread, ModelWarmupThread, RetrievalIndexThread, EmbeddingThread,
+    PostProcessThread
+)
+from backend_router import POLICIES, DEFAULT_POLICY, get_router, parse_endpoints, prune_routers
+from generation_journal import GenerationJournal
+from context_sessions import ContextSessionStore, DEFAULT_KEEP_ALIVE, DEFAULT_MAX_CONTEXT_TOKENS, supports_context
+from http_pool import (
+    get_session_pool, DEFAULT_POOL_SIZE, DEFAULT_CONNECT_TIMEOUT, DEFAULT_FIRST_BYTE_TIMEOUT, DEFAULT_READ_TIMEOUT
+)
+from model_warmup import (
+    get_warmup_tracker, model_key, supports_preload, STATE_WARM, STATE_WARMING, STATE_FAILED
+)
+from length_controller import CONTINUE_INSTRUCTION, LengthRun
+from llm_backend import DEFAULT_MAX_TOKENS, DEFAULT_TEMPERATURE
+from job_queue import JobQueue, DEFAULT_CONCURRENCY, JOB_DONE, JOB_FAILED, JOB_CANCELLED
+from manuscript_view import ManuscriptView
+from rate_limiter import get_rate_limiter
+from story_memory import StoryMemory, DEFAULT_BUDGET_TOKENS, DEFAULT_RECENT_PARAGRAPHS
+from telemetry import get_telemetry
+from token_estimator import context_window, get_token_estimator, model_family, prompt_budget
+from ui_components import GradientFrame, CustomButton, CustomInput, JobQueuePanel, TelemetryPanel, VariantPanel
+
+# 流式文本刷新到结果区的间隔（毫秒）
+STREAM_FLUSH_INTERVAL_MS = 40
+# 一次最多并排生成的候选数
+MAX_VARIANTS = 4
+# 修改后端或模型设置后等待这么久再预热，连续修改只预热一次（毫秒）
+WARMUP_DEBOUNCE_MS = 800
+# 状态栏模型状态的刷新间隔（毫秒），超过keep_alive的模型显示为未加载
+MODEL_STATE_REFRESH_MS = 30000
+# 写作提示停止修改这么久后在后台为检索查询计算向量（毫秒）
+QUERY_EMBED_DEBOUNCE_MS = 500
+# 写作提示停止修改这么久后重新估算提示长度（毫秒）
+PROMPT_ESTIMATE_DEBOUNCE_MS = 300
+# 故事记忆和引用前文合计最多占提示可用token数的比例，其余留给标题、写作要求和模板；窗口小时两者的预算按比例缩小
+CONTEXT_PROMPT_SHARE = 0.8
+
+SETTINGS_FILE = "settings.json"
+STORY_MEMORY_FILE = "story_memory.json"
+
+# 默认设置，settings.json中缺少的项使用这里的值
+DEFAULT_SETTINGS = {
+    "api_type": "Ollama",
+    "api_url": "",
+    "api_key": "",
+    "model_name": "",
+    "api_format": "OpenAI格式",
+    "custom_headers": "",
+    "extra_endpoints": "",
+    "routing": DEFAULT_POLICY,
+    "pool_size": DEFAULT_POOL_SIZE,
+    "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+    "first_byte_timeout": DEFAULT_FIRST_BYTE_TIMEOUT,
+    "read_timeout": DEFAULT_READ_TIMEOUT,
+    "enable_cache": False,
+    "concurrency": dict(DEFAULT_CONCURRENCY),
+    # 各API类型每分钟的请求数/token数上限，0表示不限（仍会从响应头学习并遵守429）
+    "rate_limits": {api_type: {"rpm": 0, "tpm": 0} for api_type in DEFAULT_CONCURRENCY},
+    "use_async": False,
+    "memory_budget_tokens": DEFAULT_BUDGET_TOKENS,
+    "memory_recent_paragraphs": DEFAULT_RECENT_PARAGRAPHS,
+    "keep_alive": DEFAULT_KEEP_ALIVE,
+    "context_max_tokens": DEFAULT_MAX_CONTEXT_TOKENS,
+    # 上下文窗口（token），0表示按模型系列估计（Ollama为服务端默认的num_ctx）；Ollama设置后随请求发送num_ctx
+    "context_window": 0,
+    # 提示超过上下文窗口时自动截去开头，否则发送前询问
+    "auto_trim_prompt": False,
+    "auto_warmup": True,
+    # 流式输出陷入重复循环时截断；retry为截断后调整采样参数续写一次
+    "repetition_check": True,
+    "repetition_retry": False,
+    # 检索注入：相关前文的片段数和token预算（与retrieval_index的DEFAULT_TOP_K、DEFAULT_RETRIEVAL_BUDGET相同，
+    # 检索模块在窗口显示后才加载）；向量模型留空时只用关键词检索
+    "retrieval_top_k": 5,
+    "retrieval_budget_tokens": 600,
+    "embedding_model": "",
+    "embedding_url": "http://localhost:11434"
+}
+
+class SettingsLoadThread(QThread):
+    """在后台读取settings.json，不占用启动的关键路径"""
+    loaded = pyqtSignal(dict)
+
+    def __init__(self, path=SETTINGS_FILE):
+        super().__init__()
+        self.path = path
+        self.settings = {}
+
+    def run(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.settings = json.load(f)
+            except Exception as e:
+                print(f"加载设置失败: {e}")
+        self.loaded.emit(self.settings)
 
 class NovelWriterWindow(QMainWindow):
     """小说写作软件主窗口"""
     def __init__(self):
         super().__init__()
+        
+        # 生成任务队列
+        self.job_queue = JobQueue(parent=self)
+        self.job_queue.job_started.connect(self.on_job_started)
+        self.job_queue.job_delta.connect(self.on_job_delta)
+        self.job_queue.job_rewind.connect(self.on_job_rewind)
+        self.job_queue.job_changed.connect(self.on_job_changed)
+        self.job_queue.job_finished.connect(self.on_job_finished)
+        
+        # 当前设置；设置标签页首次打开前，生成时直接使用这里的值
+        self.settings = json.loads(json.dumps(DEFAULT_SETTINGS))
+        self._settings_loaded = False
+        self._settings_tab_built = False
+        
         self.initUI()
         
-        # API调用线程
-        self.api_thread = None
+        # 响应缓存（在设置中启用后才创建）
+        self.response_cache = None
+        
+        # 故事记忆（首次使用续写模式时加载）
+        self.story_memory = None
+        self._memory_jobs = set()  # 续写模式提交的任务，完成后写入记忆
+        self._memory_thread = None
+        self._memory_params = None  # 概要线程运行中又有新内容时，结束后用这些设置再跑一次
+        
+        # 项目文件（打开后生成结果追加保存到当前章节）
+        self.project = None
+        self._project_jobs = {}  # 任务号 -> 提交时的章节号
+        
+        # 当前的候选组：并排显示，选中的候选结束后写入结果区
+        self._variant_jobs = []
+        
+        # 按目标字数分段生成：各段的任务号 -> LengthRun，全部写完后合并保存
+        self._length_runs = {}
+        
+        # Ollama续写会话：按章节保存返回的context，下次续写时发回
+        self.context_sessions = ContextSessionStore()
+        self._session_jobs = {}  # 任务号 -> (会话键, 完整提示, 是否带了context)
+        
+        # 模型预热：启动和修改后端/模型设置后在后台加载模型
+        self._warmup_thread = None
+        self._warmup_pending = False  # 预热进行中设置又变了，结束后再预热一次
+        self._warmup_timer = QTimer(self)
+        self._warmup_timer.setSingleShot(True)
+        self._warmup_timer.setInterval(WARMUP_DEBOUNCE_MS)
+        self._warmup_timer.timeout.connect(self.warm_up_model)
+        self._model_state_timer = QTimer(self)
+        self._model_state_timer.setInterval(MODEL_STATE_REFRESH_MS)
+        self._model_state_timer.timeout.connect(self._update_model_state_label)
+        self._model_state_timer.start()
+        
+        # 检索索引：已生成和保存的正文，生成时检索相关片段注入提示（在后台加载）
+        self.retrieval_index = None
+        self._index_thread = None
+        self._unindexed_texts = []  # 索引加载完成前生成的结果，加载后补入
+        self._embed_thread = None  # 为片段计算向量
+        self._query_embed_thread = None  # 为检索查询计算向量
+        self._query_vector = (None, None)  # (查询, 向量)
+        self._query_embed_timer = QTimer(self)
+        self._query_embed_timer.setSingleShot(True)
+        self._query_embed_timer.setInterval(QUERY_EMBED_DEBOUNCE_MS)
+        self._query_embed_timer.timeout.connect(self._prefetch_query_vector)
+        self.prompt_input.textChanged.connect(self._query_embed_timer.start)
+        
+        # 提示长度估算：输入时在后台计时，停顿后估算将要发送的提示是否超出上下文窗口
+        self._prompt_estimate_timer = QTimer(self)
+        self._prompt_estimate_timer.setSingleShot(True)
+        self._prompt_estimate_timer.setInterval(PROMPT_ESTIMATE_DEBOUNCE_MS)
+        self._prompt_estimate_timer.timeout.connect(self._update_prompt_estimate)
+        for signal in (self.prompt_input.textChanged, self.max_tokens_spin.valueChanged,
+                       self.memory_checkbox.toggled, self.session_checkbox.toggled, self.retrieval_checkbox.toggled):
+            signal.connect(self._prompt_estimate_timer.start)
+        
+        # 导出整理稿：标点规范化、分段和统计在工作进程池中进行，整理模块和进程池在第一次导出时加载
+        self.postprocessor = None
+        self._export_thread = None
+        self._export_chapters = []  # 正在导出的各章标题
+        self._export_stats = []  # 已整理完成的各章(标题, 统计)
+        
+        # 生成日志：增量实时写入磁盘，崩溃或中途退出后可以找回
+        self.journal = GenerationJournal()
+        self._journal_entries = {}  # 任务号 -> 日志编号
+        
+        # 后台加载设置
+        self._settings_loader = SettingsLoadThread()
+        self._settings_loader.loaded.connect(self._on_settings_loaded)
+        self._settings_loader.start()
+        
+        # 窗口显示后检查上次未完成的生成，再在后台加载检索索引
+        QTimer.singleShot(0, self._offer_journal_recovery)
+        QTimer.singleShot(0, self._load_retrieval_index)
+        
+        # 结果区按任务开始顺序依次显示，队首任务实时流式显示
+        self._display_order = []
+        self._live_job_id = None
+        
+        # 流式增量缓冲，由定时器按固定频率刷新到结果区
+        self._delta_buffer = []
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setInterval(STREAM_FLUSH_INTERVAL_MS)
+        self._flush_timer.timeout.connect(self._flush_delta_buffer)
         
     def initUI(self):
         """初始化用户界面"""
@@ -80,11 +272,16 @@ class NovelWriterWindow(QMainWindow):
         self.init_write_tab()
         self.tabs.addTab(self.write_tab, "写作")
         
-        # 设置标签页
+        # 设置标签页（首次切换到该页时才创建控件）
         self.settings_tab = QWidget()
-        self.init_settings_tab()
         self.tabs.addTab(self.settings_tab, "设置")
         
+        # 统计标签页（同样首次切换时创建）
+        self.stats_tab = QWidget()
+        self.telemetry_panel = None
+        self.tabs.addTab(self.stats_tab, "统计")
+        self.tabs.currentChanged.connect(self._on_tab_changed)
+        
         main_layout.addWidget(self.tabs)
         
         # 进度条
@@ -111,6 +308,16 @@ class NovelWriterWindow(QMainWindow):
         self.setStatusBar(self.statusBar)
         self.statusBar.showMessage("就绪")
         
+        # 最近一次请求的首字延迟和生成速度
+        self.telemetry_label = QLabel("")
+        self.telemetry_label.setStyleSheet("color: rgba(255, 255, 255, 0.7);")
+        self.statusBar.addPermanentWidget(self.telemetry_label)
+        
+        # 当前模型是否已加载
+        self.model_state_label = QLabel("")
+        self.model_state_label.setStyleSheet("color: rgba(255, 255, 255, 0.7);")
+        self.statusBar.addPermanentWidget(self.model_state_label)
+        
         # 居中窗口
         self.center_window()
     
@@ -156,17 +363,157 @@ class NovelWriterWindow(QMainWindow):
         self.clear_button.clicked.connect(self.clear_content)
         button_layout.addWidget(self.clear_button)
         
+        priority_label = QLabel("优先级：")
+        priority_label.setStyleSheet("color: white;")
+        button_layout.addWidget(priority_label)
+        self.priority_spin = QSpinBox()
+        self.priority_spin.setRange(-10, 10)
+        self.priority_spin.setToolTip("数值越大越先执行")
+        self.priority_spin.setStyleSheet("""
+            QSpinBox {
+                background-color: rgba(255, 255, 255, 0.1);
+                color: white;
+                border: 1px solid rgba(255, 255, 255, 0.3);
+                border-radius: 5px;
+                padding: 5px;
+            }
+        """)
+        button_layout.addWidget(self.priority_spin)
+        
+        variants_label = QLabel("候选数：")
+        variants_label.setStyleSheet("color: white;")
+        button_layout.addWidget(variants_label)
+        self.variants_spin = QSpinBox()
+        self.variants_spin.setRange(1, MAX_VARIANTS)
+        self.variants_spin.setToolTip("大于1时用不同的随机种子和温度同时生成多个候选，并排显示，选中一个后其余立即停止")
+        self.variants_spin.setStyleSheet(self.priority_spin.styleSheet())
+        button_layout.addWidget(self.variants_spin)
+        
         prompt_layout.addLayout(button_layout)
+        
+        # 本次生成的采样参数和目标长度
+        sampling_layout = QHBoxLayout()
+        temperature_label = QLabel("温度：")
+        temperature_label.setStyleSheet("color: white;")
+        sampling_layout.addWidget(temperature_label)
+        self.temperature_spin = QDoubleSpinBox()
+        self.temperature_spin.setRange(0.0, 2.0)
+        self.temperature_spin.setSingleStep(0.05)
+        self.temperature_spin.setValue(DEFAULT_TEMPERATURE)
+        self.temperature_spin.setToolTip("生成多个候选时各候选的温度以此为中心分布")
+        self.temperature_spin.setStyleSheet(self.priority_spin.styleSheet().replace("QSpinBox", "QDoubleSpinBox"))
+        sampling_layout.addWidget(self.temperature_spin)
+        max_tokens_label = QLabel("单次最大长度：")
+        max_tokens_label.setStyleSheet("color: white;")
+        sampling_layout.addWidget(max_tokens_label)
+        self.max_tokens_spin = QSpinBox()
+        self.max_tokens_spin.setRange(100, 32000)
+        self.max_tokens_spin.setSingleStep(500)
+        self.max_tokens_spin.setValue(DEFAULT_MAX_TOKENS)
+        self.max_tokens_spin.setSuffix(" token")
+        self.max_tokens_spin.setStyleSheet(self.priority_spin.styleSheet())
+        sampling_layout.addWidget(self.max_tokens_spin)
+        target_label = QLabel("目标字数：")
+        target_label.setStyleSheet("color: white;")
+        sampling_layout.addWidget(target_label)
+        self.target_length_spin = QSpinBox()
+        self.target_length_spin.setRange(0, 200000)
+        self.target_length_spin.setSingleStep(1000)
+        self.target_length_spin.setSpecialValueText("不限")
+        self.target_length_spin.setSuffix(" 字")
+        self.target_length_spin.setToolTip("设置后自动分段续写，每段按剩余字数请求，写到目标后在段落结尾停止；"
+                                           "生成多个候选时不分段")
+        self.target_length_spin.setStyleSheet(self.priority_spin.styleSheet())
+        sampling_layout.addWidget(self.target_length_spin)
+        sampling_layout.addStretch()
+        self.prompt_estimate_label = QLabel("")
+        self.prompt_estimate_label.setStyleSheet("color: rgba(255, 255, 255, 0.7);")
+        self.prompt_estimate_label.setToolTip("按模型系列估算的提示长度（包括故事记忆和引用前文的预算）与上下文窗口，"
+                                              "以及按最近的提示处理速度预计的耗时")
+        sampling_layout.addWidget(self.prompt_estimate_label)
+        prompt_layout.addLayout(sampling_layout)
+        
+        # 续写模式：提示由故事记忆（各层概要 + 最近几段原文）和写作要求组成
+        memory_layout = QHBoxLayout()
+        self.memory_checkbox = QCheckBox("续写模式（使用故事记忆）")
+        self.memory_checkbox.setStyleSheet("color: white;")
+        self.memory_checkbox.setToolTip("生成结果会在后台整理成章节概要，续写提示长度不随全书长度增长")
+        self.memory_checkbox.toggled.connect(self._update_memory_label)
+        memory_layout.addWidget(self.memory_checkbox)
+        self.memory_label = QLabel("")
+        self.memory_label.setStyleSheet("color: rgba(255, 255, 255, 0.7);")
+        memory_layout.addWidget(self.memory_label)
+        self.session_checkbox = QCheckBox("复用上下文（Ollama）")
+        self.session_checkbox.setStyleSheet("color: white;")
+        self.session_checkbox.setToolTip("把上次生成返回的context发回模型，续写同一章节时不必重新处理整段提示；"
+                                         "换模型、上下文过长或生成中断时自动改用完整提示")
+        memory_layout.addWidget(self.session_checkbox)
+        self.retrieval_checkbox = QCheckBox("引用相关前文")
+        self.retrieval_checkbox.setStyleSheet("color: white;")
+        self.retrieval_checkbox.setChecked(True)
+        self.retrieval_checkbox.setToolTip("从已生成和保存的正文中检索与写作要求相关的片段，在预算内自动加入提示")
+        memory_layout.addWidget(self.retrieval_checkbox)
+        memory_layout.addStretch()
+        self.clear_memory_button = CustomButton("清空记忆", size=(120, 40))
+        self.clear_memory_button.clicked.connect(self.clear_story_memory)
+        memory_layout.addWidget(self.clear_memory_button)
+        prompt_layout.addLayout(memory_layout)
         layout.addWidget(prompt_group)
         
+        # 任务队列
+        self.job_queue_panel = JobQueuePanel(self.job_queue, self._jobs_in_use)
+        self.job_queue_panel.setMaximumHeight(180)
+        layout.addWidget(self.job_queue_panel)
+        
+        # 候选并排显示（生成多个候选时才显示）
+        self.variant_panel = VariantPanel(self.job_queue)
+        self.variant_panel.setMinimumHeight(200)
+        self.variant_panel.picked.connect(self.pick_variant)
+        self.variant_panel.setVisible(False)
+        layout.addWidget(self.variant_panel)
+        
         # 下部：结果显示
+        result_header = QHBoxLayout()
         result_label = QLabel("生成结果：")
         result_label.setStyleSheet("color: white; font-size: 14px;")
-        layout.addWidget(result_label)
+        result_header.addWidget(result_label)
+        result_header.addStretch()
         
-        self.result_display = QTextEdit()
+        # 项目与章节：生成结果自动追加保存到当前章节
+        self.project_label = QLabel("未打开项目")
+        self.project_label.setStyleSheet("color: rgba(255, 255, 255, 0.7);")
+        result_header.addWidget(self.project_label)
+        self.open_project_button = CustomButton("打开/新建项目", size=(140, 40))
+        self.open_project_button.clicked.connect(self.open_project)
+        result_header.addWidget(self.open_project_button)
+        self.chapter_combo = QComboBox()
+        self.chapter_combo.setMinimumWidth(160)
+        self.chapter_combo.setEnabled(False)
+        self.chapter_combo.setStyleSheet("""
+            QComboBox {
+                background-color: rgba(255, 255, 255, 0.1);
+                color: white;
+                border: 1px solid rgba(255, 255, 255, 0.3);
+                border-radius: 5px;
+                padding: 5px;
+            }
+        """)
+        self.chapter_combo.activated.connect(self._on_chapter_selected)
+        result_header.addWidget(self.chapter_combo)
+        self.new_chapter_button = CustomButton("新建章节", size=(120, 40))
+        self.new_chapter_button.clicked.connect(self.new_chapter)
+        self.new_chapter_button.setEnabled(False)
+        result_header.addWidget(self.new_chapter_button)
+        self.export_button = CustomButton("导出整理稿", size=(120, 40))
+        self.export_button.clicked.connect(self.export_project)
+        self.export_button.setEnabled(False)
+        result_header.addWidget(self.export_button)
+        layout.addLayout(result_header)
+        
+        # 纯文本、内存有上限的结果区，长时间生成数MB文本也不会卡顿
+        self.result_display = ManuscriptView()
         self.result_display.setStyleSheet("""
-            QTextEdit {
+            QPlainTextEdit {
                 background-color: rgba(255, 255, 255, 0.1);
                 color: white;
                 border: 1px solid rgba(255, 255, 255, 0.3);
@@ -174,9 +521,22 @@ class NovelWriterWindow(QMainWindow):
                 padding: 5px;
             }
         """)
-        self.result_display.setReadOnly(True)
         layout.addWidget(self.result_display)
     
+    def _on_tab_changed(self, index):
+        """首次切换到设置或统计标签页时再创建其中的控件"""
+        if self.tabs.widget(index) is self.stats_tab:
+            if self.telemetry_panel is None:
+                self.telemetry_panel = TelemetryPanel(get_telemetry())
+                QVBoxLayout(self.stats_tab).addWidget(self.telemetry_panel)
+            else:
+                self.telemetry_panel.refresh()
+        if self.tabs.widget(index) is self.settings_tab and not self._settings_tab_built:
+            self._ensure_settings_loaded()
+            self.init_settings_tab()
+            self._settings_tab_built = True
+            self._populate_settings_widgets(self.settings)
+    
     def init_settings_tab(self):
         """初始化设置标签页"""
         layout = QVBoxLayout(self.settings_tab)
@@ -220,6 +580,11 @@ class NovelWriterWindow(QMainWindow):
         self.model_name_input = CustomInput("例如: llama3")
         api_layout.addRow(self.model_name_input)
         
+        # 切换后端或模型后自动预热
+        self.api_type_combo.currentTextChanged.connect(self._schedule_warmup)
+        self.api_url_input.editingFinished.connect(self._schedule_warmup)
+        self.model_name_input.editingFinished.connect(self._schedule_warmup)
+        
         # API格式（仅自定义API显示）
         api_layout.addRow(QLabel("API格式：", styleSheet="color: white;"))
         self.api_format_combo = QComboBox()
@@ -251,6 +616,197 @@ class NovelWriterWindow(QMainWindow):
         self.custom_headers_input.setPlaceholderText('例如: {"Authorization": "Bearer your_token"}')
         api_layout.addRow(self.custom_headers_input)
         
+        # 后端池：API地址加上备用端点，按路由策略分配请求
+        api_layout.addRow(QLabel("备用端点（每行一个，与API地址组成后端池）：", styleSheet="color: white;"))
+        self.extra_endpoints_input = QTextEdit()
+        self.extra_endpoints_input.setStyleSheet("""
+            QTextEdit {
+                background-color: rgba(255, 255, 255, 0.1);
+                color: white;
+                border: 1px solid rgba(255, 255, 255, 0.3);
+                border-radius: 5px;
+                padding: 5px;
+            }
+        """)
+        self.extra_endpoints_input.setMinimumHeight(60)
+        self.extra_endpoints_input.setPlaceholderText("例如: http://192.168.1.20:11434/api/generate")
+        api_layout.addRow(self.extra_endpoints_input)
+        
+        self.routing_combo = QComboBox()
+        for policy, label in POLICIES.items():
+            self.routing_combo.addItem(label, policy)
+        self.routing_combo.setStyleSheet("""
+            QComboBox {
+                background-color: rgba(255, 255, 255, 0.1);
+                color: white;
+                border: 1px solid rgba(255, 255, 255, 0.3);
+                border-radius: 5px;
+                padding: 5px;
+            }
+        """)
+        api_layout.addRow(QLabel("路由策略：", styleSheet="color: white;"), self.routing_combo)
+        
+        self.probe_button = CustomButton("检测端点", size=(120, 40))
+        self.probe_button.clicked.connect(self.probe_endpoints)
+        api_layout.addRow(self.probe_button)
+        
+        # 连接池设置
+        spin_style = """
+            QSpinBox {
+                background-color: rgba(255, 255, 255, 0.1);
+                color: white;
+                border: 1px solid rgba(255, 255, 255, 0.3);
+                border-radius: 5px;
+                padding: 5px;
+            }
+        """
+        self.pool_size_spin = QSpinBox()
+        self.pool_size_spin.setRange(1, 100)
+        self.pool_size_spin.setValue(DEFAULT_POOL_SIZE)
+        self.pool_size_spin.setStyleSheet(spin_style)
+        api_layout.addRow(QLabel("连接池大小：", styleSheet="color: white;"), self.pool_size_spin)
+        
+        self.connect_timeout_spin = QSpinBox()
+        self.connect_timeout_spin.setRange(1, 600)
+        self.connect_timeout_spin.setValue(DEFAULT_CONNECT_TIMEOUT)
+        self.connect_timeout_spin.setSuffix(" 秒")
+        self.connect_timeout_spin.setStyleSheet(spin_style)
+        api_layout.addRow(QLabel("连接超时：", styleSheet="color: white;"), self.connect_timeout_spin)
+        
+        self.first_byte_timeout_spin = QSpinBox()
+        self.first_byte_timeout_spin.setRange(1, 3600)
+        self.first_byte_timeout_spin.setValue(DEFAULT_FIRST_BYTE_TIMEOUT)
+        self.first_byte_timeout_spin.setSuffix(" 秒")
+        self.first_byte_timeout_spin.setToolTip("发出请求到收到第一块数据的最长等待，包括模型加载时间")
+        self.first_byte_timeout_spin.setStyleSheet(spin_style)
+        api_layout.addRow(QLabel("首字超时：", styleSheet="color: white;"), self.first_byte_timeout_spin)
+        
+        self.read_timeout_spin = QSpinBox()
+        self.read_timeout_spin.setRange(1, 3600)
+        self.read_timeout_spin.setValue(DEFAULT_READ_TIMEOUT)
+        self.read_timeout_spin.setSuffix(" 秒")
+        self.read_timeout_spin.setToolTip("流式输出过程中两块数据之间的最长等待")
+        self.read_timeout_spin.setStyleSheet(spin_style)
+        api_layout.addRow(QLabel("空闲超时：", styleSheet="color: white;"), self.read_timeout_spin)
+        
+        # 各后端并发上限
+        self.concurrency_spins = {}
+        for api_type, limit in DEFAULT_CONCURRENCY.items():
+            spin = QSpinBox()
+            spin.setRange(1, 64)
+            spin.setValue(limit)
+            spin.setStyleSheet(spin_style)
+            api_layout.addRow(QLabel(f"{api_type}并发数：", styleSheet="color: white;"), spin)
+            self.concurrency_spins[api_type] = spin
+        
+        # 各后端的RPM/TPM限额，超出时任务排队等待而不是收到429
+        self.rate_limit_spins = {}
+        for api_type in DEFAULT_CONCURRENCY:
+            limit_layout = QHBoxLayout()
+            spins = []
+            for suffix, maximum in ((" 请求/分", 100000), (" token/分", 100000000)):
+                spin = QSpinBox()
+                spin.setRange(0, maximum)
+                spin.setSpecialValueText("不限")
+                spin.setSuffix(suffix)
+                spin.setToolTip("0表示不限：仍会按响应头中的限额和429的Retry-After自动限速")
+                spin.setStyleSheet(spin_style)
+                limit_layout.addWidget(spin)
+                spins.append(spin)
+            api_layout.addRow(QLabel(f"{api_type}限额：", styleSheet="color: white;"), limit_layout)
+            self.rate_limit_spins[api_type] = spins
+        
+        # 响应缓存
+        self.cache_checkbox = QCheckBox("启用响应缓存（相同提示和参数直接复用结果）")
+        self.cache_checkbox.setStyleSheet("color: white;")
+        api_layout.addRow(self.cache_checkbox)
+        
+        # 异步引擎
+        self.async_checkbox = QCheckBox("使用异步引擎（所有任务共用一个事件循环线程）")
+        self.async_checkbox.setStyleSheet("color: white;")
+        api_layout.addRow(self.async_checkbox)
+        
+        # 重复循环检测
+        repetition_layout = QHBoxLayout()
+        self.repetition_checkbox = QCheckBox("检测重复循环并截断")
+        self.repetition_checkbox.setStyleSheet("color: white;")
+        self.repetition_checkbox.setChecked(True)
+        repetition_layout.addWidget(self.repetition_checkbox)
+        self.repetition_retry_checkbox = QCheckBox("截断后提高温度和重复惩罚续写一次")
+        self.repetition_retry_checkbox.setStyleSheet("color: white;")
+        repetition_layout.addWidget(self.repetition_retry_checkbox)
+        api_layout.addRow(repetition_layout)
+        
+        # 模型预热
+        warmup_layout = QHBoxLayout()
+        self.warmup_checkbox = QCheckBox("启动和切换后端/模型时自动预热（Ollama预先加载模型）")
+        self.warmup_checkbox.setStyleSheet("color: white;")
+        self.warmup_checkbox.setChecked(True)
+        warmup_layout.addWidget(self.warmup_checkbox)
+        self.warmup_button = CustomButton("立即预热", size=(120, 40))
+        self.warmup_button.clicked.connect(lambda: self.warm_up_model(force=True))
+        warmup_layout.addWidget(self.warmup_button)
+        api_layout.addRow(warmup_layout)
+        
+        # 故事记忆
+        self.memory_budget_spin = QSpinBox()
+        self.memory_budget_spin.setRange(200, 32000)
+        self.memory_budget_spin.setSingleStep(100)
+        self.memory_budget_spin.setValue(DEFAULT_BUDGET_TOKENS)
+        self.memory_budget_spin.setSuffix(" token")
+        self.memory_budget_spin.setStyleSheet(spin_style)
+        api_layout.addRow(QLabel("续写记忆预算：", styleSheet="color: white;"), self.memory_budget_spin)
+        
+        self.memory_paragraphs_spin = QSpinBox()
+        self.memory_paragraphs_spin.setRange(0, 20)
+        self.memory_paragraphs_spin.setValue(DEFAULT_RECENT_PARAGRAPHS)
+        self.memory_paragraphs_spin.setStyleSheet(spin_style)
+        api_layout.addRow(QLabel("续写附带最近段落数：", styleSheet="color: white;"), self.memory_paragraphs_spin)
+        
+        # 检索注入
+        self.retrieval_top_k_spin = QSpinBox()
+        self.retrieval_top_k_spin.setRange(1, 20)
+        self.retrieval_top_k_spin.setValue(DEFAULT_SETTINGS["retrieval_top_k"])
+        self.retrieval_top_k_spin.setStyleSheet(spin_style)
+        api_layout.addRow(QLabel("引用前文片段数：", styleSheet="color: white;"), self.retrieval_top_k_spin)
+        self.retrieval_budget_spin = QSpinBox()
+        self.retrieval_budget_spin.setRange(100, 16000)
+        self.retrieval_budget_spin.setSingleStep(100)
+        self.retrieval_budget_spin.setValue(DEFAULT_SETTINGS["retrieval_budget_tokens"])
+        self.retrieval_budget_spin.setSuffix(" token")
+        self.retrieval_budget_spin.setStyleSheet(spin_style)
+        api_layout.addRow(QLabel("引用前文预算：", styleSheet="color: white;"), self.retrieval_budget_spin)
+        self.embedding_model_input = CustomInput("例如: nomic-embed-text，留空只用关键词检索")
+        api_layout.addRow(QLabel("向量模型（Ollama）：", styleSheet="color: white;"), self.embedding_model_input)
+        self.embedding_url_input = CustomInput("例如: http://localhost:11434")
+        api_layout.addRow(QLabel("向量服务地址：", styleSheet="color: white;"), self.embedding_url_input)
+        
+        # Ollama：模型保持加载的时长和复用上下文的长度上限
+        self.keep_alive_input = CustomInput("例如: 30m、1h，-1表示一直保持，留空使用服务端默认")
+        api_layout.addRow(QLabel("Ollama保持加载：", styleSheet="color: white;"), self.keep_alive_input)
+        self.context_max_spin = QSpinBox()
+        self.context_max_spin.setRange(512, 131072)
+        self.context_max_spin.setSingleStep(512)
+        self.context_max_spin.setValue(DEFAULT_MAX_CONTEXT_TOKENS)
+        self.context_max_spin.setSuffix(" token")
+        self.context_max_spin.setToolTip("上下文超过这个长度（应不大于模型的num_ctx）时改用完整提示重新开始会话")
+        self.context_max_spin.setStyleSheet(spin_style)
+        api_layout.addRow(QLabel("复用上下文上限：", styleSheet="color: white;"), self.context_max_spin)
+        
+        # 上下文窗口：发送前检查提示长度
+        self.context_window_spin = QSpinBox()
+        self.context_window_spin.setRange(0, 1048576)
+        self.context_window_spin.setSingleStep(1024)
+        self.context_window_spin.setSpecialValueText("自动")
+        self.context_window_spin.setSuffix(" token")
+        self.context_window_spin.setToolTip("发送前检查提示是否超出这个长度；自动时按模型系列估计。"
+                                            "Ollama设置后随请求发送num_ctx（不设置时服务端会静默截掉超出的开头）")
+        self.context_window_spin.setStyleSheet(spin_style)
+        api_layout.addRow(QLabel("上下文窗口：", styleSheet="color: white;"), self.context_window_spin)
+        self.auto_trim_checkbox = QCheckBox("提示超出上下文窗口时自动截去开头（否则发送前询问）")
+        self.auto_trim_checkbox.setStyleSheet("color: white;")
+        api_layout.addRow(self.auto_trim_checkbox)
+        
         # 保存设置按钮
         save_button = CustomButton("保存设置")
         save_button.clicked.connect(self.save_settings)
@@ -258,9 +814,6 @@ class NovelWriterWindow(QMainWindow):
         
         api_group.setLayout(api_layout)
         layout.addWidget(api_group)
-        
-        # 加载保存的设置
-        self.load_settings()
     
     def center_window(self):
         """将窗口居中显示"""
@@ -270,49 +823,224 @@ class NovelWriterWindow(QMainWindow):
         self.move(frame_geometry.topLeft())
     
     def generate_content(self):
-        """生成小说内容"""
+        """提交生成任务到队列"""
         prompt = self.prompt_input.toPlainText().strip()
-        if not prompt:
+        use_memory = self.memory_checkbox.isChecked()
+        use_session = self.session_checkbox.isChecked()
+        if not prompt and not use_session and not (use_memory and not self._get_story_memory().is_empty):
             QMessageBox.warning(self, "提示", "请输入写作提示")
             return
             
         # 获取API设置
-        api_type = self.api_type_combo.currentText()
-        api_url = self.api_url_input.text().strip()
-        api_key = self.api_key_input.text().strip()
-        model_name = self.model_name_input.text().strip()
-        api_format = self.api_format_combo.currentText() if api_type == "自定义" else None
-        custom_headers = self.custom_headers_input.toPlainText().strip() or None
-        
-        if not api_url or not model_name:
+        settings = self._current_settings()
+        api_type = settings["api_type"]
+        params = self._request_params(settings)
+        params["sampling"] = {"temperature": self.temperature_spin.value(),
+                              "max_tokens": self.max_tokens_spin.value()}
+        if params["num_ctx"]:
+            params["sampling"]["num_ctx"] = params["num_ctx"]
+        
+        if not params["api_url"] or not params["model_name"]:
             QMessageBox.warning(self, "提示", "请填写API地址和模型名称")
             return
-            
-        # 准备生成
-        self.result_display.append("\n\n" + "="*50 + "\n")
-        self.result_display.append(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 开始生成...\n")
         
-        # 启动API调用线程
-        self.api_thread = ApiCallThread(
-            api_type, api_url, api_key, prompt, 
-            model_name, api_format, custom_headers
-        )
-        self.api_thread.progress.connect(self.update_progress)
-        self.api_thread.finished.connect(self.on_generation_finished)
-        self.api_thread.error.connect(self.on_generation_error)
-        self.api_thread.start()
+        instruction = prompt
+        memory_budget, retrieval_budget = self._context_budgets(settings, params)
+        if use_memory:
+            prompt = self._get_story_memory().build_prompt(
+                prompt,
+                budget_tokens=memory_budget,
+                recent_paragraphs=settings["memory_recent_paragraphs"]
+            )
+        
+        # 检索相关前文放在提示最前面；提示中已有的片段（如故事记忆的最近原文）不重复加入
+        retrieved = ""
+        if self.retrieval_checkbox.isChecked():
+            retrieved = self._retrieve_context(instruction, prompt, settings, retrieval_budget)
+            if prompt:
+                prompt = retrieved + prompt
+        
+        # 会话续写：有可复用的context时只发送本次的写作要求，失败时再用完整提示重试
+        session = None
+        if use_session and supports_context(api_type, params["api_format"]):
+            key = self._session_key()
+            self.context_sessions.max_tokens = settings["context_max_tokens"]
+            context = self.context_sessions.get(key, params["model_name"])
+            session = (key, prompt, context is not None)
+            if context is not None:
+                params["context"] = context
+                prompt = retrieved + (instruction or "紧接上文继续写下去")
+        if not prompt:
+            QMessageBox.warning(self, "提示", "请输入写作提示")
+            return
+        
+        # 发送前检查提示长度：超出上下文窗口时Ollama会静默截掉开头，云端接口则直接报错
+        prompt, trim_note = self._check_prompt_size(prompt, params, settings)
+        if prompt is None:
+            return
+        if session is not None and not session[2]:
+            session = (session[0], prompt, False)
+        
+        variants = self.variants_spin.value()
+        run = None
+        if self.target_length_spin.value() and variants == 1:
+            # 分段生成：第一段也按目标长度请求，续写时以完整提示为基础
+            run = LengthRun(session[1] if session is not None else prompt,
+                            self.target_length_spin.value(), params["sampling"]["max_tokens"])
+            params["sampling"]["max_tokens"] = run.next_max_tokens()
+        if variants > 1:
+            if self._variants_active():
+                QMessageBox.warning(self, "提示", "请先选择或停止当前的候选")
+                return
+            job_ids = self.job_queue.submit_variants(
+                prompt, params, variants,
+                priority=self.priority_spin.value(),
+                cache=self._get_response_cache()
+            )
+            for old_id in self._variant_jobs:
+                # 上一组未选择的候选不再保存
+                self._forget_job(old_id)
+            self._variant_jobs = job_ids
+            self.variant_panel.set_jobs(job_ids)
+            self.variant_panel.setVisible(True)
+        else:
+            if not self._variants_active():
+                self.variant_panel.setVisible(False)
+            job_ids = [self.job_queue.submit(
+                prompt, params,
+                priority=self.priority_spin.value(),
+                cache=self._get_response_cache()
+            )]
+        job_id = job_ids[0]
+        if run is not None:
+            run.job_ids.append(job_id)
+            self._length_runs[job_id] = run
+        if session is not None:
+            for submitted in job_ids:
+                self._session_jobs[submitted] = session
+        if self.project is not None:
+            # 按提交时的章节保存，生成过程中切换章节不影响
+            for submitted in job_ids:
+                self._project_jobs[submitted] = self._current_chapter_id()
         
         # 更新UI状态
-        self.generate_button.setEnabled(False)
         self.stop_button.setEnabled(True)
-        self.progress_bar.setVisible(True)
-        self.progress_bar.setValue(0)
-        self.statusBar.showMessage("正在生成内容...")
+        if not self.progress_bar.isVisible():
+            self.progress_bar.setVisible(True)
+            self.progress_bar.setValue(0)
+        self._flush_timer.start()
+        if use_memory:
+            self._memory_jobs.update(job_ids)
+        if variants > 1:
+            message = f"{variants}个候选已加入队列，选中一个后其余立即停止"
+        elif run is not None:
+            message = f"任务#{job_id} 已加入队列（目标{run.target_chars}字，分段生成）"
+        else:
+            message = f"任务#{job_id} 已加入队列"
+        self.statusBar.showMessage(message + (f"；{trim_note}" if trim_note else ""))
+    
+    def _context_budgets(self, settings, params):
+        """本次使用的故事记忆和引用前文的token预算，返回(记忆预算, 引用前文预算)
+
+        两者合计不超过提示可用token数的CONTEXT_PROMPT_SHARE，超出时按比例缩小，
+        上下文窗口较小的模型（如默认num_ctx的Ollama）按默认设置续写时提示不会超出窗口。
+        记忆和检索按每个汉字一个token估算预算，分词更碎的模型按其每个汉字的token数折算。
+        """
+        memory = settings["memory_budget_tokens"] if self.memory_checkbox.isChecked() else 0
+        retrieval = settings["retrieval_budget_tokens"] if self.retrieval_checkbox.isChecked() else 0
+        window = context_window(params["api_type"], params["model_name"], params["api_format"], params["num_ctx"])
+        available = int(prompt_budget(window, self.max_tokens_spin.value()) * CONTEXT_PROMPT_SHARE
+                        / max(1.0, model_family(params["model_name"])[2]))
+        if memory + retrieval <= available:
+            return memory, retrieval
+        scale = available / (memory + retrieval)
+        return int(memory * scale), int(retrieval * scale)
+    
+    def _prompt_size(self, prompt, params):
+        """估算提示（加上复用的context）的token数，返回(token数, 上下文窗口, 提示可用的token数)"""
+        tokens = get_token_estimator().count(prompt, params["model_name"]) + len(params.get("context") or [])
+        window = context_window(params["api_type"], params["model_name"], params["api_format"], params["num_ctx"])
+        return tokens, window, prompt_budget(window, self.max_tokens_spin.value())
+    
+    def _check_prompt_size(self, prompt, params, settings):
+        """提示超出上下文窗口时按设置自动截去开头或询问，返回(要发送的提示, 截断说明)，取消时提示为None"""
+        tokens, window, budget = self._prompt_size(prompt, params)
+        if tokens <= budget:
+            return prompt, None
+        if not settings["auto_trim_prompt"]:
+            answer = QMessageBox.question(
+                self, "提示过长",
+                f"提示约{tokens} token，超出了模型的上下文窗口（{window} token，预留输出后可用{budget} token），"
+                f"超出的部分会被服务端截掉或导致请求失败。\n\n"
+                f"是：截去提示开头的部分后发送\n否：仍然原样发送",
+                QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel, QMessageBox.Yes
+            )
+            if answer == QMessageBox.Cancel:
+                return None, None
+            if answer == QMessageBox.No:
+                return prompt, None
+        trimmed = get_token_estimator().trim(prompt, budget - len(params.get("context") or []), params["model_name"])
+        if not trimmed.strip():
+            return prompt, None  # 复用的context已占满窗口，截断提示也无济于事
+        return trimmed, f"提示约{tokens} token超出上下文窗口，已截去开头{len(prompt) - len(trimmed)}字"
+    
+    def _update_prompt_estimate(self):
+        """输入停顿后估算将要发送的提示长度和提示处理耗时，超出上下文窗口时标红"""
+        settings = self._current_settings()
+        params = self._request_params(settings)
+        instruction = self.prompt_input.toPlainText().strip()
+        if not params["model_name"] or not (instruction or self.memory_checkbox.isChecked()):
+            self.prompt_estimate_label.setText("")
+            return
+        prompt = instruction
+        memory_budget, retrieval_budget = self._context_budgets(settings, params)
+        if self.memory_checkbox.isChecked():
+            prompt = self._get_story_memory().build_prompt(
+                instruction,
+                budget_tokens=memory_budget,
+                recent_paragraphs=settings["memory_recent_paragraphs"]
+            )
+        if self.session_checkbox.isChecked() and supports_context(params["api_type"], params["api_format"]):
+            context = self.context_sessions.peek(self._session_key(), params["model_name"])
+            if context is not None:
+                params["context"] = context
+                prompt = instruction
+        tokens, window, budget = self._prompt_size(prompt, params)
+        if self.retrieval_checkbox.isChecked() and self.retrieval_index is not None and len(self.retrieval_index):
+            # 引用的前文在发送时才检索，按预算上限计算
+            tokens += int(retrieval_budget * max(1.0, model_family(params["model_name"])[2]))
+        text = f"提示≈{tokens} / {window} token"
+        rate = get_telemetry().prompt_rate(params["api_type"], params["model_name"])
+        if rate:
+            text += f" · 预计提示处理{tokens / rate:.1f}秒"
+        if tokens > budget:
+            text += " · 超出上下文窗口，发送时" + ("自动截断" if settings["auto_trim_prompt"] else "将询问")
+            self.prompt_estimate_label.setStyleSheet("color: #ff8080;")
+        else:
+            self.prompt_estimate_label.setStyleSheet("color: rgba(255, 255, 255, 0.7);")
+        self.prompt_estimate_label.setText(text)
+    
+    def _request_params(self, settings):
+        """生成任务使用的API设置"""
+        api_type = settings["api_type"]
+        return {
+            "api_type": api_type,
+            "api_url": settings["api_url"],
+            "api_key": settings["api_key"],
+            "model_name": settings["model_name"],
+            "api_format": settings["api_format"] if api_type == "自定义" else None,
+            "custom_headers": settings["custom_headers"] or None,
+            "endpoints": parse_endpoints(settings["api_url"], settings["extra_endpoints"]),
+            "routing": settings["routing"],
+            "keep_alive": settings["keep_alive"],
+            "num_ctx": settings["context_window"] if supports_context(api_type, settings["api_format"]) else 0,
+            "repetition": (1 if settings["repetition_retry"] else 0) if settings["repetition_check"] else None
+        }
     
     def stop_generation(self):
-        """停止生成内容"""
-        if self.api_thread and self.api_thread.isRunning():
-            self.api_thread.running = False
+        """停止所有排队和生成中的任务"""
+        if self.job_queue.active_count():
+            self.job_queue.cancel_all()
             self.statusBar.showMessage("正在停止生成...")
     
     def clear_content(self):
@@ -324,61 +1052,1087 @@ class NovelWriterWindow(QMainWindow):
         """更新进度条"""
         self.progress_bar.setValue(value)
     
-    def on_generation_finished(self, result, status):
-        """生成完成处理"""
-        self.result_display.append(result)
-        self.result_display.append(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] 生成完成\n")
-        self._reset_generation_state()
-        self.statusBar.showMessage("生成完成")
+    def on_job_started(self, job_id):
+        """任务开始运行，加入结果区的显示顺序（候选在候选面板中显示）"""
+        if job_id in self._variant_jobs:
+            return
+        self._display_order.append(job_id)
+        self._advance_display()
+    
+    def on_job_delta(self, job_id, text):
+        """接收增量文本，只有正在显示的任务放入缓冲区，等待定时刷新"""
+        entry_id = self._journal_entries.get(job_id)
+        if entry_id is None:
+            # 首个增量到达时才建立日志，此时任务对应的章节等信息都已登记
+            entry_id = self._begin_journal(self.job_queue.get(job_id))
+        if entry_id is not None:
+            self.journal.append(entry_id, text)
+        if job_id == self._live_job_id:
+            self._delta_buffer.append(text)
+        elif job_id in self._variant_jobs:
+            self.variant_panel.append(job_id, text)
+        run = self._length_runs.get(job_id)
+        if run is not None and not run.stopping and run.break_point(self.job_queue.get(job_id).text) is not None:
+            # 已写到目标并出现自然断点，停止这一段，不再多生成
+            run.stopping = True
+            self.job_queue.stop_early(job_id)
+    
+    def on_job_rewind(self, job_id, text):
+        """撤回任务末尾已显示的文本（重复循环被截掉的部分），先从尚未刷新的缓冲中扣除"""
+        if job_id == self._live_job_id:
+            buffered = "".join(self._delta_buffer)
+            keep = max(0, len(buffered) - len(text))
+            self._delta_buffer = [buffered[:keep]] if keep else []
+            rest = text[:len(text) - (len(buffered) - keep)]
+            if rest:
+                self.result_display.remove_tail(rest)
+        elif job_id in self._variant_jobs:
+            self.variant_panel.remove_tail(job_id, text)
+    
+    def on_job_changed(self, job_id):
+        """任务进度变化时更新进度条"""
+        if job_id == self._live_job_id:
+            job = self.job_queue.get(job_id)
+            run = self._length_runs.get(job_id)
+            self.update_progress(run.progress(len(job.text)) if run is not None else job.progress)
+    
+    def on_job_finished(self, job_id):
+        """任务结束处理"""
+        job = self.job_queue.get(job_id)
+        if job_id in self._variant_jobs:
+            self._on_variant_finished(job)
+        elif self._retry_without_context(job):
+            self._advance_display()
+        elif job_id in self._length_runs:
+            self._on_length_chunk_finished(job)
+        else:
+            self._advance_display()
+            self._accept_result(job)
+            self._show_job_status(job)
+        self._show_metrics(job)
+        self._mark_model_used(job)
+        
+        if not self.job_queue.active_count():
+            self._reset_generation_state()
+    
+    def _show_job_status(self, job):
+        """在状态栏显示任务的结束状态，失败时弹出错误"""
+        job_id = job.job_id
+        if job.state == JOB_FAILED:
+            self.statusBar.showMessage(f"任务#{job_id} 生成失败")
+            QMessageBox.warning(self, "错误", job.error)
+        elif job.state == JOB_CANCELLED:
+            metrics = job.metrics
+            if metrics is not None and metrics.cancel_ms is not None:
+                self.statusBar.showMessage(f"任务#{job_id} 已取消（{metrics.cancel_ms:.0f} ms 内停止）")
+            else:
+                self.statusBar.showMessage(f"任务#{job_id} 已取消")
+        elif job.status == "cached":
+            self.statusBar.showMessage(f"任务#{job_id} 生成完成（缓存命中）")
+        elif job.status == "repetition":
+            self.statusBar.showMessage(f"任务#{job_id} 检测到重复循环，已截断重复部分")
+        else:
+            pool_stats = get_session_pool().endpoint_stats(job.params["api_url"])
+            self.statusBar.showMessage(
+                f"任务#{job_id} 生成完成（连接复用 {pool_stats['reused']}/{pool_stats['requests']}）"
+            )
+    
+    def _accept_result(self, job, text=None, prompt=None):
+        """任务结果写入故事记忆和项目；text和prompt默认取自任务，分段生成时为合并后的全文和原提示"""
+        job_id = job.job_id
+        text = job.text if text is None else text
+        if job_id in self._memory_jobs:
+            self._memory_jobs.discard(job_id)
+            if job.state == JOB_DONE and text:
+                self._get_story_memory().add_text(text)
+                self._start_memory_update(job.params)
+        
+        chapter_id = self._project_jobs.pop(job_id, None)
+        if chapter_id is not None and job.state in (JOB_DONE, JOB_CANCELLED) and text:
+            self._save_to_project(job, chapter_id, text, prompt)
+            self._index_chapter(chapter_id)
+        elif chapter_id is None and job.state == JOB_DONE and text and self.project is None:
+            self._index_text(text)
+        
+        session = self._session_jobs.pop(job_id, None)
+        if session is not None:
+            final_frame = job.final_frame
+            if job.state == JOB_DONE and final_frame and final_frame.get("context"):
+                self.context_sessions.update(session[0], job.params["model_name"], final_frame["context"])
+            else:
+                # 中断、出错或缓存命中时没有新的context，下次从完整提示重新开始
+                self.context_sessions.invalidate(session[0])
+        
+        # 结果已写入结果区和项目，不再需要日志
+        self._end_journal(job_id)
     
-    def on_generation_error(self, error_msg):
-        """生成错误处理"""
-        self.result_display.append(f"\n错误: {error_msg}\n")
-        self._reset_generation_state()
-        self.statusBar.showMessage("生成失败")
-        QMessageBox.warning(self, "错误", error_msg)
+    def _forget_job(self, job_id):
+        """不再保存该任务的结果（未选中的候选）"""
+        self._memory_jobs.discard(job_id)
+        self._project_jobs.pop(job_id, None)
+        self._session_jobs.pop(job_id, None)
+        self._end_journal(job_id)
+    
+    def _begin_journal(self, job):
+        """为正在生成的任务建立日志，返回日志编号"""
+        chapter_id = self._project_jobs.get(job.job_id)
+        meta = {
+            "job_id": job.job_id,
+            "prompt": job.prompt,
+            "api_type": job.api_type,
+            "model": job.params["model_name"],
+            "project": self.project.path if self.project is not None and chapter_id is not None else None,
+            "chapter_id": chapter_id,
+            "started_at": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        try:
+            entry_id = self._journal_entries[job.job_id] = self.journal.begin(meta)
+        except OSError as e:
+            print(f"创建生成日志失败: {e}")
+            return None
+        return entry_id
+    
+    def _end_journal(self, job_id, keep=False):
+        """任务结果已经保存（或不再需要）时删除日志；keep为True时只关闭文件"""
+        entry_id = self._journal_entries.get(job_id) if keep else self._journal_entries.pop(job_id, None)
+        if entry_id is not None:
+            self.journal.finish(entry_id, keep=keep)
+    
+    def _offer_journal_recovery(self):
+        """启动时发现上次未完成的生成，询问是否恢复"""
+        try:
+            entries = self.journal.recover()
+        except OSError as e:
+            print(f"读取生成日志失败: {e}")
+            return
+        entries = [entry for entry in entries if entry.text.strip()] or entries
+        if not entries:
+            return
+        chars = sum(len(entry.text) for entry in entries)
+        box = QMessageBox(self)
+        box.setWindowTitle("恢复生成")
+        box.setText(f"发现{len(entries)}个上次未完成的生成（共{chars}字），是否恢复？\n"
+                    "恢复的内容会显示在结果区，原本要保存到项目的会追加到对应章节。")
+        recover_button = box.addButton("恢复", QMessageBox.AcceptRole)
+        discard_button = box.addButton("丢弃", QMessageBox.DestructiveRole)
+        box.addButton("以后再说", QMessageBox.RejectRole)
+        box.exec_()
+        if box.clickedButton() is recover_button:
+            for entry in entries:
+                self._recover_entry(entry)
+                self.journal.discard(entry)
+            self.statusBar.showMessage(f"已恢复{len(entries)}个生成")
+        elif box.clickedButton() is discard_button:
+            for entry in entries:
+                self.journal.discard(entry)
+    
+    def _recover_entry(self, entry):
+        """恢复的内容显示在结果区，并合并到原来的项目章节"""
+        meta = entry.meta
+        text = entry.text.strip()
+        self.result_display.append("\n\n" + "="*50 + "\n")
+        self.result_display.append(f"[{meta.get('started_at', '')}] 恢复的生成（{meta.get('model', '')}）\n")
+        self.result_display.append(text)
+        path, chapter_id = meta.get("project"), meta.get("chapter_id")
+        if not text or not path or chapter_id is None or not os.path.exists(path):
+            return
+        from project_store import ProjectStore, ProjectError
+        try:
+            if self.project is not None and os.path.abspath(self.project.path) == os.path.abspath(path):
+                store, temporary = self.project, False
+            else:
+                store, temporary = ProjectStore.open(path), True
+            try:
+                separator = "\n\n" if store.chapter_text(chapter_id) else ""
+                store.append_text(chapter_id, separator + text)
+                store.add_generation(meta.get("prompt", ""), text, meta.get("model", ""), chapter_id,
+                                     status="recovered")
+                store.sync()
+            finally:
+                if temporary:
+                    store.close()
+            if not temporary:
+                self._index_chapter(chapter_id)
+        except (KeyError, ProjectError, OSError) as e:
+            # 章节已删除或项目无法打开，内容仍在结果区
+            print(f"恢复到项目失败: {e}")
+    
+    def _retry_without_context(self, job):
+        """带context的请求失败时，丢弃会话并用完整提示重新提交，返回是否已重试"""
+        session = self._session_jobs.get(job.job_id)
+        if job.state != JOB_FAILED or session is None or not session[2]:
+            return False
+        key, full_prompt, _ = self._session_jobs.pop(job.job_id)
+        self._end_journal(job.job_id)
+        self.context_sessions.invalidate(key)
+        params = dict(job.params)
+        params.pop("context", None)
+        new_id = self.job_queue.submit(full_prompt, params, priority=job.priority, cache=job.cache)
+        self._session_jobs[new_id] = (key, full_prompt, False)
+        if job.job_id in self._memory_jobs:
+            self._memory_jobs.discard(job.job_id)
+            self._memory_jobs.add(new_id)
+        if job.job_id in self._project_jobs:
+            self._project_jobs[new_id] = self._project_jobs.pop(job.job_id)
+        run = self._length_runs.pop(job.job_id, None)
+        if run is not None:
+            run.job_ids[run.job_ids.index(job.job_id)] = new_id
+            self._length_runs[new_id] = run
+        print(f"任务#{job.job_id} 复用上下文失败，改用完整提示重试: {job.error}")
+        self.statusBar.showMessage(f"上下文已失效，任务#{new_id} 改用完整提示重新生成")
+        return True
+    
+    def _on_length_chunk_finished(self, job):
+        """分段生成的一段结束：没写到目标时立即提交下一段，否则把各段合并保存"""
+        run = self._length_runs[job.job_id]
+        metrics = job.metrics
+        tokens = metrics.tokens if metrics is not None and metrics.token_source == "server" else None
+        kept = run.add_chunk(job.text, tokens)
+        if len(kept) < len(job.text):
+            # 断点之后、停止之前多收到的部分
+            self.on_job_rewind(job.job_id, job.text[len(kept):])
+        if job.state == JOB_DONE and run.should_continue():
+            run.last_done = job
+            # 先提交下一段再更新显示和日志，两段之间不留空档
+            next_id = self._submit_length_chunk(run, job)
+            self._end_journal(job.job_id, keep=True)
+            self._advance_display()
+            self.statusBar.showMessage(f"已写{run.written}/{run.target_chars}字，任务#{next_id} 继续生成")
+            return
+        self._advance_display()
+        self._finish_length_run(run, job)
+    
+    def _submit_length_chunk(self, run, job):
+        """提交分段生成的下一段，返回任务号"""
+        params = dict(job.params)
+        params["sampling"] = dict(params.get("sampling") or {}, max_tokens=run.next_max_tokens())
+        params.pop("context", None)
+        prompt = run.next_prompt()
+        context = (job.final_frame or {}).get("context")
+        if context and job.status != "repetition" and len(context) <= self._current_settings()["context_max_tokens"]:
+            # Ollama：上一段返回的上下文已包含提示和全部正文，只需要求继续，不必重新处理提示
+            params["context"] = context
+            prompt = CONTINUE_INSTRUCTION
+        run.submitting = True
+        next_id = self.job_queue.submit(prompt, params, priority=job.priority, cache=job.cache)
+        run.job_ids.append(next_id)
+        self._length_runs[next_id] = run
+        run.submitting = False
+        return next_id
+    
+    def _finish_length_run(self, run, job):
+        """分段生成结束：各段合并为一次生成写入记忆和项目（登记在第一段上的信息转到最后一段）"""
+        accepted = job
+        if job.state == JOB_FAILED and run.last_done is not None:
+            # 这一段失败，之前写好的各段照常保存（保留任务本身，不依赖它是否还在队列中）
+            accepted = run.last_done
+        first = run.job_ids[0]
+        if first != accepted.job_id:
+            if first in self._memory_jobs:
+                self._memory_jobs.discard(first)
+                self._memory_jobs.add(accepted.job_id)
+            for registry in (self._project_jobs, self._session_jobs):
+                if first in registry:
+                    registry[accepted.job_id] = registry.pop(first)
+        for job_id in run.job_ids:
+            self._length_runs.pop(job_id, None)
+            if job_id != accepted.job_id:
+                self._end_journal(job_id)
+        self._accept_result(accepted, run.text, run.prompt)
+        self._show_job_status(job)
+        if job.state == JOB_DONE:
+            self.statusBar.showMessage(f"分段生成完成：共{run.written}字，{len(run.chunks)}段")
+    
+    def _session_key(self):
+        """会话按章节区分，未打开项目时所有续写共用一个会话"""
+        if self.project is not None and self._current_chapter_id() is not None:
+            return f"{self.project.path}#{self._current_chapter_id()}"
+        return "default"
+    
+    def _variants_active(self):
+        """当前这组候选是否还有在生成的（已从队列清除的候选按已结束处理）"""
+        return any(job is not None and job.is_active for job in map(self.job_queue.get, self._variant_jobs))
+    
+    def pick_variant(self, job_id):
+        """选中一个候选：其余候选立即停止，选中的候选结束后写入结果区"""
+        job = self.job_queue.get(job_id)
+        if job is None:
+            self.statusBar.showMessage(f"候选任务#{job_id} 已从队列中清除")
+            return
+        self.job_queue.pick(job_id)
+        if not job.is_active:
+            self._commit_variant(job)
+        else:
+            self.statusBar.showMessage(f"已选择候选任务#{job_id}，其余候选已停止")
+    
+    def _on_variant_finished(self, job):
+        """候选结束：选中的写入结果区，未选中的不保存"""
+        group = self.job_queue.group_jobs(job.group)
+        if job.picked:
+            self._commit_variant(job)
+        elif any(other.picked for other in group):
+            # 已有其他候选被选中，本候选不写入记忆和项目
+            self._forget_job(job.job_id)
+        elif job.state == JOB_FAILED:
+            self._end_journal(job.job_id)
+            self.statusBar.showMessage(f"候选任务#{job.job_id} 生成失败: {job.error}")
+        else:
+            # 等待选择期间保留日志，崩溃后仍可找回
+            self._end_journal(job.job_id, keep=True)
+            if not any(other.is_active for other in group):
+                self.statusBar.showMessage("候选已全部生成完成，请选择一个")
+    
+    def _commit_variant(self, job):
+        """把选中的候选写入结果区、故事记忆和项目，同组其余候选丢弃"""
+        for other in self.job_queue.group_jobs(job.group):
+            if other is not job:
+                self._forget_job(other.job_id)
+        self._flush_delta_buffer()
+        index = self._variant_jobs.index(job.job_id) + 1 if job.job_id in self._variant_jobs else 0
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.result_display.append("\n\n" + "="*50 + "\n")
+        self.result_display.append(f"[{now}] 任务#{job.job_id}（候选{index}）\n")
+        self.result_display.append(job.text)
+        self._accept_result(job)
+        self.statusBar.showMessage(f"候选{index}已写入结果")
+    
+    def _jobs_in_use(self):
+        """还在等待显示、等待选择候选或属于进行中的分段生成的任务，清除已结束的任务时保留"""
+        return set(self._display_order) | set(self._variant_jobs) | set(self._length_runs)
+    
+    def _advance_display(self):
+        """按开始顺序显示任务：队首任务实时流式显示，结束后轮到下一个"""
+        while self._display_order:
+            job = self.job_queue.get(self._display_order[0])
+            run = self._length_runs.get(job.job_id)
+            if self._live_job_id != job.job_id:
+                self._flush_delta_buffer()
+                if run is None or run.job_ids[0] == job.job_id:
+                    # 分段生成的后续各段紧接上一段显示
+                    self.result_display.append("\n\n" + "="*50 + "\n")
+                    started = datetime.fromtimestamp(job.started_at).strftime('%Y-%m-%d %H:%M:%S')
+                    self.result_display.append(f"[{started}] 任务#{job.job_id} 开始生成...\n")
+                    self.result_display.append("")
+                self._live_job_id = job.job_id
+                # 切换到该任务前已收到的文本先整体补上
+                self._delta_buffer = [job.text] if job.text else []
+                self.update_progress(job.progress)
+            if job.is_active or (run is not None and run.submitting):
+                # 分段生成的下一段正在提交（可能在提交过程中就开始），等登记后再接着显示
+                break
+            
+            self._flush_delta_buffer()
+            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            if run is not None and run.job_ids[-1] != job.job_id:
+                # 分段生成的中间各段不加结束标记，下一段接着显示
+                footer = None
+            elif job.state == JOB_FAILED:
+                footer = f"\n错误: {job.error}\n"
+            elif job.state == JOB_CANCELLED:
+                footer = f"\n[{now}] 生成已停止\n"
+            elif run is not None:
+                footer = f"\n[{now}] 生成完成（共{run.written}字，{len(run.chunks)}段）\n"
+            else:
+                footer = f"\n[{now}] 生成完成\n"
+            if footer is not None:
+                self.result_display.append(footer)
+            self._display_order.pop(0)
+            self._live_job_id = None
+    
+    def _flush_delta_buffer(self):
+        """将缓冲的增量文本追加到结果区末尾"""
+        if not self._delta_buffer:
+            return
+        text = "".join(self._delta_buffer)
+        self._delta_buffer = []
+        self.result_display.append_text(text)
+    
+    def _show_metrics(self, job):
+        """在状态栏显示任务的首字延迟和生成速度，统计页打开时同步刷新"""
+        metrics = job.metrics
+        if metrics is not None and metrics.status in ("success", "cancelled") and metrics.ttft_ms is not None:
+            text = f"首字 {metrics.ttft_ms:.0f} ms"
+            if metrics.tokens_per_sec is not None:
+                estimated = "≈" if metrics.token_source == "estimate" else ""
+                text += f" · {estimated}{metrics.tokens_per_sec:.1f} token/s"
+            if metrics.prompt_eval_ms is not None:
+                text += f" · 提示处理 {metrics.prompt_eval_ms:.0f} ms"
+            self.telemetry_label.setText(f"{metrics.model_name}：{text}")
+        if self.telemetry_panel is not None and self.tabs.currentWidget() is self.stats_tab:
+            self.telemetry_panel.refresh()
     
     def _reset_generation_state(self):
-        """重置生成状态"""
-        self.generate_button.setEnabled(True)
+        """所有任务结束后重置生成状态"""
+        self._flush_delta_buffer()
+        self._flush_timer.stop()
         self.stop_button.setEnabled(False)
         self.progress_bar.setVisible(False)
-        self.api_thread = None
     
-    def save_settings(self):
-        """保存设置"""
-        settings = {
+    def _settings_from_widgets(self):
+        """从设置控件读取当前设置"""
+        return {
             "api_type": self.api_type_combo.currentText(),
             "api_url": self.api_url_input.text().strip(),
             "api_key": self.api_key_input.text().strip(),
             "model_name": self.model_name_input.text().strip(),
             "api_format": self.api_format_combo.currentText(),
-            "custom_headers": self.custom_headers_input.toPlainText().strip()
+            "custom_headers": self.custom_headers_input.toPlainText().strip(),
+            "extra_endpoints": self.extra_endpoints_input.toPlainText().strip(),
+            "routing": self.routing_combo.currentData(),
+            "pool_size": self.pool_size_spin.value(),
+            "connect_timeout": self.connect_timeout_spin.value(),
+            "first_byte_timeout": self.first_byte_timeout_spin.value(),
+            "read_timeout": self.read_timeout_spin.value(),
+            "enable_cache": self.cache_checkbox.isChecked(),
+            "concurrency": {api_type: spin.value() for api_type, spin in self.concurrency_spins.items()},
+            "rate_limits": {api_type: {"rpm": rpm.value(), "tpm": tpm.value()}
+                            for api_type, (rpm, tpm) in self.rate_limit_spins.items()},
+            "use_async": self.async_checkbox.isChecked(),
+            "memory_budget_tokens": self.memory_budget_spin.value(),
+            "memory_recent_paragraphs": self.memory_paragraphs_spin.value(),
+            "keep_alive": self.keep_alive_input.text().strip(),
+            "context_max_tokens": self.context_max_spin.value(),
+            "context_window": self.context_window_spin.value(),
+            "auto_trim_prompt": self.auto_trim_checkbox.isChecked(),
+            "auto_warmup": self.warmup_checkbox.isChecked(),
+            "repetition_check": self.repetition_checkbox.isChecked(),
+            "repetition_retry": self.repetition_retry_checkbox.isChecked(),
+            "retrieval_top_k": self.retrieval_top_k_spin.value(),
+            "retrieval_budget_tokens": self.retrieval_budget_spin.value(),
+            "embedding_model": self.embedding_model_input.text().strip(),
+            "embedding_url": self.embedding_url_input.text().strip()
         }
+    
+    def _current_settings(self):
+        """当前生效的设置：设置页已创建时以控件为准（包括未保存的修改）"""
+        self._ensure_settings_loaded()
+        if self._settings_tab_built:
+            return self._settings_from_widgets()
+        return self.settings
+    
+    def save_settings(self):
+        """保存设置"""
+        self.settings = self._settings_from_widgets()
+        self._apply_settings(self.settings)
         
         try:
-            with open("settings.json", "w") as f:
-                json.dump(settings, f, ensure_ascii=False, indent=2)
+            with open(SETTINGS_FILE, "w") as f:
+                json.dump(self.settings, f, ensure_ascii=False, indent=2)
             QMessageBox.information(self, "成功", "设置已保存")
             self.statusBar.showMessage("设置已保存")
         except Exception as e:
             QMessageBox.warning(self, "错误", f"保存设置失败: {str(e)}")
+        self._schedule_warmup()
+    
+    def _ensure_settings_loaded(self):
+        """后台加载尚未完成时等待其完成（只在真正需要设置时才会阻塞）"""
+        if not self._settings_loaded:
+            self._settings_loader.wait()
+            self._on_settings_loaded(self._settings_loader.settings)
+    
+    def _on_settings_loaded(self, settings):
+        """后台加载完成，合并默认值后应用"""
+        if self._settings_loaded:
+            return
+        self._settings_loaded = True
+        merged = json.loads(json.dumps(DEFAULT_SETTINGS))
+        merged.update(settings)
+        self.settings = merged
+        self._apply_settings(self.settings)
+        if self._settings_tab_built:
+            self._populate_settings_widgets(self.settings)
+        self._schedule_warmup()
+    
+    def _populate_settings_widgets(self, settings):
+        """把设置填入设置控件"""
+        self.api_type_combo.setCurrentText(settings["api_type"])
+        self.api_url_input.setText(settings["api_url"])
+        self.api_key_input.setText(settings["api_key"])
+        self.model_name_input.setText(settings["model_name"])
+        self.api_format_combo.setCurrentText(settings["api_format"])
+        self.custom_headers_input.setText(settings["custom_headers"])
+        self.extra_endpoints_input.setPlainText(settings["extra_endpoints"])
+        index = self.routing_combo.findData(settings["routing"])
+        self.routing_combo.setCurrentIndex(max(0, index))
+        self.pool_size_spin.setValue(settings["pool_size"])
+        self.connect_timeout_spin.setValue(settings["connect_timeout"])
+        self.first_byte_timeout_spin.setValue(settings["first_byte_timeout"])
+        self.read_timeout_spin.setValue(settings["read_timeout"])
+        self.cache_checkbox.setChecked(settings["enable_cache"])
+        self.async_checkbox.setChecked(settings["use_async"])
+        self.memory_budget_spin.setValue(settings["memory_budget_tokens"])
+        self.memory_paragraphs_spin.setValue(settings["memory_recent_paragraphs"])
+        self.keep_alive_input.setText(str(settings["keep_alive"]))
+        self.context_max_spin.setValue(settings["context_max_tokens"])
+        self.context_window_spin.setValue(settings["context_window"])
+        self.auto_trim_checkbox.setChecked(settings["auto_trim_prompt"])
+        self.warmup_checkbox.setChecked(settings["auto_warmup"])
+        self.repetition_checkbox.setChecked(settings["repetition_check"])
+        self.repetition_retry_checkbox.setChecked(settings["repetition_retry"])
+        self.retrieval_top_k_spin.setValue(settings["retrieval_top_k"])
+        self.retrieval_budget_spin.setValue(settings["retrieval_budget_tokens"])
+        self.embedding_model_input.setText(settings["embedding_model"])
+        self.embedding_url_input.setText(settings["embedding_url"])
+        for api_type, limit in settings["concurrency"].items():
+            if api_type in self.concurrency_spins:
+                self.concurrency_spins[api_type].setValue(limit)
+        for api_type, limit in settings["rate_limits"].items():
+            if api_type in self.rate_limit_spins:
+                rpm, tpm = self.rate_limit_spins[api_type]
+                rpm.setValue(limit.get("rpm", 0))
+                tpm.setValue(limit.get("tpm", 0))
     
-    def load_settings(self):
-        """加载设置"""
-        if os.path.exists("settings.json"):
+    def _apply_settings(self, settings):
+        """将连接池、并发和引擎设置应用到运行中的组件"""
+        get_session_pool().configure(
+            pool_size=settings["pool_size"],
+            connect_timeout=settings["connect_timeout"],
+            read_timeout=settings["read_timeout"],
+            first_byte_timeout=settings["first_byte_timeout"]
+        )
+        for api_type, limit in settings["concurrency"].items():
+            self.job_queue.set_limit(api_type, limit)
+        for api_type, limit in settings["rate_limits"].items():
+            get_rate_limiter().configure(api_type, limit.get("rpm", 0), limit.get("tpm", 0))
+        self.job_queue.use_async = settings["use_async"]
+        # 不再配置的端点列表不再做健康检查
+        prune_routers(parse_endpoints(settings["api_url"], settings["extra_endpoints"]))
+        if self.retrieval_index is not None:
+            self.retrieval_index.set_embedding_model(settings["embedding_model"])
+            self._schedule_embeddings()
+    
+    def _get_response_cache(self):
+        """启用缓存时返回共享的响应缓存，首次使用时创建"""
+        if not self._current_settings()["enable_cache"]:
+            return None
+        if self.response_cache is None:
             try:
-                with open("settings.json", "r") as f:
-                    settings = json.load(f)
-                
-                self.api_type_combo.setCurrentText(settings.get("api_type", "Ollama"))
-                self.api_url_input.setText(settings.get("api_url", ""))
-                self.api_key_input.setText(settings.get("api_key", ""))
-                self.model_name_input.setText(settings.get("model_name", ""))
-                self.api_format_combo.setCurrentText(settings.get("api_format", "OpenAI格式"))
-                self.custom_headers_input.setText(settings.get("custom_headers", ""))
+                # 延迟导入，未启用缓存时不加载sqlite3
+                from response_cache import ResponseCache
+                self.response_cache = ResponseCache()
             except Exception as e:
-                print(f"加载设置失败: {e}")
+                print(f"打开响应缓存失败: {e}")
+                return None
+        return self.response_cache
+    
+    def probe_endpoints(self):
+        """检查后端池中每个端点是否可用及其延迟"""
+        settings = self._settings_from_widgets()
+        urls = parse_endpoints(settings["api_url"], settings["extra_endpoints"])
+        if not urls:
+            QMessageBox.warning(self, "提示", "请填写API地址")
+            return
+        self.probe_button.setEnabled(False)
+        self.statusBar.showMessage("正在检测端点...")
+        self._probe_thread = EndpointProbeThread(get_router(urls, settings["routing"]))
+        self._probe_thread.finished.connect(self._on_probe_finished)
+        self._probe_thread.start()
+    
+    def _on_probe_finished(self, results):
+        """显示端点检测结果"""
+        self.probe_button.setEnabled(True)
+        lines = []
+        for item in results:
+            if item["healthy"]:
+                lines.append(f"✔ {item['url']}  {item['probe_ms']:.0f} ms，进行中 {item['outstanding']}")
+            else:
+                lines.append(f"✘ {item['url']}  {item['last_error']}")
+        self.statusBar.showMessage("端点检测完成")
+        QMessageBox.information(self, "端点状态", "\n".join(lines))
+    
+    def _schedule_warmup(self, *args):
+        """设置变化后稍等再预热，连续修改只预热一次"""
+        if self._settings_loaded and self._current_settings()["auto_warmup"]:
+            self._warmup_timer.start()
+        self._update_model_state_label()
+    
+    def warm_up_model(self, force=False):
+        """在后台预热当前模型；已就绪的模型只在手动预热时重新加载"""
+        params = self._request_params(self._current_settings())
+        if not params["api_url"] or not params["model_name"]:
+            return
+        if self._warmup_thread is not None and self._warmup_thread.isRunning():
+            # 正在预热旧的设置，结束后按最新设置再预热一次
+            self._warmup_pending = True
+            return
+        if not force:
+            tracker = get_warmup_tracker()
+            keys = [model_key(params["api_type"], url, params["model_name"]) for url in params["endpoints"]]
+            if all(tracker.state(key)[0] == STATE_WARM for key in keys):
+                self._update_model_state_label()
+                return
+        self._warmup_pending = False
+        if self._settings_tab_built:
+            self.warmup_button.setEnabled(False)
+        self._warmup_thread = ModelWarmupThread(params)
+        self._warmup_thread.finished.connect(self._on_warmup_finished)
+        self._warmup_thread.start()
+        self._update_model_state_label()
+    
+    def _on_warmup_finished(self, results):
+        """显示预热结果"""
+        if self._settings_tab_built:
+            self.warmup_button.setEnabled(True)
+        failed = [item for item in results if not item["ok"]]
+        if failed:
+            print(f"模型预热失败: {failed[0]['url']} {failed[0]['error']}")
+            self.statusBar.showMessage(f"模型预热失败: {failed[0]['error']}")
+        elif results:
+            slowest = max(item["ms"] for item in results)
+            self.statusBar.showMessage(f"模型已就绪（{slowest / 1000:.1f} 秒）")
+        self._update_model_state_label()
+        if self._warmup_pending:
+            self._warmup_pending = False
+            self.warm_up_model()
+    
+    def _mark_model_used(self, job):
+        """生成成功说明模型已加载，并重新计算keep_alive的到期时间"""
+        if job.state != JOB_DONE or job.status == "cached" or job.metrics is None:
+            return
+        p = job.params
+        keep_alive = p.get("keep_alive") if supports_preload(p["api_type"], p.get("api_format")) else -1
+        get_warmup_tracker().mark_warm(model_key(p["api_type"], job.metrics.endpoint, p["model_name"]),
+                                       keep_alive=keep_alive)
+        self._update_model_state_label()
+    
+    def _update_model_state_label(self):
+        """在状态栏显示当前模型的冷热状态（后端池中最差的一个端点）"""
+        if not self._settings_loaded:
+            return
+        settings = self._current_settings()
+        model_name = settings["model_name"]
+        urls = parse_endpoints(settings["api_url"], settings["extra_endpoints"])
+        if not urls or not model_name:
+            self.model_state_label.setText("")
+            return
+        tracker = get_warmup_tracker()
+        states = [tracker.state(model_key(settings["api_type"], url, model_name)) for url in urls]
+        names = [state for state, _ in states]
+        if STATE_FAILED in names:
+            text = "预热失败"
+        elif STATE_WARMING in names:
+            text = "正在加载…"
+        elif all(state == STATE_WARM for state in names):
+            load_ms = [ms for _, ms in states if ms is not None]
+            text = f"已就绪（加载 {max(load_ms) / 1000:.1f} 秒）" if load_ms else "已就绪"
+        else:
+            text = "未加载"
+        self.model_state_label.setText(f"模型 {model_name}：{text}")
+    
+    def _get_story_memory(self):
+        """故事记忆，首次使用时从文件加载"""
+        if self.story_memory is None:
+            self.story_memory = StoryMemory.load(STORY_MEMORY_FILE)
+        return self.story_memory
+    
+    def _start_memory_update(self, params):
+        """在后台生成待生成的概要；已在运行时等它结束后再跑一次"""
+        if not self.story_memory.needs_update():
+            self._update_memory_label()
+            return
+        if self._memory_thread is not None and self._memory_thread.isRunning():
+            self._memory_params = params
+            return
+        self._memory_params = None
+        self._memory_thread = StoryMemoryThread(self.story_memory, params)
+        self._memory_thread.finished.connect(self._on_memory_updated)
+        self._memory_thread.error.connect(self._on_memory_error)
+        self._memory_thread.start()
+        self._update_memory_label()
+    
+    def _on_memory_updated(self, status):
+        """概要生成结束"""
+        self._update_memory_label()
+        if status == "success" and self._memory_params is not None:
+            self._start_memory_update(self._memory_params)
+    
+    def _on_memory_error(self, message):
+        """概要生成失败不影响写作，待生成的章节留到下次生成完成时重试"""
+        print(f"生成故事记忆概要失败: {message}")
+        self._memory_params = None
+        self._update_memory_label()
+        self.statusBar.showMessage(f"故事记忆更新失败: {message}")
+    
+    def _update_memory_label(self):
+        """显示故事记忆的状态"""
+        if not self.memory_checkbox.isChecked():
+            self.memory_label.setText("")
+            return
+        stats = self._get_story_memory().stats()
+        text = f"记忆：{stats['total_chars']}字，{stats['chapters']}章已概要"
+        if stats["pending"]:
+            updating = self._memory_thread is not None and self._memory_thread.isRunning()
+            text += f"，{stats['pending']}章{'正在概要' if updating else '待概要'}"
+        self.memory_label.setText(text)
+    
+    def _retrieval_index_path(self):
+        """打开项目时使用项目旁的索引，否则使用不在项目中的生成结果的索引"""
+        from retrieval_index import INDEX_SUFFIX, RETRIEVAL_INDEX_FILE
+        return self.project.path + INDEX_SUFFIX if self.project is not None else RETRIEVAL_INDEX_FILE
+    
+    def _load_retrieval_index(self):
+        """在后台读取（并按项目章节更新）检索索引，完成前生成时不引用前文"""
+        if self._index_thread is not None and self._index_thread.isRunning():
+            self._index_thread.cancel()
+            self._index_thread.wait()
+        if self._embed_thread is not None and self._embed_thread.isRunning():
+            self._embed_thread.cancel()
+        self.retrieval_index = None
+        self._query_vector = (None, None)
+        chapters = None
+        if self.project is not None:
+            # 正文在界面线程中读出，后台线程不访问项目文件；加载期间新写入的内容在加载完成后补齐
+            chapters = [(chapter_id, size, self.project.chapter_text(chapter_id))
+                        for chapter_id, _, size in self.project.chapters()]
+        self._index_thread = RetrievalIndexThread(self._retrieval_index_path(), chapters)
+        self._index_thread.finished.connect(self._on_retrieval_index_loaded)
+        self._index_thread.start()
+    
+    def _on_retrieval_index_loaded(self, index):
+        """索引就绪：补入加载期间的生成结果，开始计算缺少的向量"""
+        if index.path != self._retrieval_index_path():
+            return  # 加载期间已切换项目
+        self.retrieval_index = index
+        if self.project is None:
+            for text in self._unindexed_texts:
+                index.add_text("generation", text)
+        else:
+            # 加载期间保存到项目的内容
+            index.sync_project(self.project)
+        self._unindexed_texts = []
+        index.set_embedding_model(self._current_settings()["embedding_model"])
+        self._schedule_embeddings()
+    
+    def _save_retrieval_index(self):
+        index = self.retrieval_index
+        if index is None or not index.dirty:
+            return
+        try:
+            index.save()
+        except OSError as e:
+            print(f"保存检索索引失败: {e}")
+    
+    def _index_chapter(self, chapter_id):
+        """章节正文有新内容，只索引新增的部分"""
+        index = self.retrieval_index
+        if index is None or self.project is None:
+            return
+        try:
+            size = dict((cid, size) for cid, _, size in self.project.chapters())[chapter_id]
+            index.sync_source(f"chapter:{chapter_id}", size, lambda: self.project.chapter_text(chapter_id))
+        except KeyError:
+            return
+        self._schedule_embeddings()
+        self._query_embed_timer.start()
+    
+    def _index_text(self, text):
+        """不在项目中的生成结果加入索引"""
+        if self.retrieval_index is None:
+            self._unindexed_texts.append(text)
+            return
+        self.retrieval_index.add_text("generation", text)
+        self._schedule_embeddings()
+        self._query_embed_timer.start()
+    
+    def _retrieval_query(self, instruction):
+        """检索查询：写作要求 + 最近的正文（故事记忆的最近原文或当前章节末尾）"""
+        tail = ""
+        if self.memory_checkbox.isChecked():
+            tail = self._get_story_memory().recent_text
+        elif self.project is not None and self._current_chapter_id() is not None:
+            try:
+                tail = self.project.chapter_text(self._current_chapter_id())
+            except KeyError:
+                pass
+        from retrieval_index import QUERY_TAIL_CHARS
+        return (instruction + "\n" + tail[-QUERY_TAIL_CHARS:]).strip()
+    
+    def _retrieve_context(self, instruction, prompt, settings, budget_tokens):
+        """检索相关前文，返回要放在提示前面的部分（没有时为空）"""
+        index = self.retrieval_index
+        if index is None or not len(index):
+            return ""
+        query = self._retrieval_query(instruction)
+        if not query:
+            return ""
+        cached_query, vector = self._query_vector
+        snippets = index.search(
+            query, top_k=settings["retrieval_top_k"], budget_tokens=budget_tokens,
+            exclude=prompt, query_vector=vector if cached_query == query else None
+        )
+        from retrieval_index import format_context
+        return format_context(snippets)
+    
+    def _schedule_embeddings(self):
+        """配置了向量模型时，在后台为还没有向量的片段计算向量"""
+        index = self.retrieval_index
+        if index is None or (self._embed_thread is not None and self._embed_thread.isRunning()):
+            return
+        settings = self._current_settings()
+        from retrieval_index import EMBED_BATCH
+        pending = index.pending_embeddings(EMBED_BATCH)
+        if not pending or not settings["embedding_url"]:
+            return
+        pids = [pid for pid, _ in pending]
+        self._embed_thread = EmbeddingThread(settings["embedding_url"], index.embedding_model,
+                                             [text for _, text in pending])
+        self._embed_thread.finished.connect(
+            lambda vectors, index=index, model=index.embedding_model: self._on_embeddings_ready(
+                index, model, pids, vectors))
+        self._embed_thread.error.connect(self._on_embedding_error)
+        self._embed_thread.start()
+    
+    def _on_embeddings_ready(self, index, model, pids, vectors):
+        index.set_vectors(pids, vectors, model)
+        if index is not self.retrieval_index:
+            return
+        if index.pending_embeddings(1):
+            QTimer.singleShot(0, self._schedule_embeddings)
+        else:
+            self._save_retrieval_index()
+    
+    def _on_embedding_error(self, message):
+        """向量服务不可用时只用关键词检索，下次有新内容时再试"""
+        print(f"计算向量失败: {message}")
+        self.statusBar.showMessage(f"向量模型不可用，只用关键词检索: {message}")
+    
+    def _prefetch_query_vector(self):
+        """写作要求停止修改后在后台计算查询向量，生成时直接使用"""
+        index = self.retrieval_index
+        if index is None or not index.embedding_model or not self.retrieval_checkbox.isChecked():
+            return
+        if self._query_embed_thread is not None and self._query_embed_thread.isRunning():
+            self._query_embed_timer.start()  # 上一次还没完成，稍后再试
+            return
+        query = self._retrieval_query(self.prompt_input.toPlainText().strip())
+        settings = self._current_settings()
+        if not query or query == self._query_vector[0] or not settings["embedding_url"]:
+            return
+        self._query_embed_thread = EmbeddingThread(settings["embedding_url"], index.embedding_model, [query])
+        self._query_embed_thread.finished.connect(
+            lambda vectors, query=query: self._on_query_vector(query, vectors))
+        self._query_embed_thread.start()
+    
+    def _on_query_vector(self, query, vectors):
+        if vectors:
+            self._query_vector = (query, vectors[0])
+    
+    def clear_story_memory(self):
+        """清空故事记忆"""
+        reply = QMessageBox.question(self, "确认", "确定要清空故事记忆吗？已生成的概要将被删除。")
+        if reply != QMessageBox.Yes:
+            return
+        if self._memory_thread is not None and self._memory_thread.isRunning():
+            self._memory_thread.cancel()
+            self._memory_thread.wait()
+        self._memory_params = None
+        self._get_story_memory().clear()
+        self.context_sessions.clear()
+        self._update_memory_label()
+        self.statusBar.showMessage("故事记忆已清空")
+    
+    def open_project(self):
+        """打开项目文件，文件不存在时新建"""
+        from project_store import ProjectStore, ProjectError, PROJECT_SUFFIX  # 只在使用项目时加载
+        path, _ = QFileDialog.getSaveFileName(
+            self, "打开或新建项目", "", f"小说项目 (*{PROJECT_SUFFIX})",
+            options=QFileDialog.DontConfirmOverwrite
+        )
+        if not path:
+            return
+        try:
+            # 只读取索引和章节信息，正文在查看时才读
+            project = ProjectStore.open(path)
+        except (ProjectError, OSError) as e:
+            QMessageBox.warning(self, "错误", f"打开项目失败: {str(e)}")
+            return
+        self._close_project()
+        self.project = project
+        self._load_retrieval_index()
+        if not project.chapters():
+            project.add_chapter("第1章")
+        self.chapter_combo.setEnabled(True)
+        self.new_chapter_button.setEnabled(True)
+        self.export_button.setEnabled(True)
+        self._refresh_chapters()
+        self.chapter_combo.setCurrentIndex(self.chapter_combo.count() - 1)
+        self._on_chapter_selected()
+        self.statusBar.showMessage(f"已打开项目 {os.path.basename(project.path)}")
+    
+    def new_chapter(self):
+        """在项目末尾新建章节并切换过去"""
+        if self.project is None:
+            return
+        default = f"第{len(self.project.chapters()) + 1}章"
+        title, ok = QInputDialog.getText(self, "新建章节", "章节标题：", text=default)
+        if not ok:
+            return
+        self.project.add_chapter(title.strip() or default)
+        self._refresh_chapters()
+        self.chapter_combo.setCurrentIndex(self.chapter_combo.count() - 1)
+        self._on_chapter_selected()
+    
+    def _refresh_chapters(self):
+        """按项目中的章节重建下拉框，保留当前选中的章节"""
+        current = self._current_chapter_id()
+        self.chapter_combo.clear()
+        for chapter_id, title, _ in self.project.chapters():
+            self.chapter_combo.addItem(title, chapter_id)
+        index = self.chapter_combo.findData(current)
+        if index >= 0:
+            self.chapter_combo.setCurrentIndex(index)
+        self._update_project_label()
+    
+    def _current_chapter_id(self):
+        return self.chapter_combo.currentData()
+    
+    def _on_chapter_selected(self, index=None):
+        """切换章节：空闲时在结果区显示该章正文，生成中只改变之后任务的保存位置"""
+        chapter_id = self._current_chapter_id()
+        if chapter_id is None:
+            return
+        if self.job_queue.active_count():
+            self.statusBar.showMessage(f"之后提交的任务将保存到「{self.chapter_combo.currentText()}」")
+            return
+        self.result_display.clear()
+        text = self.project.chapter_text(chapter_id)
+        self.result_display.append(f"【{self.chapter_combo.currentText()}】\n")
+        if text:
+            self.result_display.append(text)
+    
+    def _save_to_project(self, job, chapter_id, text, prompt=None):
+        """生成结果追加到章节末尾并记录本次生成，只写入新增的内容"""
+        try:
+            separator = "\n\n" if self.project.chapter_text(chapter_id) else ""
+            self.project.append_text(chapter_id, separator + text.strip())
+            self.project.add_generation(prompt or job.prompt, text, job.params["model_name"], chapter_id,
+                                        status=job.state)
+        except KeyError:
+            # 章节已被删除
+            return
+        except OSError as e:
+            self.statusBar.showMessage(f"保存到项目失败: {e}")
+            return
+        self._update_project_label()
+    
+    def export_project(self):
+        """把项目各章整理后导出为一个文件，格式按扩展名选择；项目中的正文不变"""
+        if self.project is None:
+            return
+        if self._export_thread is not None and self._export_thread.isRunning():
+            self._export_thread.cancel()
+            self.statusBar.showMessage("正在取消导出...")
+            return
+        from postprocess import FORMATS, PostProcessor
+        name = os.path.splitext(os.path.basename(self.project.path))[0]
+        filters = ";;".join(f"{label} (*.{ext})" for ext, label in FORMATS.items())
+        path, selected = QFileDialog.getSaveFileName(self, "导出整理稿", name + ".txt", filters)
+        if not path:
+            return
+        fmt = os.path.splitext(path)[1].lstrip(".").lower()
+        if fmt not in FORMATS:
+            fmt = next(ext for ext, label in FORMATS.items() if selected.startswith(label))
+            path += "." + fmt
+        # 正文在界面线程中读出（项目文件不跨线程共享），整理和写文件都在后台
+        chapters = [(title, self.project.chapter_text(chapter_id)) for chapter_id, title, _ in self.project.chapters()]
+        self._export_chapters = [title for title, _ in chapters]
+        if self.postprocessor is None:
+            self.postprocessor = PostProcessor()
+        self._export_thread = PostProcessThread(self.postprocessor, name, chapters, path, {"format": fmt})
+        self._export_thread.progress.connect(self._on_export_progress)
+        self._export_thread.chapter_done.connect(self._on_export_chapter)
+        self._export_thread.finished.connect(lambda totals: self._on_export_finished(path, totals))
+        self._export_thread.error.connect(self._on_export_error)
+        self._export_thread.cancelled.connect(self._on_export_cancelled)
+        self._export_thread.finished.connect(self._on_export_ended)
+        self._export_thread.error.connect(self._on_export_ended)
+        self._export_thread.cancelled.connect(self._on_export_ended)
+        self._export_stats = []
+        self.export_button.setText("取消导出")
+        self._export_thread.start()
+        self.statusBar.showMessage(f"正在导出 {os.path.basename(path)}...")
+    
+    def _on_export_progress(self, value):
+        done = len(self._export_stats)
+        self.statusBar.showMessage(f"正在导出：{value}%（{done}/{len(self._export_chapters)}章）")
+    
+    def _on_export_chapter(self, index, counts):
+        """一章整理完成，立即显示该章的统计"""
+        from postprocess import word_count
+        self._export_stats.append((self._export_chapters[index], counts))
+        self.statusBar.showMessage(
+            f"正在导出：「{self._export_chapters[index]}」{word_count(counts)}字，"
+            f"{counts['paragraphs']}段（{len(self._export_stats)}/{len(self._export_chapters)}章）"
+        )
+    
+    def _on_export_finished(self, path, totals):
+        from postprocess import word_count
+        lines = [f"{title}：{word_count(counts)}字，{counts['paragraphs']}段，对话{counts['dialogue']}字"
+                 for title, counts in self._export_stats]
+        if self.project is not None:
+            self.project_label.setToolTip("\n".join(lines))
+        summary = (f"全书{word_count(totals)}字（汉字{totals.get('cjk', 0)}，英文单词{totals.get('words', 0)}），"
+                   f"{totals.get('paragraphs', 0)}段，{totals.get('sentences', 0)}句，"
+                   f"对话{totals.get('dialogue', 0)}字")
+        self.statusBar.showMessage(f"已导出到 {os.path.basename(path)}：{summary}")
+        QMessageBox.information(self, "导出完成", f"已导出到 {path}\n\n{summary}\n\n" + "\n".join(lines[:30]))
+    
+    def _on_export_error(self, message):
+        self.statusBar.showMessage(message)
+        QMessageBox.warning(self, "错误", message)
+    
+    def _on_export_cancelled(self):
+        self.statusBar.showMessage("导出已取消")
+    
+    def _on_export_ended(self, *args):
+        self.export_button.setText("导出整理稿")
+    
+    def _update_project_label(self):
+        if self.project is None:
+            self.project_label.setText("未打开项目")
+            return
+        stats = self.project.stats()
+        self.project_label.setText(
+            f"{os.path.basename(self.project.path)}：{stats['chapters']}章，{stats['generations']}次生成"
+        )
+    
+    def _close_project(self):
+        """关闭当前项目，已写入的内容刷到磁盘"""
+        if self.project is None:
+            return
+        if self._index_thread is not None and self._index_thread.isRunning():
+            # 先停下后台索引再关闭项目文件，未完成的索引在下次打开时补齐
+            self._index_thread.cancel()
+            self._index_thread.wait()
+        try:
+            self.project.sync()
+        except OSError as e:
+            print(f"保存项目失败: {e}")
+        self._save_retrieval_index()
+        self.project.close()
+        self.project = None
+        self._project_jobs = {}
+        self.retrieval_index = None
+    
+    def closeEvent(self, event):
+        """退出前停止概要线程，已完成的概要已经保存"""
+        if self._memory_thread is not None and self._memory_thread.isRunning():
+            self._memory_thread.cancel()
+            self._memory_thread.wait(2000)
+        if self._warmup_thread is not None and self._warmup_thread.isRunning():
+            self._warmup_thread.cancel()
+            self._warmup_thread.wait(2000)
+        for thread in (self._index_thread, self._embed_thread, self._query_embed_thread, self._export_thread):
+            if thread is not None and thread.isRunning():
+                thread.cancel()
+                thread.wait(2000)
+        if self.postprocessor is not None:
+            self.postprocessor.shutdown()
+        self._close_project()
+        self._save_retrieval_index()
+        # 仍在进行的生成保留日志，下次启动时可以恢复
+        self.journal.close()
+        super().closeEvent(event)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -0,0 +1,158 @@
+import tempfile
+
+from PyQt5.QtWidgets import QPlainTextEdit
+from PyQt5.QtGui import QTextCursor
+
+# 文档中最多保留的字数，超出后把最早的内容分页移出
+DEFAULT_MAX_CHARS = 200000
+# 每次移出或载回的页大小（字数，在段落边界处切分）
+PAGE_CHARS = 50000
+
+
+def _units(text):
+    """文本在QTextDocument中占用的位置数（UTF-16码元，基本平面外的字符占两个）"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+class ManuscriptView(QPlainTextEdit):
+    """面向超长文本的只读结果区
+
+    使用纯文本文档（按段落分块排版，追加时只排版新增部分），文档最多保留
+    max_chars字；更早的内容按页写入临时文件，滚动到顶部时逐页载回，
+    内存占用与会话中生成的总字数无关。full_text()返回包括已移出部分在内的全文。
+    spool为False时直接丢弃移出的内容。
+    """
+    def __init__(self, parent=None, max_chars=DEFAULT_MAX_CHARS, page_chars=PAGE_CHARS, spool=True):
+        super().__init__(parent)
+        self.max_chars = max_chars
+        self.page_chars = page_chars
+        self.spool = spool
+        self.setReadOnly(True)
+        self.setUndoRedoEnabled(False)  # 撤销栈会保留所有插入过的文本
+        self.setLineWrapMode(QPlainTextEdit.WidgetWidth)
+        self._spool_file = None
+        self._pages = []  # 写入临时文件的页：(字节偏移, 字节数, 位置数)
+        self._paged_out = 0  # 当前不在文档中的页数（总是最早的若干页）
+        self._dropped_chars = 0  # spool为False时丢弃的字数
+        self._units = 0  # 文档当前的位置数（不含末尾隐含的段落符）
+        self.verticalScrollBar().valueChanged.connect(self._on_scroll)
+
+    @property
+    def paged_out_chars(self):
+        """不在文档中的字数（已写入临时文件或已丢弃）"""
+        return sum(page[2] for page in self._pages[:self._paged_out]) + self._dropped_chars
+
+    def append_text(self, text):
+        """在末尾追加文本（不另起段落）；原本停在底部时保持滚动到底部"""
+        if not text:
+            return
+        scrollbar = self.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum() - 4
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+        self._units += _units(text)
+        # 停在底部时及时移出；用户在上方阅读时推迟，但最多允许两倍上限
+        if self._units > self.max_chars and (at_bottom or self._units > self.max_chars * 2):
+            self._page_out()
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
+
+    def remove_tail(self, text):
+        """删除末尾刚追加的text（生成中撤回的部分），不超过文档中现有的内容"""
+        size = min(_units(text), self._units)
+        if not size:
+            return
+        cursor = QTextCursor(self.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.setPosition(self._units - size, QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+        self._units -= size
+
+    def append(self, text):
+        """另起一段追加文本，与QTextEdit.append用法相同"""
+        self.append_text(("\n" if self._units else "") + text)
+
+    def clear(self):
+        # 先重置状态，避免清空时滚动条回到顶部触发载回
+        self._units = 0
+        self._pages = []
+        self._paged_out = 0
+        self._dropped_chars = 0
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._spool_file = None
+        super().clear()
+
+    def full_text(self):
+        """全文：已移出的页加上文档中的内容"""
+        parts = [self._read_page(page) for page in self._pages[:self._paged_out]]
+        parts.append(self.toPlainText())
+        return "".join(parts)
+
+    def _page_out(self):
+        """把文档开头的内容移出，直到不超过max_chars"""
+        while self._units > self.max_chars:
+            if self._paged_out < len(self._pages):
+                # 开头是之前载回的页，文件中已有，直接从文档删除
+                self._remove_head(self._pages[self._paged_out][2])
+                self._paged_out += 1
+                continue
+            size = self._head_size()
+            if size == 0:
+                return
+            if self.spool:
+                self._spool_head(size)
+                self._paged_out += 1
+            else:
+                self._dropped_chars += size
+            self._remove_head(size)
+
+    def _head_size(self):
+        """文档开头一页的位置数：按段落累计，在段落边界处切分，保证载回时段落完整"""
+        block = self.document().firstBlock()
+        size = 0
+        while block.isValid() and size < self.page_chars:
+            size += block.length()  # 包括段落符
+            block = block.next()
+        return min(size, self._units)
+
+    def _spool_head(self, size):
+        """把文档开头size个位置的内容写入临时文件"""
+        doc = self.document()
+        cursor = QTextCursor(doc)
+        cursor.setPosition(size, QTextCursor.KeepAnchor)
+        # selectedText用U+2029表示段落符
+        text = cursor.selectedText().replace("\u2029", "\n")
+        if self._spool_file is None:
+            self._spool_file = tempfile.TemporaryFile(prefix="manuscript_", suffix=".txt")
+        data = text.encode("utf-8")
+        self._spool_file.seek(0, 2)
+        self._pages.append((self._spool_file.tell(), len(data), size))
+        self._spool_file.write(data)
+
+    def _remove_head(self, size):
+        cursor = QTextCursor(self.document())
+        cursor.setPosition(size, QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+        self._units -= size
+
+    def _read_page(self, page):
+        offset, length, _ = page
+        if self._spool_file is None:
+            return ""
+        self._spool_file.seek(offset)
+        return self._spool_file.read(length).decode("utf-8")
+
+    def _on_scroll(self, value):
+        """滚动到顶部时载回上一页，位置保持在原来的内容上"""
+        if value != 0 or self._paged_out == 0 or not self.spool:
+            return
+        self._paged_out -= 1
+        page = self._pages[self._paged_out]
+        scrollbar = self.verticalScrollBar()
+        old_max = scrollbar.maximum()
+        cursor = QTextCursor(self.document())
+        cursor.insertText(self._read_page(page))
+        self._units += page[2]
+        scrollbar.setValue(scrollbar.maximum() - old_max)
@@ -0,0 +1,503 @@
+"""本地模拟大模型服务
+
+同时支持Ollama的NDJSON流（/api/generate、/api/chat）和OpenAI兼容接口的SSE流
+（/v1/chat/completions，SiliconFlow与自定义OpenAI格式），不需要真实的Ollama或云端账号
+即可测试和基准测试api_client.py。可以调节出字速度、首字延迟、抖动，按比例返回错误、
+畸形帧、把帧拆成两块发送或中途断开连接。/api/embed返回按文本散列的确定性向量，用于测试检索索引。
+
+录制模式把请求转发到真实服务，同时把原始响应（分块及时间）追加到录制文件；
+回放模式按录制时的分块和节奏（可加速）重放，不再需要真实服务。
+
+用法:
+    python mock_server.py --port 11434 --rate 30 --latency-ms 300 --jitter-ms 20
+    python mock_server.py --error-rate 0.1 --malformed-rate 0.01 --split-rate 0.2
+    python mock_server.py --rpm 60 --error-status 429
+    python mock_server.py --record streams.jsonl --upstream http://localhost:11434
+    python mock_server.py --replay streams.jsonl --speed 0
+
+界面中API地址填 http://127.0.0.1:<端口>/api/generate（Ollama）或
+http://127.0.0.1:<端口>/v1/chat/completions（SiliconFlow/自定义OpenAI格式）。
+"""
+import argparse
+import base64
+import json
+import multiprocessing
+import random
+import socketserver
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+SAMPLE_TEXT = "夜色如墨，山风穿过竹林，少年握紧了手中的长剑。他知道，今夜之后一切都将不同。"
+
+OLLAMA_PATHS = ("/api/generate", "/api/chat")
+OPENAI_PATHS = ("/v1/chat/completions", "/chat/completions")
+EMBED_PATH = "/api/embed"
+EMBED_DIMENSIONS = 64
+
+
+class MockConfig:
+    """模拟服务的行为参数
+
+    rate为每秒输出的增量数（0表示不限速），latency为收到请求到第一个增量的等待（秒），
+    jitter为每个增量间隔上随机增加的0~jitter秒。各种*_rate是按请求（error_rate、drop_rate）
+    或按帧（malformed_rate、split_rate）的概率。replay为录制文件路径，speed为回放加速倍数
+    （0表示不等待）；upstream与record同时指定时进入录制模式。rpm模拟服务商的每分钟请求数限额：
+    响应带x-ratelimit-*头，超出时返回429和Retry-After。
+    """
+    def __init__(self, tokens=200, rate=50.0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=500,
+                 malformed_rate=0.0, split_rate=0.0, drop_rate=0.0, text=SAMPLE_TEXT, seed=None,
+                 replay=None, speed=1.0, upstream=None, record=None, rpm=0):
+        self.tokens = tokens
+        self.rate = rate
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.malformed_rate = malformed_rate
+        self.split_rate = split_rate
+        self.drop_rate = drop_rate
+        self.text = text
+        self.seed = seed
+        self.replay = replay
+        self.speed = speed
+        self.upstream = upstream
+        self.record = record
+        self.rpm = rpm
+
+
+def load_recordings(path):
+    """读取录制文件，返回 路径 -> 录制列表"""
+    recordings = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 录制时被中断，最后一行可能不完整
+            record["chunks"] = [(t, base64.b64decode(data)) for t, data in record["chunks"]]
+            recordings.setdefault(record["path"], []).append(record)
+    return recordings
+
+
+def _stream_format(path):
+    if path in OLLAMA_PATHS:
+        return "ollama"
+    if path.endswith(OPENAI_PATHS):
+        return "openai"
+    return None
+
+
+def _embedding(text):
+    """按相邻两字散列的确定性向量：用词相近的文本相似度高，足以测试检索的重排"""
+    vector = [0.0] * EMBED_DIMENSIONS
+    for a, b in zip(text, text[1:]):
+        vector[zlib.crc32((a + b).encode("utf-8")) % EMBED_DIMENSIONS] += 1.0
+    return vector
+
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 逐帧的小块写入不能被Nagle算法攒批，否则首字延迟里会多出约40毫秒
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # 健康检查和连接预热只需要任意响应
+        self._send_body(200, "text/plain", b"Ollama is running")
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        raw_body = self.rfile.read(length)
+        self._extra_headers = {}
+        server.count("requests")
+        path = self.path.split("?", 1)[0]
+        if server.recorder is not None:
+            self._proxy(path, raw_body)
+            return
+        if server.recordings is not None:
+            self._replay(path)
+            return
+        fmt = _stream_format(path)
+        if fmt is None and path != EMBED_PATH:
+            self._send_body(404, "application/json", b'{"error":"not found"}')
+            return
+        try:
+            body = json.loads(raw_body or b"{}")
+        except ValueError:
+            self._send_body(400, "application/json", b'{"error":"invalid json"}')
+            return
+        if path == EMBED_PATH:
+            inputs = body.get("input", "")
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self._send_body(200, "application/json", _dumps({
+                "model": body.get("model"), "embeddings": [_embedding(text) for text in inputs]
+            }).encode("utf-8"))
+            return
+        config = server.config
+        rng = server.new_rng()
+        remaining, retry_after = server.take_request()
+        if retry_after is not None:
+            server.count("limited")
+            self._send_body(429, "application/json", _dumps({"error": "请求过于频繁"}).encode("utf-8"),
+                            {"Retry-After": f"{retry_after:.0f}"})
+            return
+        if remaining is not None:
+            self._extra_headers = {"x-ratelimit-limit-requests": str(config.rpm),
+                                   "x-ratelimit-remaining-requests": str(remaining)}
+        if rng.random() < config.error_rate:
+            server.count("errors")
+            headers = {"Retry-After": "1"} if config.error_status == 429 else None
+            self._send_body(config.error_status, "application/json",
+                            _dumps({"error": "模拟的服务端错误"}).encode("utf-8"), headers)
+            return
+        try:
+            if fmt == "ollama":
+                self._ollama(path, body, rng)
+            else:
+                self._openai(body, rng)
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前停止（取消或写到目标长度）时关闭了连接
+            server.count("client_closed")
+            self.close_connection = True
+
+    # ---- 生成 ----
+
+    def _pieces(self, rng, limit=None):
+        """按配置生成的增量文本，请求限制了最大token数（limit）时只生成这么多个"""
+        text = self.server.config.text
+        pieces = []
+        for _ in range(min(self.server.config.tokens, limit or self.server.config.tokens)):
+            start = rng.randrange(len(text))
+            pieces.append(text[start:start + rng.randint(1, 3)])
+        return pieces
+
+    def _wait_token(self, rng):
+        config = self.server.config
+        delay = (1.0 / config.rate if config.rate > 0 else 0.0) + rng.uniform(0, config.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _ollama(self, path, body, rng):
+        config = self.server.config
+        chat = path == "/api/chat"
+        prompt = body.get("prompt") or "".join(m.get("content", "") for m in body.get("messages") or ())
+        if not prompt:
+            # 不带提示的请求只加载模型（预热），返回加载耗时
+            time.sleep(config.latency)
+            self._send_body(200, "application/json", _dumps({
+                "model": body.get("model"), "response": "", "done": True,
+                "load_duration": int(config.latency * 1e9)
+            }).encode("utf-8"))
+            return
+        limit = (body.get("options") or {}).get("num_predict")
+        pieces = self._pieces(rng, limit)
+        context = list(body.get("context") or ()) + list(range(len(prompt) + len(pieces)))
+        final = {
+            "model": body.get("model"), "done": True, "context": context,
+            "done_reason": "length" if limit and len(pieces) >= limit else "stop",
+            "prompt_eval_count": len(prompt), "prompt_eval_duration": int(config.latency * 1e9),
+            "eval_count": len(pieces), "load_duration": 0,
+        }
+        if chat:
+            final["message"] = {"role": "assistant", "content": ""}
+            del final["context"]
+        else:
+            final["response"] = ""
+        if body.get("stream") is False:
+            time.sleep(config.latency)
+            key = "message" if chat else "response"
+            final[key] = {"role": "assistant", "content": "".join(pieces)} if chat else "".join(pieces)
+            self._send_body(200, "application/json", _dumps(final).encode("utf-8"))
+            return
+
+        def frame(piece):
+            delta = {"message": {"role": "assistant", "content": piece}} if chat else {"response": piece}
+            return _dumps(dict(model=body.get("model"), done=False, **delta)) + "\n"
+
+        self._stream("application/x-ndjson", pieces, frame, _dumps(final) + "\n", rng)
+
+    def _openai(self, body, rng):
+        config = self.server.config
+        pieces = self._pieces(rng, body.get("max_tokens"))
+        finish_reason = "length" if body.get("max_tokens") and len(pieces) >= body["max_tokens"] else "stop"
+        model = body.get("model")
+        if body.get("stream") is False:
+            time.sleep(config.latency)
+            self._send_body(200, "application/json", _dumps({
+                "id": "chatcmpl-mock", "object": "chat.completion", "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(pieces)},
+                             "finish_reason": finish_reason}],
+                "usage": {"completion_tokens": len(pieces)}
+            }).encode("utf-8"))
+            return
+
+        def frame(piece):
+            return "data: " + _dumps({
+                "id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]
+            }) + "\n\n"
+
+        final = "data: " + _dumps({
+            "id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}],
+            "usage": {"completion_tokens": len(pieces)}
+        }) + "\n\ndata: [DONE]\n\n"
+        self._stream("text/event-stream", pieces, frame, final, rng)
+
+    def _stream(self, content_type, pieces, frame, final, rng):
+        """逐帧发送；按配置插入畸形帧、把帧拆成两块或中途断开"""
+        server = self.server
+        config = server.config
+        self._start_chunked(200, content_type)
+        time.sleep(config.latency)
+        drop_at = rng.randrange(len(pieces)) if pieces and rng.random() < config.drop_rate else None
+        for i, piece in enumerate(pieces):
+            if i:
+                self._wait_token(rng)
+            if i == drop_at:
+                server.count("dropped")
+                self.close_connection = True
+                return  # 不发送结束块，客户端会看到连接被关闭
+            data = frame(piece).encode("utf-8")
+            if rng.random() < config.malformed_rate:
+                server.count("malformed")
+                # 截断的JSON，保留帧结尾的换行（SSE为空行）使其成为一个完整的坏帧
+                body = data.rstrip(b"\n")
+                self._write_chunk(body[:max(1, len(body) // 2)] + data[len(body):])
+            if rng.random() < config.split_rate:
+                # 在任意字节处拆开，可能落在UTF-8多字节字符中间
+                cut = rng.randrange(1, len(data))
+                self._write_chunk(data[:cut])
+                self._write_chunk(data[cut:])
+            else:
+                self._write_chunk(data)
+        self._write_chunk(final.encode("utf-8"))
+        self._end_chunked()
+
+    # ---- 录制与回放 ----
+
+    def _proxy(self, path, raw_body):
+        """转发到真实服务，边转发边录制"""
+        import requests
+        recorder = self.server.recorder
+        headers = {k: v for k, v in self.headers.items() if k.lower() in ("content-type", "authorization")}
+        start = time.perf_counter()
+        chunks = []
+        try:
+            response = requests.post(recorder.upstream + path, data=raw_body, headers=headers, stream=True,
+                                     timeout=(10, 600))
+        except Exception as e:
+            self._send_body(502, "application/json", _dumps({"error": f"上游不可用: {e}"}).encode("utf-8"))
+            return
+        with response:
+            content_type = response.headers.get("Content-Type", "application/json")
+            self._start_chunked(response.status_code, content_type)
+            for data in response.iter_content(chunk_size=None):
+                chunks.append((round((time.perf_counter() - start) * 1000, 3), data))
+                self._write_chunk(data)
+            self._end_chunked()
+        recorder.save(path, response.status_code, content_type, chunks)
+
+    def _replay(self, path):
+        """按录制时的分块和时间重放"""
+        server = self.server
+        record = server.next_recording(path)
+        if record is None:
+            self._send_body(404, "application/json", _dumps({"error": f"没有{path}的录制"}).encode("utf-8"))
+            return
+        speed = server.config.speed
+        self._start_chunked(record["status"], record["content_type"])
+        start = time.perf_counter()
+        for t, data in record["chunks"]:
+            if speed > 0:
+                delay = t / 1000 / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            self._write_chunk(data)
+        self._end_chunked()
+
+    # ---- 底层写入 ----
+
+    def _send_body(self, status, content_type, data, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_chunked(self, status, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for key, value in self._extra_headers.items():
+            self.send_header(key, value)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class _Recorder:
+    """把转发的响应逐条追加到录制文件"""
+    def __init__(self, upstream, path):
+        self.upstream = upstream.rstrip("/")
+        self.path = path
+        self._lock = threading.Lock()
+
+    def save(self, path, status, content_type, chunks):
+        line = json.dumps({
+            "path": path, "status": status, "content_type": content_type,
+            "chunks": [(t, base64.b64encode(data).decode("ascii")) for t, data in chunks]
+        })
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class MockServer(socketserver.ThreadingMixIn, HTTPServer):
+    """模拟服务：每个连接一个线程，start()在后台线程中运行"""
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        super().__init__((host, port), _MockHandler)
+        self.config = config or MockConfig()
+        self.recorder = None
+        self.recordings = None
+        if self.config.upstream and self.config.record:
+            self.recorder = _Recorder(self.config.upstream, self.config.record)
+        elif self.config.replay:
+            self.recordings = load_recordings(self.config.replay)
+        self._lock = threading.Lock()
+        self._rng = random.Random(self.config.seed)
+        self._replay_pos = {}
+        self.stats = {"requests": 0, "errors": 0, "malformed": 0, "dropped": 0, "limited": 0, "client_closed": 0}
+        self._request_times = []  # 最近一分钟内放行的请求时刻（rpm限额用）
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def new_rng(self):
+        """每个请求独立的随机数，固定seed时整个会话可复现"""
+        with self._lock:
+            return random.Random(self._rng.random())
+
+    def take_request(self):
+        """按rpm限额放行一个请求，返回(剩余次数, 需等待秒数)；不限额时都为None"""
+        rpm = self.config.rpm
+        if not rpm:
+            return None, None
+        with self._lock:
+            now = time.monotonic()
+            self._request_times = [t for t in self._request_times if now - t < 60]
+            if len(self._request_times) >= rpm:
+                return 0, max(1.0, 60 - (now - self._request_times[0]))
+            self._request_times.append(now)
+            return rpm - len(self._request_times), None
+
+    def next_recording(self, path):
+        """按顺序循环取该路径的录制"""
+        records = self.recordings.get(path)
+        if not records:
+            return None
+        with self._lock:
+            pos = self._replay_pos.get(path, 0)
+            self._replay_pos[path] = pos + 1
+        return records[pos % len(records)]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _serve(config, port_queue):
+    server = MockServer(config)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_mock_server(config=None):
+    """在独立进程中启动模拟服务（避免服务端线程计入被测进程），返回(进程, 根地址)"""
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(config or MockConfig(), port_queue), daemon=True)
+    process.start()
+    port = port_queue.get(timeout=10)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟大模型服务（Ollama NDJSON / OpenAI SSE）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--tokens", type=int, default=200, help="每次生成的增量数")
+    parser.add_argument("--rate", type=float, default=50, help="每秒增量数，0表示不限速")
+    parser.add_argument("--latency-ms", type=float, default=0, help="首个增量前的等待")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="每个增量间隔的随机抖动上限")
+    parser.add_argument("--error-rate", type=float, default=0, help="返回错误的请求比例")
+    parser.add_argument("--error-status", type=int, default=500, help="错误状态码（429时带Retry-After）")
+    parser.add_argument("--malformed-rate", type=float, default=0, help="插入畸形帧的比例")
+    parser.add_argument("--split-rate", type=float, default=0, help="把帧拆成两块发送的比例")
+    parser.add_argument("--drop-rate", type=float, default=0, help="中途断开连接的请求比例")
+    parser.add_argument("--rpm", type=int, default=0, help="模拟每分钟请求数限额，超出返回429")
+    parser.add_argument("--seed", type=int, help="随机种子，指定后行为可复现")
+    parser.add_argument("--record", help="录制文件（与--upstream一起使用）")
+    parser.add_argument("--upstream", help="录制模式转发到的真实服务根地址，如 http://localhost:11434")
+    parser.add_argument("--replay", help="回放录制文件")
+    parser.add_argument("--speed", type=float, default=1, help="回放加速倍数，0表示不等待")
+    args = parser.parse_args()
+    if bool(args.record) != bool(args.upstream):
+        parser.error("--record和--upstream需要同时指定")
+
+    config = MockConfig(
+        tokens=args.tokens, rate=args.rate, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate, error_status=args.error_status, malformed_rate=args.malformed_rate,
+        split_rate=args.split_rate, drop_rate=args.drop_rate, seed=args.seed,
+        replay=args.replay, speed=args.speed, upstream=args.upstream, record=args.record, rpm=args.rpm
+    )
+    server = MockServer(config, args.host, args.port)
+    mode = "录制" if server.recorder else "回放" if server.recordings is not None else "模拟"
+    print(f"{mode}服务已启动: {server.base_url}  (Ollama: /api/generate  OpenAI: /v1/chat/completions)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"请求 {server.stats['requests']}，错误 {server.stats['errors']}，"
+              f"畸形帧 {server.stats['malformed']}，断开 {server.stats['dropped']}，"
+              f"限流 {server.stats['limited']}")
+
+
+if __name__ == "__main__":
+    main()
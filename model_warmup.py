@@ -0,0 +1,152 @@
+import json
+import re
+import threading
+import time
+
+from http_pool import CancelToken, SessionPool, get_session_pool
+from llm_backend import ApiError, parse_keep_alive
+
+# 模型状态
+STATE_COLD = "cold"  # 未加载或已超过keep_alive
+STATE_WARMING = "warming"
+STATE_WARM = "warm"
+STATE_FAILED = "failed"
+
+# 加载大模型可能需要几分钟，预热请求单独使用更长的等待时间（秒）
+WARMUP_TIMEOUT = 600
+# Ollama未指定keep_alive时默认保持加载5分钟
+OLLAMA_DEFAULT_KEEP_ALIVE = 300
+
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def keep_alive_seconds(value):
+    """keep_alive换算成秒：负数表示一直保持（返回None），空值按Ollama默认5分钟"""
+    value = parse_keep_alive(value)
+    if value is None:
+        return OLLAMA_DEFAULT_KEEP_ALIVE
+    if isinstance(value, int):
+        return None if value < 0 else value
+    total = 0.0
+    parts = re.findall(r"(-?\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return OLLAMA_DEFAULT_KEEP_ALIVE
+    for number, unit in parts:
+        total += float(number) * _DURATION_UNITS[unit]
+    return None if total < 0 else total
+
+
+def model_key(api_type, api_url, model_name):
+    return (api_type, SessionPool.endpoint_key(api_url), model_name)
+
+
+def supports_preload(api_type, api_format=None):
+    """Ollama原生接口可以只加载模型不生成；其他接口只能预先建立连接"""
+    return api_type == "Ollama" or (api_type == "自定义" and api_format == "Ollama格式")
+
+
+class ModelState:
+    """一个端点上一个模型的冷热状态"""
+    def __init__(self):
+        self.state = STATE_COLD
+        self.load_ms = None  # 最近一次预热的加载耗时
+        self.last_used = None  # 最近一次预热或生成完成的时刻（time.monotonic）
+        self.keep_alive = OLLAMA_DEFAULT_KEEP_ALIVE  # 秒，None表示一直保持
+        self.error = None
+
+
+class WarmupTracker:
+    """记录各模型的冷热状态；超过keep_alive没有使用的模型视为已卸载"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def _get(self, key):
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = ModelState()
+        return state
+
+    def state(self, key):
+        """返回(状态, 加载耗时ms)"""
+        with self._lock:
+            state = self._get(key)
+            if state.state == STATE_WARM and state.keep_alive is not None and state.last_used is not None \
+                    and time.monotonic() - state.last_used > state.keep_alive:
+                state.state = STATE_COLD
+            return state.state, state.load_ms
+
+    def mark_warming(self, key):
+        with self._lock:
+            self._get(key).state = STATE_WARMING
+
+    def mark_warm(self, key, load_ms=None, keep_alive=None):
+        """预热或生成成功：模型已在服务端加载"""
+        with self._lock:
+            state = self._get(key)
+            state.state = STATE_WARM
+            state.error = None
+            if load_ms is not None:
+                state.load_ms = load_ms
+            state.last_used = time.monotonic()
+            state.keep_alive = keep_alive_seconds(keep_alive)
+
+    def mark_failed(self, key, error):
+        with self._lock:
+            state = self._get(key)
+            state.state = STATE_FAILED
+            state.error = str(error)
+
+
+def warm_up(api_type, api_url, model_name, api_format=None, keep_alive=None, cancel_token=None, num_ctx=0):
+    """预热一个端点上的模型，返回耗时（毫秒）
+
+    Ollama接口发送不带提示的生成请求，服务端只加载模型、不生成任何内容；
+    num_ctx与生成时一致，否则第一次生成时会按新的上下文长度重新加载；
+    其他接口无法单独加载模型，只预先建立连接（包括TLS握手）放入连接池。
+    """
+    pool = get_session_pool()
+    token = cancel_token if cancel_token is not None else CancelToken()
+    start = time.perf_counter()
+    try:
+        with token:
+            if supports_preload(api_type, api_format):
+                data = {"model": model_name, "stream": False}
+                keep_alive = parse_keep_alive(keep_alive)
+                if keep_alive is not None:
+                    data["keep_alive"] = keep_alive
+                if num_ctx:
+                    data["options"] = {"num_ctx": num_ctx}
+                with pool.post(api_url, headers={"Content-Type": "application/json"}, data=json.dumps(data),
+                               timeout=(pool.connect_timeout, WARMUP_TIMEOUT)) as response:
+                    if response.status_code != 200:
+                        raise ApiError(f"预热失败: {response.status_code} - {response.text[:200]}",
+                                       status=response.status_code)
+                    body = response.json()
+                # 服务端报告的加载耗时（纳秒），模型已在内存中时接近0
+                if body.get("load_duration") is not None:
+                    return body["load_duration"] / 1e6
+            else:
+                # 任何HTTP响应都说明连接已建立
+                pool.get(SessionPool.endpoint_key(api_url) + "/",
+                         timeout=(pool.connect_timeout, pool.connect_timeout)).close()
+    except ApiError:
+        raise
+    except Exception as e:
+        if token.cancelled:
+            raise ApiError("预热已取消")
+        raise ApiError(f"预热失败: {type(e).__name__}")
+    return (time.perf_counter() - start) * 1000
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_warmup_tracker():
+    """获取进程级共享的模型状态记录"""
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = WarmupTracker()
+        return _tracker
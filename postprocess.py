@@ -0,0 +1,310 @@
+import html
+import multiprocessing
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# 每个工作进程任务处理的字数，在段落边界切分；越小结果返回得越及时
+SEGMENT_CHARS = 20000
+# 每个工作进程同时排队的片段数，限制尚未取回的结果占用的内存
+INFLIGHT_PER_WORKER = 2
+# 超过这么多字的段落在句末拆开，0表示不拆
+MAX_PARAGRAPH_CHARS = 400
+# 首行缩进（两个全角空格）
+INDENT = "　　"
+
+# 导出格式：扩展名 -> 名称
+FORMATS = {"txt": "纯文本", "md": "Markdown", "html": "网页"}
+DEFAULT_OPTIONS = {"normalize": True, "indent": True, "max_paragraph": MAX_PARAGRAPH_CHARS, "format": "txt"}
+
+_CJK = "㐀-䶿一-鿿豈-﫿"
+_CJK_PUNCT = "，。！？；：、“”‘’（）《》〈〉【】…—「」『』"
+_HALF_TO_FULL = {",": "，", ";": "；", ":": "：", "?": "？", "!": "！", ".": "。"}
+
+_SPACE_IN_CJK = re.compile(f"(?<=[{_CJK}{_CJK_PUNCT}])[ \t　]+(?=[{_CJK}{_CJK_PUNCT}])")
+_ELLIPSIS = re.compile(f"(?<=[{_CJK}{_CJK_PUNCT}])(?:\\.{{3,}}|。{{3,}}|…+)")
+_DASH = re.compile(f"(?<=[{_CJK}{_CJK_PUNCT}])(?:—+|-{{2,}}|－{{2,}})")
+_HALF_PUNCT = re.compile(f"(?<=[{_CJK}）”’」』])[ \t]*([,;:?!.])(?![0-9A-Za-z.])")
+_OPEN_PAREN = re.compile(f"\\((?=[{_CJK}])")
+_CLOSE_PAREN = re.compile(f"(?<=[{_CJK}{_CJK_PUNCT}])\\)")
+_REPEATED_PUNCT = re.compile("([，、；：])\\1+")
+_BLANK_LINES = re.compile("\n{3,}")
+_TRAILING_SPACE = re.compile("[ \t　]+(?=\n|$)")
+_HAS_CJK = re.compile(f"[{_CJK}]")
+
+_CJK_RUN = re.compile(f"[{_CJK}]+")
+_WORD = re.compile("[A-Za-z0-9]+(?:['’-][A-Za-z0-9]+)*")
+_PUNCT_RUN = re.compile(f"[{_CJK_PUNCT}，,.;:?!\"'()]+")
+_SPACE_RUN = re.compile("\\s+")
+_SENTENCE_END = re.compile("[。！？!?]+[”’」』]?|……[”’」』]?")
+_DIALOGUE = re.compile("“([^“”]*)”|「([^「」]*)」")
+_SPLIT_AT = re.compile("[。！？!?…][”’」』]?")
+
+STAT_FIELDS = ("chars", "cjk", "words", "punctuation", "paragraphs", "sentences", "dialogue")
+
+
+def _straight_quotes(paragraph):
+    """中文段落中的直引号按出现顺序交替换成“”"""
+    if '"' not in paragraph or not _HAS_CJK.search(paragraph):
+        return paragraph
+    parts = paragraph.split('"')
+    return "".join(part + ("“" if i % 2 == 0 else "”") for i, part in enumerate(parts[:-1])) + parts[-1]
+
+
+def normalize_text(text):
+    """中文文本的标点和空白规范化
+
+    统一换行、去掉行尾空白和汉字之间的空格、合并多余空行；汉字后的半角标点、括号、
+    省略号和破折号换成全角写法；中文段落中的直引号换成弯引号。
+    """
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = _TRAILING_SPACE.sub("", text)
+    text = "\n".join(_straight_quotes(line) for line in text.split("\n"))
+    text = _ELLIPSIS.sub("……", text)
+    text = _DASH.sub("——", text)
+    text = _OPEN_PAREN.sub("（", text)
+    text = _CLOSE_PAREN.sub("）", text)
+    text = _HALF_PUNCT.sub(lambda m: _HALF_TO_FULL[m.group(1)], text)
+    text = _SPACE_IN_CJK.sub("", text)
+    text = _REPEATED_PUNCT.sub("\\1", text)
+    return _BLANK_LINES.sub("\n\n", text)
+
+
+def split_paragraph(paragraph, limit=MAX_PARAGRAPH_CHARS):
+    """把超过limit字的段落在句末拆开，每段不少于limit的一半"""
+    if not limit or len(paragraph) <= limit:
+        return [paragraph]
+    result = []
+    while len(paragraph) > limit:
+        cut = None
+        for m in _SPLIT_AT.finditer(paragraph, limit // 2, limit):
+            cut = m.end()
+        if cut is None:
+            break  # 找不到句末，保持原样
+        result.append(paragraph[:cut])
+        paragraph = paragraph[cut:].lstrip()
+    result.append(paragraph)
+    return [p for p in result if p]
+
+
+def paragraphs(text, max_chars=MAX_PARAGRAPH_CHARS):
+    """分段：每个非空行是一段（去掉原有缩进），过长的段落在句末拆开"""
+    result = []
+    for line in text.split("\n"):
+        line = line.strip(" \t　")
+        if line:
+            result.extend(split_paragraph(line, max_chars))
+    return result
+
+
+def count_text(text):
+    """字数统计：非空白字符、汉字、英文单词（含数字）、标点、段落、句子和对话字数"""
+    spaces = sum(len(m) for m in _SPACE_RUN.findall(text))
+    return {
+        "chars": len(text) - spaces,
+        "cjk": sum(len(m) for m in _CJK_RUN.findall(text)),
+        "words": len(_WORD.findall(text)),
+        "punctuation": sum(len(m) for m in _PUNCT_RUN.findall(text)),
+        "paragraphs": sum(1 for line in text.split("\n") if line.strip()),
+        "sentences": len(_SENTENCE_END.findall(text)),
+        "dialogue": sum(len(a or b) for a, b in _DIALOGUE.findall(text)),
+    }
+
+
+def merge_counts(total, counts):
+    """把counts累加到total中，返回total"""
+    for field in STAT_FIELDS:
+        total[field] = total.get(field, 0) + counts.get(field, 0)
+    return total
+
+
+def word_count(counts):
+    """习惯上的字数：汉字加英文单词"""
+    return counts.get("cjk", 0) + counts.get("words", 0)
+
+
+def _markdown_escape(paragraph):
+    paragraph = re.sub(r"([\\`*_\[\]])", r"\\\1", paragraph)
+    return re.sub(r"^([#>+-]|\d+\.)", r"\\\1", paragraph)
+
+
+def format_paragraphs(items, fmt="txt", indent=True):
+    """按导出格式排版段落，每段末尾带上分隔，各片段的结果可以直接拼接"""
+    if fmt == "html":
+        return "".join(f"<p>{html.escape(p)}</p>\n" for p in items)
+    if fmt == "md":
+        return "".join(_markdown_escape(p) + "\n\n" for p in items)
+    if indent:
+        return "".join(INDENT + p + "\n" for p in items)
+    return "".join(p + "\n\n" for p in items)
+
+
+def document_head(fmt, title):
+    if fmt == "html":
+        return (f'<!DOCTYPE html>\n<html lang="zh-CN">\n<head>\n<meta charset="utf-8">\n'
+                f"<title>{html.escape(title)}</title>\n</head>\n<body>\n<h1>{html.escape(title)}</h1>\n")
+    if fmt == "md":
+        return f"# {title}\n\n"
+    return f"{title}\n\n"
+
+
+def document_tail(fmt):
+    return "</body>\n</html>\n" if fmt == "html" else ""
+
+
+def chapter_head(fmt, title):
+    if fmt == "html":
+        return f"<h2>{html.escape(title)}</h2>\n"
+    if fmt == "md":
+        return f"## {title}\n\n"
+    return f"\n{title}\n\n"
+
+
+def process_segment(text, options):
+    """在工作进程中处理一个片段：规范化、分段、排版并统计，返回(排版后的文本, 统计)"""
+    if options.get("normalize", True):
+        text = normalize_text(text)
+    items = paragraphs(text, options.get("max_paragraph", MAX_PARAGRAPH_CHARS))
+    counts = count_text("\n".join(items))
+    return format_paragraphs(items, options.get("format", "txt"), options.get("indent", True)), counts
+
+
+def split_segments(text, size=SEGMENT_CHARS):
+    """在段落边界把文本切成约size字的片段，空文本返回一个空片段"""
+    segments = []
+    start = 0
+    while len(text) - start > size:
+        cut = text.rfind("\n", start, start + size)
+        if cut <= start:
+            cut = text.find("\n", start + size)
+            if cut == -1:
+                break
+        segments.append(text[start:cut + 1])
+        start = cut + 1
+    if start < len(text) or not segments:
+        segments.append(text[start:])
+    return segments
+
+
+def default_workers():
+    """工作进程数：留一个核给界面，最多4个"""
+    return max(1, min(4, (os.cpu_count() or 2) - 1))
+
+
+class PostProcessor:
+    """在工作进程池中整理文稿，结果按原顺序逐段取回
+
+    片段切在段落边界上，互不依赖，可以并行处理；同时在途的片段数有上限，
+    取回一段就补交一段，处理超长文稿时内存占用与总长度无关。
+    进程池在第一次使用时创建（spawn方式，不复制界面进程的线程和锁），之后复用。
+    max_workers为0时在调用线程中直接处理。
+    """
+    def __init__(self, max_workers=None, segment_chars=SEGMENT_CHARS):
+        self.max_workers = default_workers() if max_workers is None else max_workers
+        self.segment_chars = segment_chars
+        self._executor = None
+
+    def _submit(self, text, options):
+        if not self.max_workers:
+            return _Done(process_segment(text, options))
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor.submit(process_segment, text, options)
+
+    def run(self, chapters, options, should_stop=None):
+        """处理各章正文，按顺序逐段产出(章序号, 排版后的文本, 片段统计, 片段原文字数, 整章统计)
+
+        整章统计只在该章最后一段时给出，其余为None。should_stop返回True时尽快结束。
+        """
+        def tasks():
+            for index, text in enumerate(chapters):
+                segments = split_segments(text, self.segment_chars)
+                for i, segment in enumerate(segments):
+                    yield index, segment, i == len(segments) - 1
+
+        pending = deque()
+        limit = max(1, self.max_workers) * INFLIGHT_PER_WORKER
+        chapter_counts = {}
+        try:
+            for index, segment, last in tasks():
+                if should_stop is not None and should_stop():
+                    return
+                pending.append((index, len(segment), last, self._submit(segment, options)))
+                while len(pending) >= limit:
+                    yield self._collect(pending.popleft(), chapter_counts)
+            while pending:
+                if should_stop is not None and should_stop():
+                    return
+                yield self._collect(pending.popleft(), chapter_counts)
+        finally:
+            for item in pending:
+                item[3].cancel()
+
+    @staticmethod
+    def _collect(item, chapter_counts):
+        index, length, last, future = item
+        text, counts = future.result()
+        total = merge_counts(chapter_counts.setdefault(index, {}), counts)
+        if last:
+            del chapter_counts[index]
+        return index, text, counts, length, total if last else None
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class _Done:
+    """不使用进程池时的结果，接口与Future相同"""
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+    def cancel(self):
+        return False
+
+
+def export_manuscript(processor, title, chapters, path, options=None, on_progress=None, on_chapter=None,
+                      should_stop=None):
+    """整理各章（(标题, 正文)列表）并导出到path，返回全书统计；被中断时返回None，不留下半个文件
+
+    排版后的片段一取回就写入临时文件，完成后替换目标文件。
+    on_progress(已处理字数, 总字数)每段调用一次，on_chapter(章序号, 整章统计)每章结束时调用。
+    """
+    options = dict(DEFAULT_OPTIONS, **(options or {}))
+    fmt = options["format"]
+    total_chars = sum(len(text) for _, text in chapters)
+    totals = {}
+    done = 0
+    current = None
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "w", encoding="utf-8", newline="\n") as f:
+            f.write(document_head(fmt, title))
+            for index, text, _, length, chapter_total in processor.run(
+                    [text for _, text in chapters], options, should_stop):
+                if index != current:
+                    current = index
+                    f.write(chapter_head(fmt, chapters[index][0]))
+                f.write(text)
+                done += length
+                if on_progress is not None:
+                    on_progress(done, total_chars)
+                if chapter_total is not None:
+                    merge_counts(totals, chapter_total)
+                    if on_chapter is not None:
+                        on_chapter(index, chapter_total)
+            if should_stop is not None and should_stop():
+                raise InterruptedError
+            f.write(document_tail(fmt))
+        os.replace(temp_path, path)
+    except InterruptedError:
+        return None
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return totals
@@ -0,0 +1,405 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+# 项目文件的扩展名；索引文件为同名加.idx
+PROJECT_SUFFIX = ".novel"
+INDEX_SUFFIX = ".idx"
+
+# 记录类型
+KIND_META = 0  # 项目信息（JSON），以最后一条为准
+KIND_CHAPTER = 1  # 章节信息（JSON：标题、是否删除），以最后一条为准
+KIND_TEXT = 2  # 章节全文，之前的正文作废
+KIND_APPEND = 3  # 追加到章节末尾的文本
+KIND_GENERATION = 4  # 一次生成的记录（JSON：提示、模型、结果）
+
+# 一个章节最多连续这么多条追加记录，之后改写一次全文，读取时拼接的段数有上限
+MAX_APPENDS = 64
+# 最近读取过的章节正文在内存中保留的数量
+TEXT_CACHE_CHAPTERS = 8
+
+_LOG_MAGIC = b"NVLOG1\0\0"
+_INDEX_MAGIC = b"NVIDX1\0\0"
+# 文件头：魔数 + 8字节的日志标识，索引头中的标识与日志不一致时重建索引
+_FILE_HEADER = struct.Struct("<8s8s")
+# 日志记录头：魔数、类型、章节号、正文字节数、CRC32
+_RECORD_MAGIC = b"NVSG"
+_RECORD_HEADER = struct.Struct("<4sBIII")
+# 索引项：类型、章节号、正文在日志中的偏移、正文字节数
+_INDEX_ENTRY = struct.Struct("<BIQI")
+
+
+class ProjectError(Exception):
+    """项目文件无法打开或已损坏"""
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+class _Chapter:
+    """章节在索引中的状态，正文只记录位置，读取时再从日志中取"""
+    def __init__(self, chapter_id):
+        self.chapter_id = chapter_id
+        self.title = ""
+        self.deleted = False
+        self.segments = []  # 当前正文由这些(偏移, 字节数)依次拼接而成
+        self.size = 0  # 正文的UTF-8字节数
+
+
+class ProjectStore:
+    """只追加的小说项目文件
+
+    项目由两个文件组成：段日志（PROJECT_SUFFIX）依次追加章节、正文和生成记录，
+    从不改写已有内容；索引（同名加.idx）每条记录一个定长项，保存记录在日志中的位置。
+    打开时只读索引和章节信息，正文在查看时才通过内存映射从日志中读取；
+    保存只追加变化的部分（续写时只追加新增的文字），耗时与全书长度无关。
+    索引缺失、不完整或与日志不匹配时从日志扫描重建，日志末尾写了一半的记录会被截掉。
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        self.meta = {}
+        self._chapters = OrderedDict()  # chapter_id -> _Chapter，按创建顺序
+        self._generations = []  # 生成记录的(偏移, 字节数, 章节号)
+        self._texts = OrderedDict()  # 最近读取的章节正文
+        self._next_chapter_id = 1
+        self._map = None
+        self._open()
+
+    @classmethod
+    def open(cls, path):
+        """打开项目，文件不存在时新建"""
+        if not path.endswith(PROJECT_SUFFIX):
+            path += PROJECT_SUFFIX
+        return cls(path)
+
+    # ---------- 打开与索引 ----------
+
+    def _open(self):
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) > 0
+        self._log = open(self.path, "r+b" if exists else "w+b")
+        if exists:
+            magic, self._log_id = _FILE_HEADER.unpack(self._log.read(_FILE_HEADER.size).ljust(_FILE_HEADER.size, b"\0"))
+            if magic != _LOG_MAGIC:
+                self._log.close()
+                raise ProjectError(f"不是项目文件: {self.path}")
+        else:
+            self._log_id = os.urandom(8)
+            self._log.write(_FILE_HEADER.pack(_LOG_MAGIC, self._log_id))
+            self._log.flush()
+        entries = self._load_index()
+        self._log.seek(0, 2)
+        log_size = self._log.tell()
+        # 索引之后还有记录（写完日志、写索引前退出）时扫描补上
+        scan_from = _FILE_HEADER.size
+        if entries:
+            _, _, offset, length = entries[-1]
+            scan_from = offset + length
+        if scan_from < log_size:
+            new_entries = self._scan(scan_from, log_size)
+            for entry in new_entries:
+                self._index.write(_INDEX_ENTRY.pack(*entry))
+            self._index.flush()
+            entries.extend(new_entries)
+        for entry in entries:
+            self._apply(*entry)
+
+    def _load_index(self):
+        """读取索引项；索引无效时从日志重建"""
+        path = index_path(self.path)
+        entries = []
+        valid = False
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            if len(data) >= _FILE_HEADER.size and _FILE_HEADER.unpack_from(data) == (_INDEX_MAGIC, self._log_id):
+                valid = True
+                self._log.seek(0, 2)
+                log_size = self._log.tell()
+                count = (len(data) - _FILE_HEADER.size) // _INDEX_ENTRY.size
+                for i in range(count):
+                    entry = _INDEX_ENTRY.unpack_from(data, _FILE_HEADER.size + i * _INDEX_ENTRY.size)
+                    if entry[2] + entry[3] > log_size:
+                        break
+                    entries.append(entry)
+        if not valid:
+            entries = self._scan(_FILE_HEADER.size, None)
+        # 按有效的索引项重写文件长度，去掉写了一半的索引项
+        self._index = open(path, "r+b" if valid else "w+b")
+        if not valid:
+            self._index.write(_FILE_HEADER.pack(_INDEX_MAGIC, self._log_id))
+            for entry in entries:
+                self._index.write(_INDEX_ENTRY.pack(*entry))
+        self._index.truncate(_FILE_HEADER.size + len(entries) * _INDEX_ENTRY.size)
+        self._index.seek(0, 2)
+        self._index.flush()
+        return entries
+
+    def _scan(self, start, end):
+        """从日志的start处逐条读取记录头，返回索引项；遇到不完整或损坏的记录时截断日志"""
+        self._log.seek(0, 2)
+        log_size = self._log.tell()
+        if end is None:
+            end = log_size
+        entries = []
+        position = start
+        self._log.seek(position)
+        while position + _RECORD_HEADER.size <= end:
+            magic, kind, chapter_id, length, crc = _RECORD_HEADER.unpack(self._log.read(_RECORD_HEADER.size))
+            offset = position + _RECORD_HEADER.size
+            if magic != _RECORD_MAGIC or offset + length > end:
+                break
+            payload = self._log.read(length)
+            if zlib.crc32(payload) != crc:
+                break
+            entries.append((kind, chapter_id, offset, length))
+            position = offset + length
+        if position < log_size:
+            print(f"项目文件末尾有不完整的记录，已截断 {log_size - position} 字节: {self.path}")
+            self._close_map()
+            self._log.truncate(position)
+            self._log.flush()
+        return entries
+
+    def _apply(self, kind, chapter_id, offset, length):
+        """把一条记录应用到内存中的状态"""
+        if kind == KIND_META:
+            self.meta = self._read_json(offset, length)
+        elif kind == KIND_CHAPTER:
+            info = self._read_json(offset, length)
+            chapter = self._chapters.get(chapter_id)
+            if chapter is None:
+                chapter = self._chapters[chapter_id] = _Chapter(chapter_id)
+            chapter.title = info.get("title", "")
+            chapter.deleted = info.get("deleted", False)
+            self._next_chapter_id = max(self._next_chapter_id, chapter_id + 1)
+        elif kind in (KIND_TEXT, KIND_APPEND):
+            chapter = self._chapters.get(chapter_id)
+            if chapter is None:
+                return
+            if kind == KIND_TEXT:
+                chapter.segments = []
+                chapter.size = 0
+            chapter.segments.append((offset, length))
+            chapter.size += length
+        elif kind == KIND_GENERATION:
+            self._generations.append((offset, length, chapter_id))
+
+    # ---------- 读取 ----------
+
+    def _view(self):
+        """日志的只读内存映射，日志变长后重新映射"""
+        size = self._log_size()
+        if self._map is None or len(self._map) < size:
+            self._close_map()
+            self._map = mmap.mmap(self._log.fileno(), size, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _log_size(self):
+        self._log.seek(0, 2)
+        return self._log.tell()
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _read(self, offset, length):
+        return self._view()[offset:offset + length]
+
+    def _read_json(self, offset, length):
+        return json.loads(self._read(offset, length).decode("utf-8"))
+
+    def chapters(self):
+        """未删除的章节：[(章节号, 标题, 正文字节数)]，按创建顺序"""
+        with self._lock:
+            return [(c.chapter_id, c.title, c.size) for c in self._chapters.values() if not c.deleted]
+
+    def chapter_title(self, chapter_id):
+        with self._lock:
+            return self._chapter(chapter_id).title
+
+    def chapter_text(self, chapter_id):
+        """读取章节正文（拼接全文和之后的追加记录）"""
+        with self._lock:
+            text = self._texts.get(chapter_id)
+            if text is not None:
+                self._texts.move_to_end(chapter_id)
+                return text
+            chapter = self._chapter(chapter_id)
+            view = self._view()
+            text = b"".join(view[offset:offset + length] for offset, length in chapter.segments).decode("utf-8")
+            self._remember(chapter_id, text)
+            return text
+
+    def generations(self, chapter_id=None):
+        """生成记录（按时间顺序），chapter_id不为None时只返回该章节的"""
+        with self._lock:
+            return [self._read_json(offset, length) for offset, length, cid in self._generations
+                    if chapter_id is None or cid == chapter_id]
+
+    def generation_count(self):
+        with self._lock:
+            return len(self._generations)
+
+    def _chapter(self, chapter_id):
+        chapter = self._chapters.get(chapter_id)
+        if chapter is None or chapter.deleted:
+            raise KeyError(chapter_id)
+        return chapter
+
+    def _remember(self, chapter_id, text):
+        self._texts[chapter_id] = text
+        self._texts.move_to_end(chapter_id)
+        while len(self._texts) > TEXT_CACHE_CHAPTERS:
+            self._texts.popitem(last=False)
+
+    # ---------- 写入 ----------
+
+    def _append(self, kind, chapter_id, payload):
+        """追加一条记录：先写日志再写索引，两者都只在末尾追加"""
+        header = _RECORD_HEADER.pack(_RECORD_MAGIC, kind, chapter_id, len(payload), zlib.crc32(payload))
+        self._log.seek(0, 2)
+        offset = self._log.tell() + _RECORD_HEADER.size
+        self._log.write(header + payload)
+        self._log.flush()
+        entry = (kind, chapter_id, offset, len(payload))
+        self._index.write(_INDEX_ENTRY.pack(*entry))
+        self._index.flush()
+        self._apply(*entry)
+
+    def _append_json(self, kind, chapter_id, obj):
+        self._append(kind, chapter_id, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+    def set_meta(self, **values):
+        with self._lock:
+            meta = dict(self.meta)
+            meta.update(values)
+            self._append_json(KIND_META, 0, meta)
+
+    def add_chapter(self, title, text=""):
+        """新建章节，返回章节号"""
+        with self._lock:
+            chapter_id = self._next_chapter_id
+            self._append_json(KIND_CHAPTER, chapter_id, {"title": title, "created": time.time()})
+            if text:
+                self._append(KIND_TEXT, chapter_id, text.encode("utf-8"))
+            self._remember(chapter_id, text)
+            return chapter_id
+
+    def rename_chapter(self, chapter_id, title):
+        with self._lock:
+            self._chapter(chapter_id)
+            self._append_json(KIND_CHAPTER, chapter_id, {"title": title})
+
+    def delete_chapter(self, chapter_id):
+        """标记删除，正文在compact时才真正移除"""
+        with self._lock:
+            chapter = self._chapter(chapter_id)
+            self._append_json(KIND_CHAPTER, chapter_id, {"title": chapter.title, "deleted": True})
+            self._texts.pop(chapter_id, None)
+
+    def append_text(self, chapter_id, text):
+        """在章节末尾追加文本，只写入新增部分"""
+        if not text:
+            return
+        with self._lock:
+            chapter = self._chapter(chapter_id)
+            cached = self._texts.get(chapter_id)
+            if len(chapter.segments) >= MAX_APPENDS:
+                # 追加记录过多时改写一次全文，读取时不必拼接太多段
+                full = self.chapter_text(chapter_id) + text
+                self._append(KIND_TEXT, chapter_id, full.encode("utf-8"))
+                self._remember(chapter_id, full)
+                return
+            self._append(KIND_APPEND, chapter_id, text.encode("utf-8"))
+            if cached is not None:
+                self._remember(chapter_id, cached + text)
+
+    def set_chapter_text(self, chapter_id, text):
+        """保存章节正文：只在末尾增加了内容时追加新增部分，否则写入全文；没有变化时不写"""
+        with self._lock:
+            current = self.chapter_text(chapter_id)
+            if text == current:
+                return
+            if current and text.startswith(current):
+                self.append_text(chapter_id, text[len(current):])
+                return
+            self._append(KIND_TEXT, chapter_id, text.encode("utf-8"))
+            self._remember(chapter_id, text)
+
+    def add_generation(self, prompt, text, model_name="", chapter_id=0, **extra):
+        """记录一次生成（提示、模型、结果），与章节正文分开保存"""
+        record = {"time": time.time(), "model": model_name, "prompt": prompt, "text": text}
+        record.update(extra)
+        with self._lock:
+            self._append_json(KIND_GENERATION, chapter_id, record)
+
+    def sync(self):
+        """把已写入的内容刷到磁盘（写入时只刷到操作系统缓冲区）"""
+        with self._lock:
+            os.fsync(self._log.fileno())
+            os.fsync(self._index.fileno())
+
+    # ---------- 维护 ----------
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chapters": sum(1 for c in self._chapters.values() if not c.deleted),
+                "generations": len(self._generations),
+                "text_bytes": sum(c.size for c in self._chapters.values() if not c.deleted),
+                "log_bytes": self._log_size(),
+                "index_bytes": self._index.tell(),
+            }
+
+    def compact(self):
+        """重写项目文件，去掉已删除的章节和被覆盖的旧正文；生成记录全部保留"""
+        with self._lock:
+            tmp_path = self.path + ".compact"
+            for path in (tmp_path, index_path(tmp_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+            new = ProjectStore(tmp_path)
+            try:
+                if self.meta:
+                    new.set_meta(**self.meta)
+                for chapter in self._chapters.values():
+                    if chapter.deleted:
+                        continue
+                    new._append_json(KIND_CHAPTER, chapter.chapter_id, {"title": chapter.title})
+                    text = self.chapter_text(chapter.chapter_id)
+                    if text:
+                        new._append(KIND_TEXT, chapter.chapter_id, text.encode("utf-8"))
+                for offset, length, chapter_id in self._generations:
+                    new._append(KIND_GENERATION, chapter_id, bytes(self._read(offset, length)))
+                new.sync()
+            finally:
+                new.close()
+            self.close()
+            # 先替换日志：替换索引前退出时，索引标识与新日志不一致，下次打开会重建
+            os.replace(tmp_path, self.path)
+            os.replace(index_path(tmp_path), index_path(self.path))
+            self._load()
+
+    def close(self):
+        with self._lock:
+            self._close_map()
+            for f in (self._log, self._index):
+                if not f.closed:
+                    f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,363 @@
+import threading
+import time
+
+from llm_backend import ApiError
+
+# 429没有Retry-After时的首次等待（秒），连续被限流时翻倍
+DEFAULT_RETRY_AFTER = 2.0
+MAX_BACKOFF = 60.0
+# 一次请求因429最多重试的次数
+MAX_RATE_RETRIES = 5
+# 预约TPM时按这个数估计输出token，结束后按实际用量结算
+DEFAULT_OUTPUT_TOKENS = 1000
+# 等待配额时检查取消的间隔（秒）
+WAIT_STEP = 0.1
+
+# OpenAI兼容接口（SiliconFlow等）返回的限额头，限额按每分钟计
+LIMIT_HEADERS = {
+    "rpm": ("x-ratelimit-limit-requests", "x-ratelimit-remaining-requests"),
+    "tpm": ("x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens"),
+}
+
+
+def quota_key(api_type, api_key, model_name):
+    """配额按API类型、密钥和模型计算；密钥只保留摘要"""
+    import hashlib  # 只在发出请求时需要，不拖慢启动
+    fingerprint = hashlib.sha1(api_key.encode("utf-8")).hexdigest()[:12] if api_key else ""
+    return (api_type, fingerprint, model_name)
+
+
+def estimate_request_tokens(prompt):
+    """预约TPM用的token数：提示 + 预计输出"""
+    from token_estimator import estimate_tokens  # 延迟导入，未启用限流时不需要
+    return estimate_tokens(prompt) + DEFAULT_OUTPUT_TOKENS
+
+
+def used_tokens(decoder):
+    """从结束帧或usage读出本次实际消耗的token数，没有时返回None"""
+    if decoder is None:
+        return None
+    final = decoder.final_frame or {}
+    usage = getattr(decoder, "usage", None) or {}
+    if usage.get("total_tokens"):
+        return usage["total_tokens"]
+    if final.get("eval_count") is not None:
+        return final["eval_count"] + (final.get("prompt_eval_count") or 0)
+    if usage.get("completion_tokens") is not None:
+        return usage["completion_tokens"] + (usage.get("prompt_tokens") or 0)
+    return None
+
+
+def _header_number(headers, name):
+    try:
+        return int(float(headers[name]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """每分钟per_minute个令牌、连续补充的令牌桶
+
+    预约允许透支：余量不足时照样扣除，返回需要等待的秒数。
+    先预约的请求先轮到，后来的请求排在透支的部分之后，自然形成先进先出的匀速放行。
+    """
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.per_minute / 60.0
+
+    def _refill(self, now):
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount, now):
+        """退回（负数为补扣）令牌"""
+        self._refill(now)
+        self.level = min(self.per_minute, self.level + amount)
+
+    def set_limit(self, per_minute, now):
+        self._refill(now)
+        self.level = min(self.level, per_minute)
+        self.per_minute = per_minute
+
+    def clamp(self, remaining, now):
+        """服务端报告的剩余量比本地估计少时以服务端为准"""
+        self._refill(now)
+        self.level = min(self.level, remaining)
+
+
+class Quota:
+    """一个配额键的限流状态"""
+    def __init__(self):
+        self.rpm = None  # TokenBucket，None表示不限
+        self.tpm = None
+        self.learned = set()  # 从响应头学到的限额（"rpm"/"tpm"），优先于设置
+        self.blocked_until = 0.0  # 429之后在此之前不发送任何请求
+        self.failures = 0  # 连续429次数
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.throttled = 0
+
+
+class Reservation:
+    """一次预约：请求数1、token数tokens，delay为预约时计算的等待秒数"""
+    def __init__(self, key, tokens, delay):
+        self.key = key
+        self.tokens = tokens
+        self.delay = delay
+
+
+class RateLimiter:
+    """按配额键（API类型 + 密钥 + 模型）对请求限速，使请求数和token数保持在每分钟限额之内
+
+    限额可以按API类型设置，也会从响应头（x-ratelimit-*）学习；两者都没有时不限速，
+    只在收到429后按Retry-After暂停该键的所有请求。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limits = {}  # API类型 -> (rpm, tpm)，0表示不限
+        self._quotas = {}
+
+    def configure(self, api_type, rpm=0, tpm=0):
+        with self._lock:
+            self._limits[api_type] = (rpm, tpm)
+            now = time.monotonic()
+            for key, quota in self._quotas.items():
+                if key[0] == api_type:
+                    self._apply_limit(quota, "rpm", rpm, now, learned=False)
+                    self._apply_limit(quota, "tpm", tpm, now, learned=False)
+
+    def _apply_limit(self, quota, name, limit, now, learned):
+        if not learned and name in quota.learned:
+            return  # 服务端报告的限额更准确
+        if learned:
+            quota.learned.add(name)
+        bucket = getattr(quota, name)
+        if not limit:
+            setattr(quota, name, None)
+        elif bucket is None:
+            setattr(quota, name, TokenBucket(limit))
+        elif bucket.per_minute != limit:
+            bucket.set_limit(limit, now)
+
+    def _get(self, key, now):
+        quota = self._quotas.get(key)
+        if quota is None:
+            quota = self._quotas[key] = Quota()
+            rpm, tpm = self._limits.get(key[0], (0, 0))
+            self._apply_limit(quota, "rpm", rpm, now, learned=False)
+            self._apply_limit(quota, "tpm", tpm, now, learned=False)
+        return quota
+
+    def reserve(self, key, tokens):
+        """预约一次请求，返回Reservation；等待delay秒后再发送"""
+        with self._lock:
+            now = time.monotonic()
+            quota = self._get(key, now)
+            delay = max(0.0, quota.blocked_until - now)
+            if quota.rpm is not None:
+                delay = max(delay, quota.rpm.reserve(1, now))
+            if quota.tpm is not None:
+                delay = max(delay, quota.tpm.reserve(tokens, now))
+            if delay > 0:
+                quota.waits += 1
+                quota.wait_seconds += delay
+            return Reservation(key, tokens, delay)
+
+    def blocked_for(self, key):
+        """该键因429还需暂停的秒数"""
+        with self._lock:
+            quota = self._quotas.get(key)
+            return max(0.0, quota.blocked_until - time.monotonic()) if quota is not None else 0.0
+
+    def release(self, reservation):
+        """请求没有发出（被取消或要重试），退回预约的配额"""
+        with self._lock:
+            now = time.monotonic()
+            quota = self._get(reservation.key, now)
+            if quota.rpm is not None:
+                quota.rpm.refund(1, now)
+            if quota.tpm is not None:
+                quota.tpm.refund(reservation.tokens, now)
+
+    def settle(self, reservation, tokens):
+        """请求完成，按实际token数结算多退少补"""
+        with self._lock:
+            now = time.monotonic()
+            quota = self._get(reservation.key, now)
+            quota.failures = 0
+            if quota.tpm is not None and tokens is not None:
+                quota.tpm.refund(reservation.tokens - tokens, now)
+
+    def update_from_headers(self, key, headers):
+        """从响应头学习限额和剩余量"""
+        with self._lock:
+            now = time.monotonic()
+            quota = self._get(key, now)
+            for name, (limit_header, remaining_header) in LIMIT_HEADERS.items():
+                limit = _header_number(headers, limit_header)
+                if limit:
+                    self._apply_limit(quota, name, limit, now, learned=True)
+                remaining = _header_number(headers, remaining_header)
+                bucket = getattr(quota, name)
+                if remaining is not None and bucket is not None:
+                    bucket.clamp(remaining, now)
+
+    def throttled(self, key, retry_after=None):
+        """收到429：按Retry-After（没有时指数退避）暂停该键，返回暂停秒数"""
+        with self._lock:
+            now = time.monotonic()
+            quota = self._get(key, now)
+            quota.failures += 1
+            quota.throttled += 1
+            if retry_after is None:
+                retry_after = min(MAX_BACKOFF, DEFAULT_RETRY_AFTER * (2 ** (quota.failures - 1)))
+            quota.blocked_until = max(quota.blocked_until, now + retry_after)
+            # 本地估计的余量显然偏多，清空后按速率重新积累
+            for bucket in (quota.rpm, quota.tpm):
+                if bucket is not None:
+                    bucket.clamp(0, now)
+            return retry_after
+
+    def stats(self, key):
+        with self._lock:
+            quota = self._quotas.get(key)
+            if quota is None:
+                return {"rpm": None, "tpm": None, "waits": 0, "wait_seconds": 0.0, "throttled": 0}
+            return {
+                "rpm": quota.rpm.per_minute if quota.rpm is not None else None,
+                "tpm": quota.tpm.per_minute if quota.tpm is not None else None,
+                "waits": quota.waits,
+                "wait_seconds": quota.wait_seconds,
+                "throttled": quota.throttled,
+            }
+
+
+def _sleep(seconds, should_stop):
+    """可取消的等待，被取消时返回False"""
+    deadline = time.monotonic() + seconds
+    while True:
+        if should_stop is not None and should_stop():
+            return False
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return True
+        time.sleep(min(WAIT_STEP, remaining))
+
+
+def _abandon(limiter, reservation, sent):
+    """尝试出错结束：请求没有到达服务端时退回配额，否则按预约的用量结算"""
+    if sent:
+        limiter.settle(reservation, None)
+    else:
+        limiter.release(reservation)
+
+
+def run_with_quota(key, tokens, attempt, should_stop=None, on_wait=None, limiter=None):
+    """同步：等到配额允许后调用attempt(on_headers)，429时按Retry-After等待后重试
+
+    attempt返回解码器，完成后按实际用量结算。on_wait(秒数)在需要等待时调用。
+    等待期间被取消时不发送请求，返回None。
+    """
+    limiter = limiter or get_rate_limiter()
+    sent = [False]  # 本次尝试是否已收到响应头（请求已到达服务端）
+
+    def on_headers(headers):
+        sent[0] = True
+        limiter.update_from_headers(key, headers)
+
+    for retry in range(MAX_RATE_RETRIES + 1):
+        reservation = limiter.reserve(key, tokens)
+        sent[0] = False
+        delay = reservation.delay
+        while delay > 0:
+            if on_wait is not None:
+                on_wait(delay)
+            if not _sleep(delay, should_stop):
+                limiter.release(reservation)
+                return None
+            # 等待期间其他请求收到429时继续等
+            delay = limiter.blocked_for(key)
+        try:
+            decoder = attempt(on_headers)
+        except ApiError as e:
+            if e.status != 429:
+                _abandon(limiter, reservation, sent[0])
+                raise
+            limiter.release(reservation)
+            if retry == MAX_RATE_RETRIES:
+                raise
+            wait = limiter.throttled(key, e.retry_after)
+            print(f"请求被限流（429），{wait:.1f}秒后重试")
+            continue
+        except BaseException:
+            # 连接错误、重复循环截断、取消等：同样退回或结算预约，不让估算的用量一直占着配额
+            _abandon(limiter, reservation, sent[0])
+            raise
+        limiter.settle(reservation, used_tokens(decoder))
+        return decoder
+
+
+async def async_run_with_quota(key, tokens, attempt, on_wait=None, limiter=None):
+    """异步版本的run_with_quota，attempt(on_headers)返回协程，取消由协程取消完成"""
+    import asyncio
+    limiter = limiter or get_rate_limiter()
+    sent = [False]
+
+    def on_headers(headers):
+        sent[0] = True
+        limiter.update_from_headers(key, headers)
+
+    for retry in range(MAX_RATE_RETRIES + 1):
+        reservation = limiter.reserve(key, tokens)
+        sent[0] = False
+        try:
+            delay = reservation.delay
+            while delay > 0:
+                if on_wait is not None:
+                    on_wait(delay)
+                await asyncio.sleep(delay)
+                delay = limiter.blocked_for(key)
+        except asyncio.CancelledError:
+            limiter.release(reservation)
+            raise
+        try:
+            decoder = await attempt(on_headers)
+        except ApiError as e:
+            if e.status != 429:
+                _abandon(limiter, reservation, sent[0])
+                raise
+            limiter.release(reservation)
+            if retry == MAX_RATE_RETRIES:
+                raise
+            wait = limiter.throttled(key, e.retry_after)
+            print(f"请求被限流（429），{wait:.1f}秒后重试")
+            continue
+        except BaseException:
+            # 连接错误、重复循环截断、取消等：同样退回或结算预约，不让估算的用量一直占着配额
+            _abandon(limiter, reservation, sent[0])
+            raise
+        limiter.settle(reservation, used_tokens(decoder))
+        return decoder
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """获取进程级共享的限流器"""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
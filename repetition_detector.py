@@ -0,0 +1,115 @@
+from collections import deque
+
+# 比较的片段长度（字）：连续这么多字与前文完全相同才算一次重复
+NGRAM_CHARS = 16
+# 只在最近这么多字里查找重复，内存和耗时与输出总长度无关
+WINDOW_CHARS = 4000
+# 连续这么多字都在重复前文时判定为陷入循环
+MIN_REPEAT_CHARS = 200
+
+# 截断后继续生成时的采样调整：提高温度和重复惩罚，扩大惩罚的回看范围
+RETRY_TEMPERATURE_STEP = 0.15
+MAX_RETRY_TEMPERATURE = 1.2
+RETRY_REPEAT_PENALTY_STEP = 0.2  # Ollama的repeat_penalty，默认1.1
+RETRY_REPEAT_LAST_N = 256  # Ollama的repeat_last_n，默认64
+RETRY_FREQUENCY_PENALTY_STEP = 0.5  # OpenAI兼容接口的frequency_penalty，默认0
+
+CONTINUE_PROMPT = "{prompt}\n\n【已写部分】\n{text}\n\n请紧接已写部分继续写下去，不要重复已写的内容。"
+
+_HASH_BASE = 1000003
+_HASH_MOD = (1 << 61) - 1
+
+
+class RepetitionLoop(Exception):
+    """流式输出陷入重复循环，由增量回调抛出以中断当前请求"""
+
+
+class RepetitionDetector:
+    """流式输出的重复循环检测
+
+    对输出（忽略空白）中每个长度为ngram的片段计算滚动哈希，记录最近window字内出现过的哈希。
+    新片段在窗口内出现过即为重复；连续min_repeat字都是重复时判定为循环，
+    此时从这段重复开始的位置截断，之前的内容（循环的第一遍）保留。
+    每个字只做常数次整数运算，不保留窗口以外的文本。
+    """
+    def __init__(self, ngram=NGRAM_CHARS, window=WINDOW_CHARS, min_repeat=MIN_REPEAT_CHARS):
+        self.ngram = ngram
+        self.window = window
+        self.min_repeat = min_repeat
+        self._power = pow(_HASH_BASE, ngram, _HASH_MOD)
+        self._clear()
+
+    def _clear(self):
+        self._codes = deque()  # 当前片段中各字的编码
+        self._hash = 0
+        self._hashes = deque()  # 窗口内各片段的哈希，按出现顺序
+        self._counts = {}  # 哈希 -> 窗口内出现次数
+        self._offsets = deque(maxlen=self.min_repeat + self.ngram)  # 最近各字（忽略空白）在原文中的位置
+        self._run = 0  # 连续重复的片段数
+        self.fed = 0  # 已输入的字数（包括空白）
+
+    def feed(self, text):
+        """输入一段增量；判定为循环时返回应保留的字数（从第一次feed算起），否则返回None"""
+        return self._feed(text, True)
+
+    def _feed(self, text, detect):
+        """detect为False时只更新窗口，不判定循环，保证整段文本都被计入"""
+        for ch in text:
+            offset = self.fed
+            self.fed += 1
+            if ch.isspace():
+                continue
+            self._offsets.append(offset)
+            code = ord(ch)
+            self._codes.append(code)
+            self._hash = (self._hash * _HASH_BASE + code) % _HASH_MOD
+            if len(self._codes) > self.ngram:
+                self._hash = (self._hash - self._codes.popleft() * self._power) % _HASH_MOD
+            elif len(self._codes) < self.ngram:
+                continue
+            if self._counts.get(self._hash):
+                self._run += 1
+            else:
+                self._run = 0
+            self._counts[self._hash] = self._counts.get(self._hash, 0) + 1
+            self._hashes.append(self._hash)
+            if len(self._hashes) > self.window:
+                old = self._hashes.popleft()
+                self._counts[old] -= 1
+                if not self._counts[old]:
+                    del self._counts[old]
+            if detect and self._run >= self.min_repeat:
+                # 第一个重复片段的起点就是这一遍循环的开头
+                return self._offsets[-(self._run + self.ngram - 1)]
+        return None
+
+    def reset(self, history=""):
+        """清空状态，把history（截断后保留的全部正文）的末尾放入窗口，继续生成时重复它也能检测到
+
+        之后feed返回的位置仍从history的开头算起。
+        """
+        self._clear()
+        tail = history[-self.window:]
+        self.fed = len(history) - len(tail)
+        self._feed(tail, False)
+        self._run = 0
+
+
+def retry_sampling(sampling, api_type, api_format=None):
+    """截断后继续生成使用的采样参数：在原有参数基础上提高温度和重复惩罚"""
+    ollama = api_type == "Ollama" or (api_type == "自定义" and api_format == "Ollama格式")
+    sampling = dict(sampling or {})
+    temperature = sampling.get("temperature", 0.7) + RETRY_TEMPERATURE_STEP
+    sampling["temperature"] = round(min(MAX_RETRY_TEMPERATURE, temperature), 2)
+    if ollama:
+        sampling["repeat_penalty"] = round(sampling.get("repeat_penalty", 1.1) + RETRY_REPEAT_PENALTY_STEP, 2)
+        sampling["repeat_last_n"] = max(sampling.get("repeat_last_n", 64), RETRY_REPEAT_LAST_N)
+    else:
+        penalty = sampling.get("frequency_penalty", 0.0) + RETRY_FREQUENCY_PENALTY_STEP
+        sampling["frequency_penalty"] = round(min(2.0, penalty), 2)
+    return sampling
+
+
+def continuation_prompt(prompt, text):
+    """截断后继续生成的提示：原提示 + 已保留的正文"""
+    return CONTINUE_PROMPT.format(prompt=prompt, text=text)
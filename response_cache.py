@@ -0,0 +1,129 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# 默认缓存参数
+DEFAULT_CACHE_PATH = "response_cache.sqlite3"
+DEFAULT_MEMORY_ITEMS = 64  # 内存层最多保留的条目数
+DEFAULT_MAX_DISK_BYTES = 64 * 1024 * 1024  # 磁盘层最大容量（字节）
+
+# 请求数据中不属于采样参数的字段
+_NON_SAMPLING_FIELDS = ("model", "prompt", "messages", "stream", "keep_alive")
+
+
+def sampling_params(data):
+    """从请求数据中取出采样参数（温度、最大长度等）"""
+    return {k: v for k, v in data.items() if k not in _NON_SAMPLING_FIELDS}
+
+
+def make_cache_key(api_type, api_url, model_name, prompt, params):
+    """根据API类型、地址、模型、提示词和采样参数计算缓存键"""
+    raw = json.dumps([api_type, api_url, model_name, prompt, params],
+                     ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """两级响应缓存：内存LRU + SQLite磁盘层
+
+    磁盘层按总字节数淘汰最久未使用的条目。所有方法都可在工作线程中调用。
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, memory_items=DEFAULT_MEMORY_ITEMS,
+                 max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.path = path
+        self.memory_items = memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        """查询缓存，未命中返回None"""
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return text
+            row = self._conn.execute(
+                "SELECT text FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            self._remember(key, row[0])
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, text):
+        """写入缓存，并在磁盘层超出容量时淘汰旧条目"""
+        size = len(text.encode("utf-8"))
+        if size > self.max_disk_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, text)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, text, size, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?)", (key, text, size, now, now)
+            )
+            self._evict()
+            self._conn.commit()
+
+    def clear(self):
+        """清空两级缓存"""
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def disk_usage(self):
+        """磁盘层当前占用的字节数"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _remember(self, key, text):
+        self._memory[key] = text
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        total = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_disk_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            total -= size
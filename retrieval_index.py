@@ -0,0 +1,424 @@
+import array
+import base64
+import json
+import math
+import os
+import re
+import threading
+import zlib
+
+from http_pool import CancelToken, SessionPool, get_session_pool
+from llm_backend import ApiError
+from token_estimator import estimate_tokens
+
+# 项目的检索索引保存在项目文件旁边；不在项目中的生成结果使用单独的索引文件
+INDEX_SUFFIX = ".ridx"
+RETRIEVAL_INDEX_FILE = "retrieval_index.json"
+INDEX_VERSION = 1
+
+# 正文按段落切成约这么多字的片段，片段是检索和注入的最小单位
+PASSAGE_CHARS = 300
+# BM25参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 查询最多使用这么多个最有区分度的词，长查询的耗时不随长度增长
+MAX_QUERY_TERMS = 64
+# 出现在超过这个比例的片段中的词几乎没有区分度，检索时跳过
+COMMON_TERM_RATIO = 0.5
+# 得分低于最高分这个比例的片段不注入
+MIN_SCORE_RATIO = 0.3
+# 有向量时，先按关键词取这么多个候选，再按向量相似度重排
+RERANK_CANDIDATES = 50
+# 重排时关键词得分和向量相似度的权重
+VECTOR_WEIGHT = 0.5
+# 检索用的查询：写作要求 + 最近这么多字的正文
+QUERY_TAIL_CHARS = 500
+
+DEFAULT_TOP_K = 5
+DEFAULT_RETRIEVAL_BUDGET = 600
+# 每次向向量服务发送的片段数
+EMBED_BATCH = 32
+EMBED_TIMEOUT = 120
+
+_RUN_PATTERN = re.compile(r"[0-9A-Za-z]+|[㐀-䶿一-鿿豈-﫿]+")
+_SENTENCE_END = re.compile(r"(?<=[。！？!?…])")
+
+
+def terms(text):
+    """切词：汉字按相邻两字（单字成段时取单字），字母数字按整词（小写）"""
+    result = []
+    for run in _RUN_PATTERN.findall(text):
+        if run[0] < "㐀":
+            result.append(run.lower())
+        elif len(run) == 1:
+            result.append(run)
+        else:
+            result.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return result
+
+
+def split_passages(text, size=PASSAGE_CHARS):
+    """按段落把正文切成约size字的片段，过长的段落按句子再切"""
+    passages = []
+    current = ""
+    for paragraph in text.split("\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        pieces = [paragraph]
+        if len(paragraph) > size * 3 // 2:
+            pieces, piece = [], ""
+            for sentence in _SENTENCE_END.split(paragraph):
+                if piece and len(piece) + len(sentence) > size:
+                    pieces.append(piece)
+                    piece = ""
+                piece += sentence
+            if piece:
+                pieces.append(piece)
+        for piece in pieces:
+            current = (current + "\n" + piece) if current else piece
+            if len(current) >= size:
+                passages.append(current)
+                current = ""
+    if current:
+        passages.append(current)
+    return passages
+
+
+def format_context(snippets):
+    """检索到的片段组成注入提示的前文部分"""
+    if not snippets:
+        return ""
+    return "【相关前文】（节选，供保持人物和情节一致，不要重复）\n" + "\n……\n".join(snippets) + "\n\n"
+
+
+def _norm(vector):
+    return math.sqrt(sum(x * x for x in vector)) or 1.0
+
+
+class Passage:
+    """索引中的一个片段"""
+    def __init__(self, source, text):
+        self.source = source  # 来源：章节（chapter:编号）或不在项目中的生成结果
+        self.text = text
+        self.length = 0  # 词数
+        self.tokens = estimate_tokens(text)  # 注入提示时占用的估算token数
+        self.vector = None  # array("f")，没有向量时为None
+        self.norm = 1.0
+
+
+class RetrievalIndex:
+    """本地检索索引：汉字二元组倒排索引（BM25），可选用Ollama的向量模型重排
+
+    正文增量加入：只切分、索引新增的部分。检索先按关键词打分，
+    有向量时对得分最高的候选按向量相似度重排，最后在token预算内返回片段。
+    向量由调用方在后台计算（pending_embeddings / set_vectors），检索本身不发送网络请求。
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._passages = {}  # 片段号 -> Passage，片段号递增，即写入顺序
+        self._lengths = {}  # 片段号 -> 词数，打分时直接查表
+        self._postings = {}  # 词 -> {片段号: 词频}
+        self._sources = {}  # 来源 -> {"bytes": 已索引的字节数, "tail": 末尾校验值}
+        self._total_length = 0
+        self._next_id = 1
+        self.embedding_model = ""
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path):
+        """从文件读取索引（倒排表重新构建），文件不存在或损坏时返回空索引"""
+        index = cls(path)
+        if not os.path.exists(path):
+            return index
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("version") != INDEX_VERSION:
+                return index
+            index.embedding_model = state.get("embedding_model", "")
+            index._sources = state.get("sources", {})
+            for pid, source, text, vector in state.get("passages", []):
+                passage = index._add_passage(pid, source, text)
+                if vector:
+                    passage.vector = array.array("f", base64.b64decode(vector))
+                    passage.norm = _norm(passage.vector)
+            index._next_id = state.get("next_id", index._next_id)
+        except Exception as e:
+            print(f"加载检索索引失败: {e}")
+            return cls(path)
+        return index
+
+    def save(self):
+        """写入临时文件后替换，中途退出不会留下半个文件"""
+        if not self.path:
+            return
+        with self._lock:
+            state = {
+                "version": INDEX_VERSION,
+                "embedding_model": self.embedding_model,
+                "next_id": self._next_id,
+                "sources": dict(self._sources),
+                "passages": [
+                    [pid, p.source, p.text,
+                     base64.b64encode(p.vector.tobytes()).decode("ascii") if p.vector is not None else None]
+                    for pid, p in self._passages.items()
+                ],
+            }
+            self.dirty = False
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self._passages)
+
+    # ---------- 写入 ----------
+
+    def _add_passage(self, pid, source, text):
+        """调用时已持有锁（或索引尚未共享）"""
+        passage = Passage(source, text)
+        counts = {}
+        for term in terms(text):
+            counts[term] = counts.get(term, 0) + 1
+        passage.length = sum(counts.values())
+        for term, count in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+            postings[pid] = count
+        self._passages[pid] = passage
+        self._lengths[pid] = passage.length
+        self._total_length += passage.length
+        self._next_id = max(self._next_id, pid + 1)
+        return passage
+
+    def add_text(self, source, text):
+        """加入新增的正文，返回新增的片段数"""
+        passages = split_passages(text)
+        with self._lock:
+            for passage_text in passages:
+                self._add_passage(self._next_id, source, passage_text)
+            if passages:
+                self.dirty = True
+        return len(passages)
+
+    def remove_source(self, source):
+        """删除某个来源的全部片段（章节被删除或改写）"""
+        with self._lock:
+            self._remove_source(source)
+
+    def _remove_source(self, source):
+        removed = [pid for pid, p in self._passages.items() if p.source == source]
+        for pid in removed:
+            passage = self._passages.pop(pid)
+            del self._lengths[pid]
+            self._total_length -= passage.length
+            for term in set(terms(passage.text)):
+                postings = self._postings.get(term)
+                if postings is not None:
+                    postings.pop(pid, None)
+                    if not postings:
+                        del self._postings[term]
+        self._sources.pop(source, None)
+        if removed:
+            self.dirty = True
+
+    def sync_source(self, source, size, read_text):
+        """使某个来源的索引与其全文一致，返回新增的片段数
+
+        size是全文的UTF-8字节数，与已索引的相同时不读取全文；
+        全文只在末尾追加了内容时只索引新增部分，否则整个来源重新索引。
+        """
+        with self._lock:
+            state = self._sources.get(source)
+        if state is not None and state["bytes"] == size:
+            return 0
+        data = read_text().encode("utf-8")
+        start = 0
+        if state is not None and len(data) >= state["bytes"] \
+                and zlib.crc32(data[max(0, state["bytes"] - 64):state["bytes"]]) == state["tail"]:
+            start = state["bytes"]
+        else:
+            self.remove_source(source)
+        added = self.add_text(source, data[start:].decode("utf-8"))
+        with self._lock:
+            self._sources[source] = {"bytes": len(data), "tail": zlib.crc32(data[max(0, len(data) - 64):])}
+            self.dirty = True
+        return added
+
+    def sync_project(self, project, should_stop=None):
+        """按项目的章节更新索引，只读取有变化的章节；项目文件不跨线程共享，只在打开它的线程中调用"""
+        return self.sync_chapters(
+            [(chapter_id, size, lambda chapter_id=chapter_id: project.chapter_text(chapter_id))
+             for chapter_id, _, size in project.chapters()],
+            should_stop
+        )
+
+    def sync_chapters(self, chapters, should_stop=None):
+        """按章节列表[(章节号, 正文字节数, 读取正文的函数)]更新索引：
+        新增、追加和改写的章节重新索引，不在列表中的章节移除
+        """
+        added = 0
+        live = set()
+        for chapter_id, size, read_text in chapters:
+            if should_stop is not None and should_stop():
+                return added
+            source = f"chapter:{chapter_id}"
+            live.add(source)
+            added += self.sync_source(source, size, read_text)
+        with self._lock:
+            stale = {p.source for p in self._passages.values() if p.source.startswith("chapter:")}
+            stale |= {source for source in self._sources if source.startswith("chapter:")}
+        for source in stale - live:
+            self.remove_source(source)
+        return added
+
+    # ---------- 向量 ----------
+
+    def set_embedding_model(self, model):
+        """换用其他向量模型时清空已有向量"""
+        with self._lock:
+            if model == self.embedding_model:
+                return
+            self.embedding_model = model
+            for passage in self._passages.values():
+                passage.vector = None
+            self.dirty = True
+
+    def pending_embeddings(self, limit=EMBED_BATCH):
+        """还没有向量的片段：[(片段号, 正文)]"""
+        with self._lock:
+            if not self.embedding_model:
+                return []
+            pending = []
+            for pid, passage in self._passages.items():
+                if passage.vector is None:
+                    pending.append((pid, passage.text))
+                    if len(pending) >= limit:
+                        break
+            return pending
+
+    def set_vectors(self, pids, vectors, model):
+        """保存后台计算的向量；期间模型被更换或片段被删除时忽略"""
+        with self._lock:
+            if model != self.embedding_model:
+                return
+            for pid, vector in zip(pids, vectors):
+                passage = self._passages.get(pid)
+                if passage is not None:
+                    passage.vector = array.array("f", vector)
+                    passage.norm = _norm(passage.vector)
+            self.dirty = True
+
+    # ---------- 检索 ----------
+
+    def search(self, query, top_k=DEFAULT_TOP_K, budget_tokens=DEFAULT_RETRIEVAL_BUDGET, exclude="",
+               query_vector=None):
+        """返回与查询最相关的片段正文（按原文顺序），总估算token数不超过预算
+
+        exclude中已经出现的片段（如故事记忆里的最近原文）不再返回。
+        """
+        with self._lock:
+            count = len(self._passages)
+            if not count:
+                return []
+            average = self._total_length / count or 1.0
+            weighted = []
+            for term in set(terms(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                df = len(postings)
+                if count > 10 and df > count * COMMON_TERM_RATIO:
+                    continue
+                weighted.append((math.log(1 + (count - df + 0.5) / (df + 0.5)), postings))
+            weighted.sort(key=lambda item: item[0], reverse=True)
+            scores = {}
+            get = scores.get
+            lengths = self._lengths
+            base = BM25_K1 * (1 - BM25_B)
+            scale = BM25_K1 * BM25_B / average
+            for idf, postings in weighted[:MAX_QUERY_TERMS]:
+                weight = idf * (BM25_K1 + 1)
+                for pid, tf in postings.items():
+                    scores[pid] = get(pid, 0.0) + weight * tf / (tf + base + scale * lengths[pid])
+            if not scores:
+                return []
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+            top = ranked[0][1]
+            ranked = [(pid, score) for pid, score in ranked if score >= top * MIN_SCORE_RATIO]
+            if query_vector is not None:
+                ranked = self._rerank(ranked[:RERANK_CANDIDATES], top, query_vector)
+            chosen = []
+            remaining = budget_tokens
+            for pid, _ in ranked:
+                if len(chosen) >= top_k or remaining <= 0:
+                    break
+                passage = self._passages[pid]
+                if passage.tokens > remaining or (exclude and passage.text[:50] in exclude):
+                    continue
+                chosen.append((pid, passage.text))
+                remaining -= passage.tokens
+        chosen.sort()
+        return [text for _, text in chosen]
+
+    def _rerank(self, ranked, top, query_vector):
+        """关键词得分（归一化）与向量余弦相似度加权，调用时已持有锁"""
+        query_norm = _norm(query_vector)
+        rescored = []
+        for pid, score in ranked:
+            passage = self._passages[pid]
+            similarity = 0.0
+            if passage.vector is not None and len(passage.vector) == len(query_vector):
+                dot = sum(a * b for a, b in zip(passage.vector, query_vector))
+                similarity = max(0.0, dot / (passage.norm * query_norm))
+            rescored.append((pid, (1 - VECTOR_WEIGHT) * score / top + VECTOR_WEIGHT * similarity))
+        rescored.sort(key=lambda item: item[1], reverse=True)
+        return rescored
+
+    def stats(self):
+        with self._lock:
+            return {
+                "passages": len(self._passages),
+                "terms": len(self._postings),
+                "vectors": sum(1 for p in self._passages.values() if p.vector is not None),
+            }
+
+
+def embed_texts(base_url, model, texts, cancel_token=None):
+    """调用Ollama的向量接口，返回与texts一一对应的向量
+
+    优先使用批量接口/api/embed，旧版Ollama没有时逐条调用/api/embeddings。
+    """
+    pool = get_session_pool()
+    token = cancel_token if cancel_token is not None else CancelToken()
+    base = SessionPool.endpoint_key(base_url)
+    headers = {"Content-Type": "application/json"}
+    timeout = (pool.connect_timeout, EMBED_TIMEOUT)
+    try:
+        with token:
+            with pool.post(base + "/api/embed", headers=headers, timeout=timeout,
+                           data=json.dumps({"model": model, "input": texts})) as response:
+                if response.status_code == 200:
+                    return response.json()["embeddings"]
+                if response.status_code != 404:
+                    raise ApiError(f"向量请求失败: {response.status_code} - {response.text[:200]}",
+                                   status=response.status_code)
+            vectors = []
+            for text in texts:
+                with pool.post(base + "/api/embeddings", headers=headers, timeout=timeout,
+                               data=json.dumps({"model": model, "prompt": text})) as response:
+                    if response.status_code != 200:
+                        raise ApiError(f"向量请求失败: {response.status_code} - {response.text[:200]}",
+                                       status=response.status_code)
+                    vectors.append(response.json()["embedding"])
+            return vectors
+    except ApiError:
+        raise
+    except Exception as e:
+        if token.cancelled:
+            raise ApiError("向量请求已取消")
+        raise ApiError(f"向量请求失败: {type(e).__name__}")
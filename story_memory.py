@@ -0,0 +1,239 @@
+import json
+import os
+import threading
+
+from token_estimator import estimate_tokens
+
+# 正文累计到这么多字就结束一章并在后台生成章节概要
+CHAPTER_CHARS = 2000
+# 每满这么多条未合并的章节概要，合并为一条篇章概要
+CHAPTERS_PER_ARC = 5
+# 每满这么多条未合并的篇章概要，并入全书概要
+ARCS_PER_BOOK = 5
+# 各层概要要求的最大字数；模型超出时按两倍截断，保证提示长度有上限
+CHAPTER_SUMMARY_CHARS = 200
+ARC_SUMMARY_CHARS = 400
+BOOK_SUMMARY_CHARS = 800
+# 只保留最近这么多字的原文，用于续写时提供最近几段
+RECENT_TEXT_CHARS = 6000
+
+# 续写提示中记忆部分的默认token预算和最近原文段落数
+DEFAULT_BUDGET_TOKENS = 1500
+DEFAULT_RECENT_PARAGRAPHS = 3
+
+CHAPTER_PROMPT = "请用不超过{limit}字概括以下小说片段的情节要点，保留人物、地点、关键事件和伏笔，只输出概要：\n\n{text}"
+ARC_PROMPT = "请把以下按时间顺序排列的章节概要合并为一段不超过{limit}字的情节概要，只输出概要：\n\n{text}"
+BOOK_PROMPT = ("以下是小说已有的全书概要和之后新发生的情节，请合并为一段不超过{limit}字的全书概要，"
+               "保留主线和重要伏笔，只输出概要：\n\n【已有概要】\n{book}\n\n【新情节】\n{text}")
+
+
+def _clip(text, limit):
+    """截断模型返回的概要，避免个别超长概要撑大后续提示"""
+    text = text.strip()
+    return text if len(text) <= limit * 2 else text[:limit * 2] + "……"
+
+
+def _fit(text, budget, keep_tail=False):
+    """截取文本使其估算token数不超过预算"""
+    if estimate_tokens(text) <= budget:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        part = text[-mid:] if keep_tail else text[:mid]
+        if estimate_tokens(part) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    if low == 0:
+        return ""
+    return ("……" + text[-low:]) if keep_tail else (text[:low] + "……")
+
+
+class StoryMemory:
+    """滚动的故事记忆：章节概要 -> 篇章概要 -> 全书概要
+
+    每次生成完成后用add_text追加正文，正文累计满一章就等待概要；
+    update在后台线程中调用模型生成各层概要。续写提示由build_prompt
+    按固定token预算组装，不随全书长度增长。
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.book_summary = ""
+        self.arc_summaries = []  # 尚未并入全书概要的篇章概要
+        self.chapter_summaries = []  # 尚未合并为篇章概要的章节概要
+        self.pending_chapters = []  # 已结束、等待生成概要的章节正文
+        self.current_chapter = ""  # 正在写的章节正文
+        self.recent_text = ""  # 最近的原文（只保留末尾RECENT_TEXT_CHARS字）
+        self.total_chars = 0
+        self.chapter_count = 0  # 已生成概要的章节数
+
+    @classmethod
+    def load(cls, path):
+        """从JSON文件读取记忆，文件不存在或损坏时返回空记忆"""
+        memory = cls(path)
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                for key in ("book_summary", "arc_summaries", "chapter_summaries", "pending_chapters",
+                            "current_chapter", "recent_text", "total_chars", "chapter_count"):
+                    if key in state:
+                        setattr(memory, key, state[key])
+            except Exception as e:
+                print(f"加载故事记忆失败: {e}")
+        return memory
+
+    def save(self):
+        """写入临时文件后替换，中途退出不会留下半个文件"""
+        if not self.path:
+            return
+        with self._lock:
+            state = {
+                "book_summary": self.book_summary,
+                "arc_summaries": list(self.arc_summaries),
+                "chapter_summaries": list(self.chapter_summaries),
+                "pending_chapters": list(self.pending_chapters),
+                "current_chapter": self.current_chapter,
+                "recent_text": self.recent_text,
+                "total_chars": self.total_chars,
+                "chapter_count": self.chapter_count,
+            }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+        self.save()
+
+    @property
+    def is_empty(self):
+        return self.total_chars == 0
+
+    def add_text(self, text):
+        """追加新生成的正文，满一章时结束该章，返回是否有待生成的概要"""
+        text = text.strip()
+        if not text:
+            return self.needs_update()
+        with self._lock:
+            separator = "\n\n" if self.recent_text else ""
+            self.recent_text = (self.recent_text + separator + text)[-RECENT_TEXT_CHARS:]
+            self.current_chapter = (self.current_chapter + "\n\n" + text) if self.current_chapter else text
+            self.total_chars += len(text)
+            if len(self.current_chapter) >= CHAPTER_CHARS:
+                self.pending_chapters.append(self.current_chapter)
+                self.current_chapter = ""
+        return self.needs_update()
+
+    def needs_update(self):
+        with self._lock:
+            return bool(self.pending_chapters) or len(self.chapter_summaries) >= CHAPTERS_PER_ARC \
+                or len(self.arc_summaries) >= ARCS_PER_BOOK
+
+    def update(self, summarize, should_stop=None):
+        """生成所有待生成的概要
+
+        summarize(prompt)返回模型输出的文本，调用时不持有锁，可以耗时很久。
+        每完成一步就保存一次，中途停止或出错时已完成的部分不会丢失。
+        """
+        while should_stop is None or not should_stop():
+            with self._lock:
+                if self.pending_chapters:
+                    step = "chapter"
+                    prompt = CHAPTER_PROMPT.format(limit=CHAPTER_SUMMARY_CHARS, text=self.pending_chapters[0])
+                elif len(self.chapter_summaries) >= CHAPTERS_PER_ARC:
+                    step = "arc"
+                    merged = "\n".join(self.chapter_summaries[:CHAPTERS_PER_ARC])
+                    prompt = ARC_PROMPT.format(limit=ARC_SUMMARY_CHARS, text=merged)
+                elif len(self.arc_summaries) >= ARCS_PER_BOOK:
+                    step = "book"
+                    merged = "\n".join(self.arc_summaries[:ARCS_PER_BOOK])
+                    prompt = BOOK_PROMPT.format(limit=BOOK_SUMMARY_CHARS, book=self.book_summary or "（无）",
+                                                text=merged)
+                else:
+                    return
+            summary = summarize(prompt)
+            with self._lock:
+                if step == "chapter":
+                    self.pending_chapters.pop(0)
+                    self.chapter_summaries.append(_clip(summary, CHAPTER_SUMMARY_CHARS))
+                    self.chapter_count += 1
+                elif step == "arc":
+                    del self.chapter_summaries[:CHAPTERS_PER_ARC]
+                    self.arc_summaries.append(_clip(summary, ARC_SUMMARY_CHARS))
+                else:
+                    del self.arc_summaries[:ARCS_PER_BOOK]
+                    self.book_summary = _clip(summary, BOOK_SUMMARY_CHARS)
+            self.save()
+
+    def build_prompt(self, instruction, budget_tokens=DEFAULT_BUDGET_TOKENS,
+                     recent_paragraphs=DEFAULT_RECENT_PARAGRAPHS):
+        """组装续写提示：各层概要 + 最近几段原文 + 用户的写作要求
+
+        记忆部分的估算token数不超过budget_tokens。最近原文最多占一半预算，
+        其余依次留给较新的章节概要、篇章概要和全书概要，超出的部分从最旧的开始舍弃。
+        """
+        with self._lock:
+            paragraphs = [p for p in self.recent_text.split("\n") if p.strip()]
+            chapter_summaries = list(self.chapter_summaries)
+            arc_summaries = list(self.arc_summaries)
+            book_summary = self.book_summary
+            # 已结束但概要还没生成的章节，暂时用其末尾原文代替
+            pending = [_fit(text, CHAPTER_SUMMARY_CHARS, keep_tail=True) for text in self.pending_chapters]
+
+        remaining = budget_tokens
+        recent = []
+        recent_budget = budget_tokens // 2
+        for paragraph in reversed(paragraphs[-recent_paragraphs:] if recent_paragraphs > 0 else []):
+            paragraph = _fit(paragraph, recent_budget, keep_tail=True)
+            if not paragraph:
+                break
+            recent.insert(0, paragraph)
+            recent_budget -= estimate_tokens(paragraph)
+        remaining -= sum(estimate_tokens(p) for p in recent)
+
+        def take(items):
+            nonlocal remaining
+            kept = []
+            for item in reversed(items):
+                item = _fit(item, remaining)
+                if not item:
+                    break
+                kept.insert(0, item)
+                remaining -= estimate_tokens(item)
+            return kept
+
+        chapters = take(chapter_summaries + pending)
+        arcs = take(arc_summaries)
+        book = take([book_summary] if book_summary else [])
+
+        sections = []
+        if book:
+            sections.append("【全书概要】\n" + book[0])
+        if arcs:
+            sections.append("【前情提要】\n" + "\n".join(arcs))
+        if chapters:
+            sections.append("【近期章节】\n" + "\n".join(chapters))
+        if recent:
+            sections.append("【最近原文】\n" + "\n".join(recent))
+        if not sections:
+            return instruction
+        sections.append("【续写要求】\n" + (instruction or "紧接最近原文继续写下去"))
+        return "请根据以下故事记忆续写小说，保持人物、情节和文风连贯。\n\n" + "\n\n".join(sections)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "total_chars": self.total_chars,
+                "chapters": self.chapter_count,
+                "pending": len(self.pending_chapters),
+                "arcs": len(self.arc_summaries),
+                "has_book_summary": bool(self.book_summary),
+            }
@@ -0,0 +1,161 @@
+import json
+
+
+class StreamDecodeError(Exception):
+    """流中出现服务端错误帧时抛出"""
+    pass
+
+
+class StreamDecoder:
+    """增量流解码器基类
+
+    直接处理iter_content得到的原始字节块，按换行切分成帧，
+    跨读取边界的半帧（包括被截断的UTF-8字符）会保留到下一次feed再拼接。
+    子类实现decode_frame，把一帧解析成文本增量。
+    """
+    def __init__(self):
+        self._buffer = b""
+        self.done = False  # 是否已收到结束帧
+        self.final_frame = None  # 结束帧的完整内容（如Ollama的context、用量统计）
+        self.usage = None  # OpenAI格式流中的用量统计（usage字段）
+        self.frames = 0  # 已处理的帧数
+        self.fast_frames = 0  # 走快速路径的帧数
+        self.malformed_frames = 0  # 无法解析而被跳过的帧数
+
+    def feed(self, data):
+        """输入一段字节，返回其中完整帧解析出的文本增量列表"""
+        if self._buffer:
+            data = self._buffer + data
+        lines = data.split(b"\n")
+        self._buffer = lines.pop()
+        deltas = []
+        for line in lines:
+            if self.done:
+                break
+            self._handle_line(line, deltas)
+        return deltas
+
+    def finish(self):
+        """流结束时处理缓冲区中剩余的最后一帧"""
+        deltas = []
+        if self._buffer and not self.done:
+            self._handle_line(self._buffer, deltas)
+        self._buffer = b""
+        return deltas
+
+    def _handle_line(self, line, deltas):
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        if not line:
+            return
+        self.frames += 1
+        self.decode_frame(line, deltas)
+
+    def decode_frame(self, frame, deltas):
+        """解析一帧，把得到的文本追加到deltas"""
+        raise NotImplementedError
+
+    def _load_json(self, payload):
+        """完整JSON解析，失败时记为损坏帧并返回None"""
+        try:
+            obj = json.loads(payload)
+        except ValueError:
+            self.malformed_frames += 1
+            return None
+        if not isinstance(obj, dict):
+            self.malformed_frames += 1
+            return None
+        if obj.get("error"):
+            error = obj["error"]
+            if isinstance(error, dict):
+                error = error.get("message", error)
+            raise StreamDecodeError(f"服务端返回错误: {error}")
+        return obj
+
+    def _fast_extract(self, frame, key):
+        """快速路径：对只含一个目标字段、没有转义字符的普通增量帧直接切片
+
+        帧中没有反斜杠时，所有引号都是JSON结构的一部分，
+        字段值就是两个引号之间的原始字节，无需完整解析。
+        不满足条件时返回None，交给完整JSON解析。
+        """
+        if b"\\" in frame:
+            return None
+        start = frame.find(key)
+        if start < 0 or frame.find(key, start + 1) >= 0:
+            return None
+        start += len(key)
+        end = frame.find(b'"', start)
+        if end < 0:
+            return None
+        self.fast_frames += 1
+        return frame[start:end].decode("utf-8")
+
+
+class OllamaStreamDecoder(StreamDecoder):
+    """Ollama格式（NDJSON，每行一个JSON对象，文本在response字段）"""
+    _KEY = b'"response":"'
+
+    def decode_frame(self, frame, deltas):
+        # 只有done为false的普通帧走快速路径，结束帧需要完整解析以保留context等信息
+        if b'"done":false' in frame:
+            text = self._fast_extract(frame, self._KEY)
+            if text is not None:
+                if text:
+                    deltas.append(text)
+                return
+        obj = self._load_json(frame)
+        if obj is None:
+            return
+        text = obj.get("response")
+        if text:
+            deltas.append(text)
+        if obj.get("done"):
+            self.done = True
+            self.final_frame = obj
+
+
+class OpenAIStreamDecoder(StreamDecoder):
+    """OpenAI格式（SSE，data: 前缀，文本在choices[0].delta.content，以[DONE]结束）"""
+    _KEY = b'"content":"'
+
+    def decode_frame(self, frame, deltas):
+        if not frame.startswith(b"data:"):
+            # 注释行、event:、id: 等SSE字段与文本无关；
+            # 兼容不带data:前缀直接输出JSON的服务
+            if not frame.startswith(b"{"):
+                return
+            payload = frame
+        else:
+            payload = frame[5:].lstrip(b" ")
+        if payload == b"[DONE]":
+            self.done = True
+            return
+        if b'"finish_reason":"' not in payload:
+            text = self._fast_extract(payload, self._KEY)
+            if text is not None:
+                if text:
+                    deltas.append(text)
+                return
+        obj = self._load_json(payload)
+        if obj is None:
+            return
+        if obj.get("usage"):
+            # 开启stream_options.include_usage时用量在最后一个choices为空的帧中
+            self.usage = obj["usage"]
+        choices = obj.get("choices") or []
+        if choices:
+            choice = choices[0]
+            delta = choice.get("delta") or choice.get("message") or {}
+            text = delta.get("content")
+            if text:
+                deltas.append(text)
+            if choice.get("finish_reason"):
+                self.final_frame = obj
+
+
+def create_decoder(api_type, api_format=None):
+    """根据API类型和格式创建对应的解码器"""
+    if api_type == "Ollama" or (api_type == "自定义" and api_format == "Ollama格式"):
+        return OllamaStreamDecoder()
+    return OpenAIStreamDecoder()
@@ -0,0 +1,298 @@
+import json
+import math
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from http_pool import SessionPool
+
+# 每个直方图保留的最近样本数（滚动窗口）
+DEFAULT_WINDOW = 500
+# 分片间隔每个请求有很多个样本，窗口相应放大
+GAP_WINDOW = DEFAULT_WINDOW * 20
+# 导出时保留的最近请求记录数
+MAX_RECORDS = 2000
+
+# 聚合的指标：名称 -> 显示名
+METRICS = {
+    "connect_ms": "连接(ms)",
+    "ttft_ms": "首字延迟(ms)",
+    "prompt_eval_ms": "提示处理(ms)",
+    "tokens_per_sec": "速度(token/s)",
+    "gap_ms": "分片间隔(ms)",
+    "total_ms": "总耗时(ms)",
+    "cancel_ms": "取消耗时(ms)",
+}
+PERCENTILES = (50, 90, 99)
+
+
+def _estimate_tokens(text):
+    # 延迟导入，未记录文本时不需要
+    from token_estimator import estimate_tokens
+    return estimate_tokens(text)
+
+
+class RequestMetrics:
+    """一次生成请求的计时与用量
+
+    在工作线程中按顺序调用start、mark_connected、on_text和finish，
+    finish之后的字段只读，可以在界面线程中读取。
+    """
+    def __init__(self, api_type, api_url, model_name):
+        self.api_type = api_type
+        self.endpoint = SessionPool.endpoint_key(api_url)
+        self.model_name = model_name
+        self.started_at = None  # 墙上时间，用于导出
+        self.status = None  # success/cancelled/error
+        self.connect_ms = None  # 发出请求到收到响应头
+        self.ttft_ms = None  # 发出请求到第一段文本
+        self.total_ms = None
+        self.chars = 0
+        self.chunks = 0
+        self.gaps_ms = []  # 相邻文本分片之间的间隔
+        self.tokens = None
+        self.prompt_tokens = None  # 服务端处理的提示token数
+        self.prompt_eval_ms = None  # 服务端处理提示的耗时（Ollama结束帧）
+        self.token_source = None  # server：服务端返回的用量；estimate：按字数估算
+        self.tokens_per_sec = None  # 首字之后的生成速度
+        self.cancel_ms = None  # 从请求取消到工作线程真正停止
+        self._cancel_at = None
+        self._start = None
+        self._last = None
+
+    def set_endpoint(self, api_url):
+        """多端点路由时记录实际使用的端点"""
+        self.endpoint = SessionPool.endpoint_key(api_url)
+
+    def start(self):
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+
+    def mark_connected(self):
+        if self._start is not None and self.connect_ms is None:
+            self.connect_ms = (time.perf_counter() - self._start) * 1000
+
+    def mark_cancel_requested(self):
+        """记录发出取消的时刻（可在界面线程中调用）"""
+        if self._cancel_at is None:
+            self._cancel_at = time.perf_counter()
+
+    def on_text(self, text):
+        if self._start is None:
+            return
+        now = time.perf_counter()
+        if self._last is None:
+            self.ttft_ms = (now - self._start) * 1000
+        else:
+            self.gaps_ms.append((now - self._last) * 1000)
+        self._last = now
+        self.chars += len(text)
+        self.chunks += 1
+
+    def finish(self, status, decoder=None, text=""):
+        """结束计时；decoder带有服务端用量时使用服务端的token数"""
+        if self._start is None:
+            self.start()
+        self.status = status
+        now = time.perf_counter()
+        self.total_ms = (now - self._start) * 1000
+        if self._cancel_at is not None:
+            self.cancel_ms = (now - self._cancel_at) * 1000
+        tokens = None
+        if decoder is not None:
+            final = decoder.final_frame or {}
+            usage = getattr(decoder, "usage", None) or {}
+            if final.get("eval_count"):
+                tokens = final["eval_count"]  # Ollama
+            elif usage.get("completion_tokens"):
+                tokens = usage["completion_tokens"]  # OpenAI
+            self.prompt_tokens = final.get("prompt_eval_count") or usage.get("prompt_tokens")
+            if final.get("prompt_eval_duration") is not None:
+                self.prompt_eval_ms = final["prompt_eval_duration"] / 1e6  # 纳秒
+        if tokens is not None:
+            self.tokens, self.token_source = tokens, "server"
+        elif text:
+            self.tokens, self.token_source = _estimate_tokens(text), "estimate"
+        if self.tokens and self.ttft_ms is not None:
+            generating = (self.total_ms - self.ttft_ms) / 1000
+            if generating > 0:
+                self.tokens_per_sec = self.tokens / generating
+
+    def to_dict(self):
+        gaps = sorted(self.gaps_ms)
+        return {
+            "time": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds")
+            if self.started_at else None,
+            "api_type": self.api_type,
+            "endpoint": self.endpoint,
+            "model": self.model_name,
+            "status": self.status,
+            "connect_ms": _round(self.connect_ms),
+            "ttft_ms": _round(self.ttft_ms),
+            "total_ms": _round(self.total_ms),
+            "chars": self.chars,
+            "chunks": self.chunks,
+            "tokens": self.tokens,
+            "token_source": self.token_source,
+            "tokens_per_sec": _round(self.tokens_per_sec),
+            "prompt_tokens": self.prompt_tokens,
+            "prompt_eval_ms": _round(self.prompt_eval_ms),
+            "gap_p50_ms": _round(_percentile(gaps, 50)),
+            "gap_max_ms": _round(gaps[-1] if gaps else None),
+            "cancel_ms": _round(self.cancel_ms),
+        }
+
+
+def _round(value, digits=1):
+    return round(value, digits) if value is not None else None
+
+
+def _percentile(sorted_values, p):
+    """最近秩法百分位，sorted_values需已排序"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values), math.ceil(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+class Histogram:
+    """滚动窗口百分位统计，只保留最近window个样本"""
+    def __init__(self, window=DEFAULT_WINDOW):
+        self._values = deque(maxlen=window)
+
+    def add(self, value):
+        if value is not None:
+            self._values.append(value)
+
+    def extend(self, values):
+        self._values.extend(values)
+
+    @property
+    def count(self):
+        return len(self._values)
+
+    def values(self):
+        return list(self._values)
+
+    def snapshot(self):
+        """返回样本数、平均值和各百分位"""
+        values = sorted(self._values)
+        result = {"count": len(values),
+                  "mean": sum(values) / len(values) if values else None}
+        for p in PERCENTILES:
+            result[f"p{p}"] = _percentile(values, p)
+        return result
+
+
+class _Group:
+    """同一后端、同一模型的聚合统计"""
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.histograms = {name: Histogram(GAP_WINDOW if name == "gap_ms" else DEFAULT_WINDOW)
+                           for name in METRICS}
+        self.prompt_rates = Histogram()  # 服务端处理提示的速度（token/s），用于预估提示处理耗时
+
+
+class TelemetryStore:
+    """按后端和模型聚合请求指标，可在任意线程中记录"""
+    def __init__(self, max_records=MAX_RECORDS):
+        self._lock = threading.Lock()
+        self._groups = {}  # (api_type, endpoint, model) -> _Group
+        self._records = deque(maxlen=max_records)
+
+    def record(self, metrics):
+        """记录一次请求；失败的请求只计数，不进入延迟统计"""
+        key = (metrics.api_type, metrics.endpoint, metrics.model_name)
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _Group()
+            group.requests += 1
+            self._records.append(metrics.to_dict())
+            h = group.histograms
+            if metrics.status == "error":
+                group.errors += 1
+                return
+            if metrics.status == "cancelled":
+                group.cancelled += 1
+                h["cancel_ms"].add(metrics.cancel_ms)
+            h["connect_ms"].add(metrics.connect_ms)
+            h["ttft_ms"].add(metrics.ttft_ms)
+            h["prompt_eval_ms"].add(metrics.prompt_eval_ms)
+            if metrics.prompt_tokens and metrics.prompt_eval_ms:
+                group.prompt_rates.add(metrics.prompt_tokens * 1000 / metrics.prompt_eval_ms)
+            h["gap_ms"].extend(metrics.gaps_ms)
+            if metrics.status == "success":
+                # 取消的请求耗时和速度不完整，不计入
+                h["total_ms"].add(metrics.total_ms)
+                h["tokens_per_sec"].add(metrics.tokens_per_sec)
+
+    def summary(self):
+        """每个后端和模型一行的聚合结果"""
+        with self._lock:
+            rows = []
+            for (api_type, endpoint, model), group in self._groups.items():
+                row = {"api_type": api_type, "endpoint": endpoint, "model": model,
+                       "requests": group.requests, "errors": group.errors, "cancelled": group.cancelled}
+                for name, histogram in group.histograms.items():
+                    row[name] = histogram.snapshot()
+                rows.append(row)
+            return rows
+
+    def prompt_rate(self, api_type, model_name):
+        """该模型最近处理提示的速度（token/s，各后端合并的中位数），没有样本时返回None"""
+        rates = Histogram()
+        with self._lock:
+            for (group_type, _, model), group in self._groups.items():
+                if group_type == api_type and model == model_name:
+                    rates.extend(group.prompt_rates.values())
+        return rates.snapshot()["p50"]
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def clear(self):
+        with self._lock:
+            self._groups = {}
+            self._records.clear()
+
+    def export_json(self, path):
+        """导出聚合结果和每次请求的明细"""
+        data = {"exported_at": datetime.now().isoformat(timespec="seconds"),
+                "summary": self.summary(), "records": self.records()}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+    def export_csv(self, path):
+        """导出每次请求的明细，一行一个请求（带BOM，Excel可直接打开）"""
+        import csv
+        records = self.records()
+        fields = list(RequestMetrics("", "", "").to_dict().keys())
+        with open(path, "w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+
+    def export(self, path):
+        """按扩展名导出为CSV或JSON"""
+        if path.lower().endswith(".csv"):
+            self.export_csv(path)
+        else:
+            self.export_json(path)
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def get_telemetry():
+    """获取进程级共享的遥测统计"""
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            _telemetry = TelemetryStore()
+        return _telemetry
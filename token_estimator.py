@@ -0,0 +1,163 @@
+import math
+import re
+import threading
+from collections import OrderedDict
+
+# 各模型系列的分词密度和上下文窗口：(系列, 名称中的关键字, 每个汉字的token数, 每个token的其他字符数, 上下文窗口)
+# 按顺序匹配，更具体的关键字在前；数值为各分词器处理中文小说的大致平均值
+MODEL_FAMILIES = (
+    ("qwen", ("qwen", "qwq"), 0.7, 4.0, 32768),
+    ("deepseek", ("deepseek",), 0.6, 4.0, 65536),
+    ("glm", ("glm", "chatglm"), 0.6, 4.0, 131072),
+    ("yi", ("yi-", "yi:"), 0.6, 4.0, 32768),
+    ("baichuan", ("baichuan",), 0.6, 4.0, 32768),
+    ("moonshot", ("moonshot", "kimi"), 0.6, 4.0, 131072),
+    ("gpt-4o", ("gpt-4o", "gpt-4.1"), 0.8, 4.0, 128000),
+    ("gpt-3.5", ("gpt-3.5",), 1.3, 4.0, 16385),
+    ("gpt-4", ("gpt-4",), 1.3, 4.0, 128000),
+    ("claude", ("claude",), 1.1, 3.5, 200000),
+    ("gemma", ("gemma",), 0.9, 4.0, 8192),
+    ("llama3", ("llama3", "llama-3"), 1.0, 4.0, 8192),
+    ("llama", ("llama",), 1.5, 3.5, 4096),
+    ("mistral", ("mistral", "mixtral"), 1.4, 3.5, 32768),
+)
+DEFAULT_FAMILY = ("default", (), 1.0, 4.0, 8192)
+# Ollama不指定num_ctx时的上下文长度，超出的提示会被服务端静默截掉开头
+OLLAMA_DEFAULT_NUM_CTX = 4096
+# 每条消息的模板开销（角色标记等）
+PROMPT_OVERHEAD_TOKENS = 8
+# 缓存的行数和总字数：按行缓存，记忆、检索片段和编辑中没改动的行重复出现时直接复用
+MAX_CACHED_SEGMENTS = 4096
+MAX_CACHED_CHARS = 2000000
+# 窗口中至少留给提示的比例，单次最大长度接近窗口时不把提示压得过短
+MIN_PROMPT_SHARE = 0.5
+
+# OpenAI o系列推理模型（o1、o3-mini、openai/o4-mini）与gpt-4o同一分词器；名称很短，
+# 只在名称开头或"/"之后整词匹配，不把名称中间偶然出现的"o1"算进来
+_O_SERIES = re.compile(r"(?:^|/)o[134]\b")
+# 中日韩字符以外的字符（码位在"⺀"之前）；删掉它们后剩下的就是中日韩字符
+_NON_CJK = re.compile("[\x00-\u2e7f]+")
+
+
+def model_family(model_name):
+    """按模型名称判断所属系列，无法判断时返回DEFAULT_FAMILY"""
+    name = (model_name or "").lower()
+    if _O_SERIES.search(name):
+        return next(family for family in MODEL_FAMILIES if family[0] == "gpt-4o")
+    for family in MODEL_FAMILIES:
+        if any(keyword in name for keyword in family[1]):
+            return family
+    return DEFAULT_FAMILY
+
+
+def context_window(api_type, model_name, api_format=None, num_ctx=0):
+    """请求实际可用的上下文长度：Ollama为num_ctx（未设置时为服务端默认），其余按模型系列"""
+    ollama = api_type == "Ollama" or (api_type == "自定义" and api_format == "Ollama格式")
+    if ollama:
+        return num_ctx or OLLAMA_DEFAULT_NUM_CTX
+    return model_family(model_name)[4]
+
+
+def prompt_budget(window, max_tokens):
+    """提示可用的token数：窗口减去预留的输出长度，至少保留窗口的MIN_PROMPT_SHARE"""
+    return max(int(window * MIN_PROMPT_SHARE), window - max_tokens)
+
+
+def _estimate(text, family):
+    cjk = len(_NON_CJK.sub("", text))
+    return math.ceil(cjk * family[2] + (len(text) - cjk) / family[3])
+
+
+def estimate_tokens(text, model_name=None):
+    """估算一段文本的token数（不含消息模板开销，不缓存）；不指定模型时中日韩字符约一个字一个token，
+    其余字符约四个一个token
+    """
+    return _estimate(text, model_family(model_name))
+
+
+class TokenEstimator:
+    """按模型系列估算提示的token数，按行缓存估算结果
+
+    提示中的故事记忆、检索片段和正在编辑的提示在多次估算之间大多不变，
+    只有新增或改动的行需要重新计算。可在任意线程中使用。
+    """
+    def __init__(self, max_segments=MAX_CACHED_SEGMENTS, max_chars=MAX_CACHED_CHARS):
+        self.max_segments = max_segments
+        self.max_chars = max_chars
+        self._cache = OrderedDict()  # (系列, 行) -> token数
+        self._chars = 0  # 缓存中各行的总字数
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _segment_tokens(self, segment, family):
+        key = (family[0], segment)
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return tokens
+        tokens = _estimate(segment, family)
+        with self._lock:
+            self.misses += 1
+            if key not in self._cache:
+                self._chars += len(segment)
+            self._cache[key] = tokens
+            while len(self._cache) > self.max_segments or self._chars > self.max_chars:
+                (_, old), _ = self._cache.popitem(last=False)
+                self._chars -= len(old)
+        return tokens
+
+    def count(self, text, model_name=None):
+        """估算text在model_name的分词器下的token数（含消息模板开销）"""
+        if not text:
+            return 0
+        family = model_family(model_name)
+        return PROMPT_OVERHEAD_TOKENS + sum(self._segment_tokens(line, family) for line in text.splitlines(True))
+
+    def trim(self, text, budget, model_name=None):
+        """去掉text开头的整行直到估算token数不超过budget，保留靠近写作要求的末尾
+
+        最后一行本身超出预算时从该行开头截断。
+        """
+        family = model_family(model_name)
+        budget -= PROMPT_OVERHEAD_TOKENS
+        lines = text.splitlines(True)
+        kept = []
+        for line in reversed(lines):
+            tokens = self._segment_tokens(line, family)
+            if tokens > budget:
+                if not kept:
+                    kept.append(self._trim_line(line, budget, family))
+                break
+            budget -= tokens
+            kept.append(line)
+        return "".join(reversed(kept))
+
+    def _trim_line(self, line, budget, family):
+        low, high = 0, len(line)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if _estimate(line[-mid:], family) <= budget:
+                low = mid
+            else:
+                high = mid - 1
+        return line[len(line) - low:] if low else ""
+
+    def stats(self):
+        with self._lock:
+            return {"segments": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+_estimator = None
+_estimator_lock = threading.Lock()
+
+
+def get_token_estimator():
+    """获取进程级共享的token估算器"""
+    global _estimator
+    with _estimator_lock:
+        if _estimator is None:
+            _estimator = TokenEstimator()
+        return _estimator
@@ -1,15 +1,11 @@
-from PyQt5.QtCore import Qt, QSize, QUrl
+from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtWidgets import (
-    QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit,
-    QPushButton, QMessageBox, QFrame, QGridLayout, QTabWidget, QTextEdit,
-    QComboBox, QGroupBox, QFormLayout, QFileDialog, QSpinBox, QSplitter, QProgressBar,
-    QStackedWidget, QScrollArea, QToolBar, QAction, QMenu, QStatusBar, QToolTip,
-    QDialog, QDialogButtonBox
-)
-from PyQt5.QtGui import (
-    QFont, QIcon, QPalette, QColor, QPixmap, QPainter, QBrush, QLinearGradient,
-    QFontDatabase
+    QWidget, QVBoxLayout, QHBoxLayout, QLineEdit, QPushButton, QFrame, QLabel, QPlainTextEdit,
+    QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView, QFileDialog, QMessageBox
 )
+from PyQt5.QtGui import QColor, QPainter, QLinearGradient, QTextCursor
+
+from telemetry import METRICS
 
 class GradientFrame(QFrame):
     """自定义渐变背景框架"""
@@ -74,4 +70,279 @@ class CustomInput(QLineEdit):
                 background-color: rgba(255, 255, 255, 0.15);
             }
         """)
-        self.setEchoMode(QLineEdit.Normal)
\ No newline at end of file
+        self.setEchoMode(QLineEdit.Normal)
+
+
+class JobQueuePanel(QWidget):
+    """任务队列面板，显示每个任务的状态并支持单独取消"""
+    COLUMNS = ["编号", "提示", "后端", "优先级", "状态", "进度"]
+
+    def __init__(self, job_queue, jobs_in_use=None, parent=None):
+        super().__init__(parent)
+        self.job_queue = job_queue
+        self.jobs_in_use = jobs_in_use  # 返回界面仍在使用的任务编号，清除时保留这些任务
+        self._rows = {}  # job_id -> 行号
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+        self.table.setStyleSheet("""
+            QTableWidget {
+                background-color: rgba(255, 255, 255, 0.1);
+                color: white;
+                border: 1px solid rgba(255, 255, 255, 0.3);
+                border-radius: 5px;
+            }
+            QHeaderView::section {
+                background-color: rgba(108, 92, 231, 0.6);
+                color: white;
+                border: none;
+                padding: 4px;
+            }
+        """)
+        layout.addWidget(self.table)
+
+        button_layout = QHBoxLayout()
+        button_layout.addStretch()
+        self.cancel_button = CustomButton("取消所选", size=(120, 36))
+        self.cancel_button.clicked.connect(self.cancel_selected)
+        button_layout.addWidget(self.cancel_button)
+        self.clear_button = CustomButton("清除已结束", size=(120, 36))
+        self.clear_button.clicked.connect(self.clear_finished)
+        button_layout.addWidget(self.clear_button)
+        layout.addLayout(button_layout)
+
+        job_queue.job_changed.connect(self.refresh_job)
+
+    def refresh_job(self, job_id):
+        """刷新某个任务所在的行，新任务追加到末尾"""
+        job = self.job_queue.get(job_id)
+        if job is None:
+            return
+        row = self._rows.get(job_id)
+        if row is None:
+            row = self.table.rowCount()
+            self.table.insertRow(row)
+            self._rows[job_id] = row
+        prompt = job.prompt.replace("\n", " ")
+        values = [
+            f"#{job.job_id}",
+            prompt[:40] + ("…" if len(prompt) > 40 else ""),
+            f"{job.api_type} {job.params['model_name']}",
+            str(job.priority),
+            job.display_state,
+            f"{job.progress}%",
+        ]
+        for column, value in enumerate(values):
+            item = self.table.item(row, column)
+            if item is None:
+                self.table.setItem(row, column, QTableWidgetItem(value))
+            elif item.text() != value:
+                item.setText(value)
+
+    def cancel_selected(self):
+        """取消选中的任务"""
+        rows = {index.row() for index in self.table.selectedIndexes()}
+        for job_id, row in list(self._rows.items()):
+            if row in rows:
+                self.job_queue.cancel(job_id)
+
+    def clear_finished(self):
+        """移除已结束的任务并重建列表"""
+        self.job_queue.clear_finished(self.jobs_in_use() if self.jobs_in_use is not None else ())
+        self.table.setRowCount(0)
+        self._rows = {}
+        for job in self.job_queue.jobs():
+            self.refresh_job(job.job_id)
+
+
+class VariantPanel(QWidget):
+    """同一提示的多个候选并排流式显示，选中一个后其余候选立即停止"""
+    picked = pyqtSignal(int)  # 选中的任务号
+
+    def __init__(self, job_queue, parent=None):
+        super().__init__(parent)
+        self.job_queue = job_queue
+        self._columns = {}  # job_id -> (标题, 文本框, 选择按钮)
+
+        self.columns_layout = QHBoxLayout(self)
+        self.columns_layout.setContentsMargins(0, 0, 0, 0)
+
+        job_queue.job_changed.connect(self.refresh_job)
+
+    def set_jobs(self, job_ids):
+        """为一组候选重建各列"""
+        self.clear()
+        for index, job_id in enumerate(job_ids):
+            column = QVBoxLayout()
+            title = QLabel("")
+            title.setStyleSheet("color: white;")
+            column.addWidget(title)
+            text = QPlainTextEdit()
+            text.setReadOnly(True)
+            text.setStyleSheet("""
+                QPlainTextEdit {
+                    background-color: rgba(255, 255, 255, 0.1);
+                    color: white;
+                    border: 1px solid rgba(255, 255, 255, 0.3);
+                    border-radius: 5px;
+                    padding: 5px;
+                }
+            """)
+            column.addWidget(text)
+            button = CustomButton(f"选择候选{index + 1}", size=(120, 36))
+            button.clicked.connect(lambda checked=False, job_id=job_id: self.picked.emit(job_id))
+            column.addWidget(button)
+            self.columns_layout.addLayout(column)
+            self._columns[job_id] = (title, text, button)
+            self.refresh_job(job_id)
+
+    def job_ids(self):
+        return list(self._columns)
+
+    def append(self, job_id, text):
+        """在候选末尾追加增量文本，原本停在底部时保持滚动到底部"""
+        column = self._columns.get(job_id)
+        if column is None:
+            return
+        view = column[1]
+        scrollbar = view.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum() - 4
+        cursor = QTextCursor(view.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
+
+    def remove_tail(self, job_id, text):
+        """删除候选末尾被撤回的文本"""
+        column = self._columns.get(job_id)
+        if column is None:
+            return
+        doc = column[1].document()
+        end = doc.characterCount() - 1  # 不含末尾隐含的段落符
+        cursor = QTextCursor(doc)
+        cursor.setPosition(end)
+        cursor.setPosition(max(0, end - len(text.encode("utf-16-le")) // 2), QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+
+    def refresh_job(self, job_id):
+        """更新候选的标题：序号、采样参数和状态"""
+        column = self._columns.get(job_id)
+        job = self.job_queue.get(job_id)
+        if column is None or job is None:
+            return
+        title, _, button = column
+        index = list(self._columns).index(job_id) + 1
+        sampling = job.params.get("sampling") or {}
+        text = f"候选{index}（温度 {sampling.get('temperature', '-')}）：{job.state}"
+        if job.picked:
+            text = "★ " + text
+        title.setText(text)
+        # 失败的候选和已有候选被选中后不能再选
+        button.setEnabled(job.error is None and not any(
+            other.picked for other in self.job_queue.group_jobs(job.group)))
+
+    def clear(self):
+        """移除所有列"""
+        while self.columns_layout.count():
+            column = self.columns_layout.takeAt(0).layout()
+            while column.count():
+                widget = column.takeAt(0).widget()
+                widget.deleteLater()
+            column.deleteLater()
+        self._columns = {}
+
+
+class TelemetryPanel(QWidget):
+    """请求统计面板：按后端和模型显示各项指标的P50 / P90 / P99，可导出JSON或CSV"""
+    COLUMNS = ["后端", "模型", "请求", "失败", "取消"]
+
+    def __init__(self, telemetry, parent=None):
+        super().__init__(parent)
+        self.telemetry = telemetry
+        self.metric_names = list(METRICS)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(20, 20, 20, 20)
+
+        columns = self.COLUMNS + [f"{label} P50/P90/P99" for label in METRICS.values()]
+        self.table = QTableWidget(0, len(columns))
+        self.table.setHorizontalHeaderLabels(columns)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.setStyleSheet("""
+            QTableWidget {
+                background-color: rgba(255, 255, 255, 0.1);
+                color: white;
+                border: 1px solid rgba(255, 255, 255, 0.3);
+                border-radius: 5px;
+            }
+            QHeaderView::section {
+                background-color: rgba(108, 92, 231, 0.6);
+                color: white;
+                border: none;
+                padding: 4px;
+            }
+        """)
+        layout.addWidget(self.table)
+
+        button_layout = QHBoxLayout()
+        button_layout.addStretch()
+        self.refresh_button = CustomButton("刷新", size=(120, 36))
+        self.refresh_button.clicked.connect(self.refresh)
+        button_layout.addWidget(self.refresh_button)
+        self.export_button = CustomButton("导出", size=(120, 36))
+        self.export_button.clicked.connect(self.export)
+        button_layout.addWidget(self.export_button)
+        self.clear_button = CustomButton("清空统计", size=(120, 36))
+        self.clear_button.clicked.connect(self.clear)
+        button_layout.addWidget(self.clear_button)
+        layout.addLayout(button_layout)
+
+        self.refresh()
+
+    def refresh(self):
+        """按最新统计重建表格"""
+        rows = self.telemetry.summary()
+        self.table.setRowCount(len(rows))
+        for row, data in enumerate(rows):
+            values = [
+                f"{data['api_type']} {data['endpoint']}",
+                data["model"],
+                str(data["requests"]),
+                str(data["errors"]),
+                str(data["cancelled"]),
+            ]
+            for name in self.metric_names:
+                snapshot = data[name]
+                values.append(" / ".join(
+                    "-" if snapshot[p] is None else f"{snapshot[p]:.0f}" for p in ("p50", "p90", "p99")
+                ))
+            for column, value in enumerate(values):
+                self.table.setItem(row, column, QTableWidgetItem(value))
+
+    def export(self):
+        """导出为JSON（聚合结果+明细）或CSV（明细）"""
+        path, selected_filter = QFileDialog.getSaveFileName(
+            self, "导出统计", "telemetry.json", "JSON文件 (*.json);;CSV文件 (*.csv)"
+        )
+        if not path:
+            return
+        if "csv" in selected_filter and not path.lower().endswith(".csv"):
+            path += ".csv"
+        try:
+            self.telemetry.export(path)
+        except Exception as e:
+            QMessageBox.warning(self, "错误", f"导出失败: {str(e)}")
+
+    def clear(self):
+        self.telemetry.clear()
+        self.refresh()